@@ -0,0 +1,315 @@
+import os
+import re
+import random
+import asyncio
+import logging
+from collections import deque
+from datetime import date, datetime, timedelta, timezone
+
+import db
+import funnel
+
+# ===== НАСТРОЙКИ ЖУРНАЛА АКТИВНОСТИ =====
+# Ёмкость кольцевого буфера: при переполнении теряются самые старые события
+ACTIVITY_BUFFER_SIZE = int(os.environ.get('ACTIVITY_BUFFER_SIZE', 10000))
+# Сброс в БД по размеру пачки или по времени — что наступит раньше
+ACTIVITY_FLUSH_SIZE = int(os.environ.get('ACTIVITY_FLUSH_SIZE', 500))
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get('ACTIVITY_FLUSH_INTERVAL', 5))
+# Выше этой заполненности буфера события пишутся выборочно
+ACTIVITY_SAMPLE_WATERMARK = float(os.environ.get('ACTIVITY_SAMPLE_WATERMARK', 0.8))
+ACTIVITY_SAMPLE_RATE = float(os.environ.get('ACTIVITY_SAMPLE_RATE', 0.1))
+
+# ===== ХРАНЕНИЕ =====
+# Сырые события хранятся помесячными секциями столько месяцев (не считая текущего),
+# дальше остаются только дневные сводки user_activity_daily
+ACTIVITY_RETENTION_MONTHS = int(os.environ.get('ACTIVITY_RETENTION_MONTHS', 6))
+# Сколько будущих месяцев секционировать заранее, чтобы вставке всегда было куда писать
+ACTIVITY_PARTITIONS_AHEAD = int(os.environ.get('ACTIVITY_PARTITIONS_AHEAD', 2))
+# Период задачи обслуживания (сводки, новые и устаревшие секции), секунды
+ACTIVITY_MAINTENANCE_INTERVAL = float(os.environ.get('ACTIVITY_MAINTENANCE_INTERVAL', 3600))
+# Сколько дней сворачивать за один запуск — первый запуск на большой истории не растягивается
+ACTIVITY_ROLLUP_MAX_DAYS = int(os.environ.get('ACTIVITY_ROLLUP_MAX_DAYS', 31))
+# Сутки сворачиваются, когда после их конца прошло столько секунд: события пишутся
+# со своим временем пачками с задержкой (ACTIVITY_FLUSH_INTERVAL, повтор после сбоя)
+ACTIVITY_ROLLUP_DELAY = float(os.environ.get('ACTIVITY_ROLLUP_DELAY', 300))
+
+PARTITION_RE = re.compile(r'^user_activity_(\d{6})$')
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityRecorder:
+    """Сбор событий пользователей в памяти и пакетная запись в user_activity.
+
+    record() не ждёт БД и не блокирует обработчик: событие кладётся в буфер,
+    а фоновая задача сбрасывает накопленное одним многострочным INSERT.
+    """
+
+    def __init__(self, buffer_size=ACTIVITY_BUFFER_SIZE):
+        self._buffer = deque(maxlen=buffer_size)
+        self._high_watermark = int(buffer_size * ACTIVITY_SAMPLE_WATERMARK)
+        self._flush_needed = asyncio.Event()
+        self._task = None
+        self.stats = {'recorded': 0, 'dropped': 0, 'sampled_out': 0, 'flushed': 0, 'batches': 0, 'errors': 0}
+
+    def record(self, user_id, action, details=None):
+        size = len(self._buffer)
+        if size >= self._high_watermark and random.random() > ACTIVITY_SAMPLE_RATE:
+            self.stats['sampled_out'] += 1
+            return
+        if size == self._buffer.maxlen:
+            self.stats['dropped'] += 1
+        # Время события фиксируется здесь, а не при вставке: пачка пишется с задержкой
+        self._buffer.append((user_id, action[:50], details, datetime.now(timezone.utc).replace(tzinfo=None)))
+        self.stats['recorded'] += 1
+        if size + 1 >= ACTIVITY_FLUSH_SIZE:
+            self._flush_needed.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name='activity_flusher')
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Досбрасываем остаток при остановке
+        while self._buffer:
+            if not await self.flush():
+                break
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=ACTIVITY_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            while self._buffer:
+                if not await self.flush() or len(self._buffer) < ACTIVITY_FLUSH_SIZE:
+                    break
+
+    async def flush(self):
+        """Запись одной пачки; при ошибке БД события возвращаются в буфер, если есть место"""
+        batch = [self._buffer.popleft() for _ in range(min(len(self._buffer), ACTIVITY_FLUSH_SIZE))]
+        if not batch:
+            return True
+        try:
+            await db.call(db.pool.run, _insert_events, batch)
+        except Exception as e:
+            self.stats['errors'] += 1
+            room = self._buffer.maxlen - len(self._buffer)
+            keep = batch[-room:] if room else []
+            self.stats['dropped'] += len(batch) - len(keep)
+            self._buffer.extendleft(reversed(keep))
+            logger.error(f"❌ Ошибка записи активности ({len(batch)} событий): {e}")
+            return False
+        self.stats['flushed'] += len(batch)
+        self.stats['batches'] += 1
+        return True
+
+    @property
+    def backlog(self):
+        return len(self._buffer)
+
+
+def _insert_events(conn, batch):
+    cursor = conn.cursor()
+    db.execute_values(
+        cursor,
+        'INSERT INTO user_activity (user_id, action, details, created_at) VALUES %s',
+        batch, page_size=len(batch)
+    )
+    cursor.close()
+
+
+# ===== ТАБЛИЦЫ И СЕКЦИИ =====
+def _utc_today():
+    # Время событий пишется в UTC (см. record), поэтому и границы суток — в UTC
+    return datetime.now(timezone.utc).date()
+
+
+def _add_months(month, count):
+    years, month_index = divmod(month.month - 1 + count, 12)
+    return date(month.year + years, month_index + 1, 1)
+
+
+def ensure_partitions(cursor, first_month=None):
+    """Секции с first_month (по умолчанию текущего) до ACTIVITY_PARTITIONS_AHEAD месяцев вперёд"""
+    this_month = _utc_today().replace(day=1)
+    month = first_month or this_month
+    last = _add_months(this_month, ACTIVITY_PARTITIONS_AHEAD)
+    while month <= last:
+        upper = _add_months(month, 1)
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS user_activity_{month:%Y%m}
+            PARTITION OF user_activity FOR VALUES FROM (%s) TO (%s)
+        ''', (month, upper))
+        month = upper
+
+
+def init_activity_tables(cursor):
+    """Журнал активности, секционированный по месяцам, и дневные сводки.
+
+    Несекционированная user_activity прежних версий переносится в секции
+    один раз при старте.
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('user_activity')")
+    row = cursor.fetchone()
+    legacy = row is not None and row[0] == 'r'
+    if legacy:
+        cursor.execute('ALTER TABLE user_activity RENAME TO user_activity_unpartitioned')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_activity (
+            user_id BIGINT,
+            action VARCHAR(50),
+            details TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) PARTITION BY RANGE (created_at)
+    ''')
+    # История пользователя; индекс родителя создаётся в каждой секции
+    cursor.execute('CREATE INDEX IF NOT EXISTS user_activity_user_created_idx ON user_activity (user_id, created_at)')
+    # События пишутся по возрастанию времени — BRIN на диапазон суток почти ничего не весит
+    cursor.execute('CREATE INDEX IF NOT EXISTS user_activity_created_brin ON user_activity USING brin (created_at)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_activity_daily (
+            day DATE,
+            action VARCHAR(50),
+            details TEXT,
+            events INTEGER NOT NULL,
+            users INTEGER NOT NULL,
+            PRIMARY KEY (day, action, details)
+        )
+    ''')
+    funnel.init_funnel_tables(cursor)
+    # До какого момента сырые события уже свёрнуты, по каждой сводке
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS activity_rollup_state (
+            name VARCHAR(50) PRIMARY KEY,
+            rolled_until TIMESTAMP NOT NULL
+        )
+    ''')
+
+    first_month = None
+    if legacy:
+        cursor.execute('SELECT MIN(created_at) FROM user_activity_unpartitioned')
+        oldest = cursor.fetchone()[0]
+        if oldest is not None:
+            first_month = oldest.date().replace(day=1)
+    ensure_partitions(cursor, first_month)
+
+    if legacy:
+        cursor.execute('''
+            INSERT INTO user_activity (user_id, action, details, created_at)
+            SELECT user_id, action, details, COALESCE(created_at, CURRENT_TIMESTAMP)
+            FROM user_activity_unpartitioned
+        ''')
+        logger.info(f"✅ Журнал активности перенесён в помесячные секции: {cursor.rowcount} событий")
+        cursor.execute('DROP TABLE user_activity_unpartitioned')
+
+
+# ===== ОБСЛУЖИВАНИЕ =====
+def _rollup(cursor):
+    """Сворачивание завершённых суток в user_activity_daily. Возвращает
+    (свёрнуто суток, дата, до которой всё свёрнуто)"""
+    ready = (datetime.now(timezone.utc) - timedelta(seconds=ACTIVITY_ROLLUP_DELAY)).date()
+    cursor.execute("SELECT rolled_until FROM activity_rollup_state WHERE name = 'daily'")
+    row = cursor.fetchone()
+    if row is not None:
+        start = row[0].date()
+    else:
+        cursor.execute('SELECT MIN(created_at) FROM user_activity')
+        oldest = cursor.fetchone()[0]
+        start = oldest.date() if oldest is not None else ready
+    end = min(ready, start + timedelta(days=ACTIVITY_ROLLUP_MAX_DAYS))
+    if start >= end:
+        return 0, start
+    # Свободный текст сообщений (action='text') в сводку не попадает — только счётчики
+    cursor.execute('''
+        INSERT INTO user_activity_daily (day, action, details, events, users)
+        SELECT created_at::date, action,
+            CASE WHEN action = 'text' THEN '' ELSE COALESCE(details, '') END,
+            COUNT(*), COUNT(DISTINCT user_id)
+        FROM user_activity
+        WHERE created_at >= %s AND created_at < %s
+        GROUP BY 1, 2, 3
+        ON CONFLICT (day, action, details) DO UPDATE SET events = EXCLUDED.events, users = EXCLUDED.users
+    ''', (start, end))
+    cursor.execute('''
+        INSERT INTO activity_rollup_state (name, rolled_until) VALUES ('daily', %s)
+        ON CONFLICT (name) DO UPDATE SET rolled_until = EXCLUDED.rolled_until
+    ''', (end,))
+    return (end - start).days, end
+
+
+def _drop_expired(cursor, rolled_until):
+    """Удаление секций старше срока хранения — только если их сутки уже свёрнуты"""
+    cutoff = min(_add_months(_utc_today().replace(day=1), -ACTIVITY_RETENTION_MONTHS), rolled_until)
+    cursor.execute('''
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'user_activity'::regclass
+    ''')
+    dropped = []
+    for (name,) in cursor.fetchall():
+        match = PARTITION_RE.match(name)
+        if match is None:
+            continue
+        month = datetime.strptime(match.group(1), '%Y%m').date()
+        if _add_months(month, 1) <= cutoff:
+            cursor.execute(f'DROP TABLE {name}')
+            dropped.append(name)
+    return sorted(dropped)
+
+
+def maintain(sections=()):
+    """Задача обслуживания: секции наперёд, дневные и часовые (воронка) сводки,
+    удаление устаревших секций. sections — разделы базы знаний для отчёта /funnel"""
+    def run(conn):
+        cursor = conn.cursor()
+        ensure_partitions(cursor)
+        days, rolled_until = _rollup(cursor)
+        hours, funnel_until = funnel.rollup(cursor, sections)
+        # Секция удаляется, только когда её свернули обе сводки
+        dropped = _drop_expired(cursor, min(rolled_until, funnel_until.date()))
+        cursor.close()
+        return days, hours, dropped
+
+    days, hours, dropped = db.pool.run(run)
+    if days or hours or dropped:
+        logger.info(
+            f"🧹 Активность: свёрнуто суток {days}, часов воронки {hours}, "
+            f"удалены секции {', '.join(dropped) or '—'}"
+        )
+    return days, dropped
+
+
+recorder = None
+
+
+def start_recorder():
+    """Журнал активности работает только при настроенной БД"""
+    global recorder
+    if db.pool is None:
+        return
+    recorder = ActivityRecorder()
+    recorder.start()
+
+
+async def stop_recorder():
+    if recorder is not None:
+        await recorder.stop()
+
+
+def record(user_id, action, details=None):
+    if recorder is not None and user_id is not None:
+        recorder.record(user_id, action, details)
+
+
+def activity_stats():
+    if recorder is None:
+        return None
+    return dict(recorder.stats, backlog=recorder.backlog)
@@ -0,0 +1,127 @@
+import os
+import hmac
+import json
+import hashlib
+import logging
+
+from aiohttp import web
+from aiohttp.helpers import ETag
+
+import db
+import leads
+import startup
+
+# ===== НАСТРОЙКИ API ЗАЯВОК =====
+# Токен CRM (заголовок Authorization: Bearer ...); без токена API выключен.
+# API отвечает на HTTP-сервере бота: webhook, кластер или polling с заданным PORT
+LEADS_API_TOKEN = os.environ.get('LEADS_API_TOKEN', '')
+LEADS_API_PAGE_SIZE = int(os.environ.get('LEADS_API_PAGE_SIZE', 100))
+LEADS_API_MAX_PAGE_SIZE = int(os.environ.get('LEADS_API_MAX_PAGE_SIZE', 1000))
+# Изменения моложе стольких секунд лента не отдаёт (см. leads.fetch_lead_changes)
+LEADS_API_SETTLE = float(os.environ.get('LEADS_API_SETTLE', 5))
+# Ответы меньше этого не сжимаются: gzip маленького JSON не окупается
+LEADS_API_GZIP_MIN = int(os.environ.get('LEADS_API_GZIP_MIN', 1024))
+
+logger = logging.getLogger(__name__)
+
+stats = {'requests': 0, 'not_modified': 0, 'unauthorized': 0, 'errors': 0}
+
+
+def enabled():
+    return bool(LEADS_API_TOKEN) and bool(os.environ.get('DATABASE_URL'))
+
+
+def _authorized(request):
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    return hmac.compare_digest(token, LEADS_API_TOKEN)
+
+
+def _json_default(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def json_response(request, payload):
+    """JSON с ETag: совпавший If-None-Match — 304 без тела, крупный ответ сжимается.
+
+    ETag слабый: тот же документ отдаётся и сжатым, и несжатым.
+    """
+    body = json.dumps(payload, ensure_ascii=False, default=_json_default).encode('utf-8')
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    if any(tag.value == etag for tag in request.if_none_match or ()):
+        stats['not_modified'] += 1
+        response = web.Response(status=304)
+    else:
+        response = web.Response(body=body, content_type='application/json', charset='utf-8')
+        if len(body) >= LEADS_API_GZIP_MIN:
+            # Кодировка выбирается по Accept-Encoding клиента; без него ответ не сжимается
+            response.enable_compression()
+    response.etag = ETag(value=etag, is_weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Vary'] = 'Accept-Encoding, Authorization'
+    return response
+
+
+def api_handler(handler):
+    """Проверка токена и готовности БД, учёт запросов и ошибок"""
+    async def wrapper(request):
+        stats['requests'] += 1
+        if not _authorized(request):
+            stats['unauthorized'] += 1
+            return web.json_response(
+                {'error': 'unauthorized'}, status=401, headers={'WWW-Authenticate': 'Bearer'}
+            )
+        await startup.ready()
+        try:
+            return await handler(request)
+        except web.HTTPException:
+            raise
+        except Exception as e:
+            stats['errors'] += 1
+            logger.error(f"❌ Ошибка API заявок: {e}")
+            return web.json_response({'error': 'unavailable'}, status=503)
+    return wrapper
+
+
+@api_handler
+async def handle_changes(request):
+    """GET /api/leads?since=<курсор>&limit=N — лента изменений по (updated_at, id).
+
+    Курсор next из ответа передаётся в следующий запрос; пустая лента
+    возвращает тот же курсор, поэтому опрос без изменений получает 304.
+    """
+    since = request.query.get('since') or None
+    try:
+        position = leads.decode_cursor(since) if since else None
+        limit = int(request.query.get('limit', LEADS_API_PAGE_SIZE))
+    except ValueError:
+        return web.json_response({'error': 'bad cursor or limit'}, status=400)
+    limit = min(max(limit, 1), LEADS_API_MAX_PAGE_SIZE)
+    rows, has_more = await db.call(leads.fetch_lead_changes, position, limit, LEADS_API_SETTLE)
+    return json_response(request, {
+        'leads': rows,
+        'next': leads.encode_cursor(rows[-1], 'updated_at') if rows else since,
+        'has_more': has_more,
+    })
+
+
+@api_handler
+async def handle_lead(request):
+    """GET /api/leads/<id> — одна заявка"""
+    try:
+        lead_id = int(request.match_info['lead_id'])
+    except ValueError:
+        return web.json_response({'error': 'not found'}, status=404)
+    row = await db.call(leads.fetch_lead, lead_id)
+    if row is None:
+        return web.json_response({'error': 'not found'}, status=404)
+    return json_response(request, row)
+
+
+def add_routes(router):
+    """Маршруты API на HTTP-сервере процесса с доступом к БД"""
+    router.add_get('/api/leads', handle_changes)
+    router.add_get('/api/leads/{lead_id}', handle_lead)
+
+
+def api_stats():
+    return dict(stats) if enabled() else None
@@ -1,30 +1,63 @@
 import os
+import math
+import time
+import tempfile
+import asyncio
 import logging
-import smtplib
-import psycopg2
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+
+# Первым из модулей бота: от этой точки отсчитывается этап импортов
+import startup
+from telegram import Update
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
-    MessageHandler, filters, ContextTypes, ConversationHandler
+    MessageHandler, TypeHandler, filters, ContextTypes, ConversationHandler
 )
 
+import db
+import outbox
+import server
+import persistence
+import activity
+import leads
+import intents
+import metrics
+import ratelimit
+import broadcast
+import notifier
+import journal
+import cluster
+import breaker
+import profiler
+import funnel
+import api
+import render
+import ui
+
 # ===== НАСТРОЙКИ =====
 TOKEN = os.environ.get('BOT_TOKEN')
 ADMIN_CHAT_ID = os.environ.get('ADMIN_CHAT_ID', '1294415669')
-DATABASE_URL = os.environ.get('DATABASE_URL')
+DATABASE_URL = db.DATABASE_URL
+# Свой сервер Bot API (telegram-bot-api или заглушка нагрузочного теста); по умолчанию api.telegram.org
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+# Размер пула HTTP-соединений к Bot API
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', 256))
+# Общий бюджет на заявку: запись в журнал, сохранение в БД и постановку уведомлений.
+# Что не уложилось — догружается из журнала в фоне, пользователь этого не ждёт
+CONFIRM_DEADLINE = float(os.environ.get('CONFIRM_DEADLINE', 10))
+# Сколько секунд /stats отдаёт закешированные счётчики
+STATS_CACHE_TTL = float(os.environ.get('STATS_CACHE_TTL', 60))
+# Сколько дней / недель показывает /funnel (и максимум для /funnel day N)
+FUNNEL_REPORT_DAYS = int(os.environ.get('FUNNEL_REPORT_DAYS', 14))
+FUNNEL_REPORT_WEEKS = int(os.environ.get('FUNNEL_REPORT_WEEKS', 8))
 
 # ===== EMAIL НАСТРОЙКИ =====
-SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
-SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
-EMAIL_USER = os.environ.get('EMAIL_USER', 'strategy.elp@gmail.com')
-EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD', '')
-EMAIL_TO = os.environ.get('EMAIL_TO', 'strategy.elp@gmail.com')
+EMAIL_PASSWORD = outbox.EMAIL_PASSWORD
 
 # Состояния для ConversationHandler
 AREA, TERM, CONTACT, CONFIRM = range(4)
+# Шаг, на котором воронку бросили: чего бот ждал от пользователя
+FUNNEL_STEPS = {AREA: 'area', TERM: 'term', CONTACT: 'name', CONFIRM: 'contact'}
 
 # Настройка логирования
 logging.basicConfig(
@@ -41,385 +74,272 @@ def init_db():
         return
     
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS leads (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                username VARCHAR(100),
-                name VARCHAR(100),
-                contact VARCHAR(100),
-                contact_type VARCHAR(20),
-                area VARCHAR(50),
-                term VARCHAR(50),
-                status VARCHAR(20) DEFAULT 'new',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                notes TEXT
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_activity (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                action VARCHAR(50),
-                details TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db.pool.connection() as conn:
+            cursor = conn.cursor()
+            db.schema_lock(cursor)
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS leads (
+                    id SERIAL PRIMARY KEY,
+                    user_id BIGINT,
+                    username VARCHAR(100),
+                    name VARCHAR(100),
+                    contact VARCHAR(100),
+                    contact_type VARCHAR(20),
+                    area VARCHAR(50),
+                    term VARCHAR(50),
+                    status VARCHAR(20) DEFAULT 'new',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    notes TEXT
+                )
+            ''')
+            
+            activity.init_activity_tables(cursor)
+            
+            # Ключ постраничного просмотра /leads
+            cursor.execute('CREATE INDEX IF NOT EXISTS leads_created_id_idx ON leads (created_at, id)')
+            
+            leads.init_dedup_columns(cursor)
+            leads.init_submissions_table(cursor)
+            leads.init_change_feed(cursor)
+            init_stats_rollup(cursor)
+            broadcast.init_broadcast_tables(cursor)
+            
+            cursor.close()
         logger.info("✅ База данных PostgreSQL инициализирована")
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации БД: {e}")
 
 def save_lead_to_db(lead_data):
-    """Сохранение заявки в PostgreSQL"""
+    """Сохранение заявки в PostgreSQL; повтор с тем же контактом объединяется с прежней.
+
+    Возвращает (id, новая_ли_заявка); без БД — (None, True).
+    """
     if not DATABASE_URL:
         logger.warning("⚠️ БД не настроена, заявка сохраняется только в памяти")
-        return None
+        return None, True
     
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO leads (user_id, username, name, contact, contact_type, area, term, status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        ''', (
-            lead_data['user_id'],
-            lead_data.get('username', ''),
-            lead_data['name'],
-            lead_data['contact'],
-            lead_data['contact_type'],
-            lead_data['area'],
-            lead_data['term'],
-            'new'
-        ))
-        
-        lead_id = cursor.fetchone()[0]
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        logger.info(f"✅ Заявка #{lead_id} сохранена в PostgreSQL")
-        return lead_id
+        lead_id, created = leads.upsert_lead(lead_data)
+        if created:
+            invalidate_stats_cache()
+            logger.info(f"✅ Заявка #{lead_id} сохранена в PostgreSQL")
+        else:
+            logger.info(f"🔁 Повторная заявка объединена с #{lead_id}")
+        return lead_id, created
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения в БД: {e}")
-        return None
+        return None, True
+
+def init_stats_rollup(cursor):
+    """Счётчики заявок по дням и статусам, которые ведёт триггер на leads"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lead_stats_daily (
+            day DATE PRIMARY KEY,
+            leads INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lead_stats_status (
+            status VARCHAR(20) PRIMARY KEY,
+            leads INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION leads_stats_rollup() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE lead_stats_status SET leads = leads - 1
+                WHERE status = COALESCE(OLD.status, 'unknown');
+            END IF;
+            IF TG_OP = 'DELETE' THEN
+                UPDATE lead_stats_daily SET leads = leads - 1 WHERE day = OLD.created_at::date;
+            END IF;
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO lead_stats_daily (day, leads) VALUES (NEW.created_at::date, 1)
+                ON CONFLICT (day) DO UPDATE SET leads = lead_stats_daily.leads + 1;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO lead_stats_status (status, leads) VALUES (COALESCE(NEW.status, 'unknown'), 1)
+                ON CONFLICT (status) DO UPDATE SET leads = lead_stats_status.leads + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    
+    # Первичное заполнение из существующих заявок; блокировка leads не даёт
+    # вставкам проскочить между подсчётом и созданием триггера
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM lead_stats_status)')
+    if not cursor.fetchone()[0]:
+        cursor.execute('LOCK TABLE leads IN SHARE ROW EXCLUSIVE MODE')
+        cursor.execute('DELETE FROM lead_stats_daily')
+        cursor.execute('''
+            INSERT INTO lead_stats_daily (day, leads)
+            SELECT created_at::date, COUNT(*) FROM leads GROUP BY 1
+        ''')
+        cursor.execute('''
+            INSERT INTO lead_stats_status (status, leads)
+            SELECT COALESCE(status, 'unknown'), COUNT(*) FROM leads GROUP BY 1
+        ''')
+    
+    cursor.execute('DROP TRIGGER IF EXISTS leads_stats_rollup ON leads')
+    cursor.execute('''
+        CREATE TRIGGER leads_stats_rollup
+        AFTER INSERT OR DELETE OR UPDATE OF status ON leads
+        FOR EACH ROW EXECUTE FUNCTION leads_stats_rollup()
+    ''')
+
+def _select_stats(conn):
+    cursor = conn.cursor()
+    # Только точечные чтения по первичным ключам сводных таблиц — не зависит от числа заявок
+    cursor.execute('''
+        SELECT 
+            (SELECT COALESCE(SUM(leads), 0) FROM lead_stats_status) as total_leads,
+            (SELECT COALESCE(SUM(leads), 0) FROM lead_stats_daily WHERE day = CURRENT_DATE) as today_leads,
+            (SELECT COALESCE(SUM(leads), 0) FROM lead_stats_status WHERE status = 'new') as new_leads,
+            (SELECT COALESCE(SUM(leads), 0) FROM lead_stats_status WHERE status = 'contacted') as contacted_leads
+    ''')
+    stats = cursor.fetchone()
+    cursor.close()
+    return stats
+
+_stats_cache = {'value': None, 'expires': 0.0}
+
+def invalidate_stats_cache():
+    _stats_cache['expires'] = 0.0
 
 def get_db_stats():
     """Получение статистики из PostgreSQL"""
     if not DATABASE_URL:
         return {'total': 0, 'today': 0, 'new': 0, 'contacted': 0}
     
+    if _stats_cache['value'] is not None and time.monotonic() < _stats_cache['expires']:
+        return _stats_cache['value']
+    
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT 
-                COUNT(*) as total_leads,
-                COUNT(CASE WHEN created_at::date = CURRENT_DATE THEN 1 END) as today_leads,
-                COUNT(CASE WHEN status = 'new' THEN 1 END) as new_leads,
-                COUNT(CASE WHEN status = 'contacted' THEN 1 END) as contacted_leads
-            FROM leads
-        ''')
-        
-        stats = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
-        return {
+        stats = db.pool.run(_select_stats)
+        value = {
             'total': stats[0] or 0,
             'today': stats[1] or 0,
             'new': stats[2] or 0,
             'contacted': stats[3] or 0
         }
+        _stats_cache['value'] = value
+        _stats_cache['expires'] = time.monotonic() + STATS_CACHE_TTL
+        return value
     except Exception as e:
         logger.error(f"❌ Ошибка получения статистики: {e}")
         return {'total': 0, 'today': 0, 'new': 0, 'contacted': 0}
 
-# ===== EMAIL ФУНКЦИИ =====
-def send_email_notification_sync(lead_data, lead_id_display):
-    """Отправка email-уведомления о новой заявке (синхронная версия)"""
-    if not EMAIL_PASSWORD:
-        logger.warning("⚠️ Пароль email не настроен, уведомления не отправляются")
-        return False
-    
-    try:
-        # Тема письма
-        subject = f"🚀 Новая заявка ELP {lead_id_display} - {lead_data['name']}"
-        
-        # HTML тело письма
-        body = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-                .header {{ background: #1a3d7a; color: white; padding: 20px; text-align: center; border-radius: 5px 5px 0 0; }}
-                .content {{ background: #f9f9f9; padding: 20px; border: 1px solid #ddd; }}
-                .lead-info {{ background: white; padding: 15px; margin: 10px 0; border-left: 4px solid #1a3d7a; }}
-                .label {{ font-weight: bold; color: #1a3d7a; }}
-                .footer {{ text-align: center; margin-top: 20px; color: #666; font-size: 12px; }}
-                .button {{ display: inline-block; background: #1a3d7a; color: white; padding: 10px 20px; text-decoration: none; border-radius: 4px; margin-top: 10px; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h2>🚀 Новая заявка с бота ELP</h2>
-                </div>
-                
-                <div class="content">
-                    <div class="lead-info">
-                        <p><span class="label">📋 ID заявки:</span> {lead_id_display}</p>
-                        <p><span class="label">👤 Клиент:</span> {lead_data['name']}</p>
-                        <p><span class="label">📧 Контакт:</span> {lead_data['contact']} ({lead_data['contact_type']})</p>
-                        <p><span class="label">📐 Интересуемая площадь:</span> {lead_data['area']}</p>
-                        <p><span class="label">📅 Срок аренды:</span> {lead_data['term']}</p>
-                        <p><span class="label">⏰ Дата и время:</span> {datetime.now().strftime('%d.%m.%Y %H:%M')}</p>
-                        <p><span class="label">🔗 User ID:</span> {lead_data['user_id']}</p>
-                        <p><span class="label">👤 Username:</span> @{lead_data.get('username', 'не указан')}</p>
-                    </div>
-                    
-                    <p><strong>📞 Быстрый ответ:</strong></p>
-                    <p>• Email: <a href="mailto:{lead_data['contact']}">{lead_data['contact']}</a></p>
-                    
-                    <p style="margin-top: 20px;">
-                        <a href="https://t.me/elp_almaty_bot" class="button">💬 Открыть бота</a>
-                    </p>
-                </div>
-                
-                <div class="footer">
-                    <p>📍 Евразийский Логистический Парк | Алматы</p>
-                    <p>📧 strategy.elp@gmail.com | 🌐 elpk.kz</p>
-                    <p><em>Заявка сгенерирована автоматически Telegram-ботом ELP</em></p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-        
-        # Создаем письмо
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = subject
-        msg['From'] = f"ELP Telegram Bot <{EMAIL_USER}>"
-        msg['To'] = EMAIL_TO
-        
-        # Добавляем HTML версию
-        html_part = MIMEText(body, 'html')
-        msg.attach(html_part)
-        
-        # Отправляем
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(EMAIL_USER, EMAIL_PASSWORD)
-            server.send_message(msg)
-        
-        logger.info(f"✅ Email отправлен на {EMAIL_TO}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка отправки email: {e}")
-        return False
-
-# ===== БАЗА ЗНАНИЙ ELP =====
-KNOWLEDGE_BASE = {
-    'area': "🏭 *Площади складов ELP:*\n\n• Корпус А: 32 800 м²\n• Корпус В: 17 500 м²\n• Минимальная аренда: от 3 500 м²\n\nВсе склады класса А с полным комплектом инженерных систем.",
-    'price': "💰 *Стоимость аренды:*\n\n• От 5 500 ₸ за кв.м/мес\n• Включает OPEX (эксплуатационные расходы)\n• Индивидуальный расчёт для площадей от 3 500 м²\n\nНужен точный расчёт для вашего бизнеса?",
-    'location': "📍 *Расположение:*\n\n• Алматинская область, Талгарский район\n• Кульджинский тракт, 200\n• 30 км до центра Алматы\n• 22 км до международного аэропорта\n• 5 км до развязки БАКАД\n\nКоординаты: 43.394771, 77.173137",
-    'specs': "⚙️ *Технические характеристики:*\n\n• Класс А по международной классификации\n• Высота до подкранового пути: 12 м\n• Допустимая нагрузка на пол: 8 т/м²\n• Шаг колонн: 12×24 м\n• Доки: 1 на 1200 м²\n• Современные системы пожаротушения\n• Круглосуточная охрана и видеонаблюдение",
-    'contact': "👨‍💼 *Контакты директора по развитию:*\n\n**Директор по развитию ELP**\n• Email: strategy.elp@gmail.com\n• Telegram: @elp_almaty_bot\n\nСпециализируется на стратегическом развитии логистических мощностей в Алматы.",
-    'timeline': "📅 *Сроки реализации:*\n\n• Период проекта: 2025–2028 гг.\n• 1 этап (Корпус В) — введён в эксплуатацию\n• Поэтапный ввод до общей площади 250 000 м²"
-}
-
-# ===== КЛАВИАТУРЫ =====
-def main_menu_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("📐 Площади", callback_data='area'), InlineKeyboardButton("💰 Стоимость", callback_data='price')],
-        [InlineKeyboardButton("📍 Расположение", callback_data='location'), InlineKeyboardButton("⚙️ Характеристики", callback_data='specs')],
-        [InlineKeyboardButton("👨‍💼 Контакты", callback_data='contact'), InlineKeyboardButton("📅 Сроки", callback_data='timeline')],
-        [InlineKeyboardButton("📝 Оставить заявку", callback_data='start_request')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-def action_keyboard(action_type='default'):
-    if action_type == 'price':
-        keyboard = [
-            [InlineKeyboardButton("📝 Оставить заявку", callback_data='start_request'), InlineKeyboardButton("👨‍💼 Написать директору", callback_data='contact')],
-            [InlineKeyboardButton("🗓️ Записаться на просмотр", callback_data='schedule_tour')]
-        ]
-    elif action_type == 'contact':
-        keyboard = [
-            [InlineKeyboardButton("✉️ Написать email", callback_data='write_email'), InlineKeyboardButton("📝 Оставить заявку", callback_data='start_request')],
-            [InlineKeyboardButton("🏭 Посмотреть площади", callback_data='area')]
-        ]
-    else:
-        keyboard = [
-            [InlineKeyboardButton("📝 Оставить заявку", callback_data='start_request'), InlineKeyboardButton("💰 Узнать стоимость", callback_data='price')],
-            [InlineKeyboardButton("👨‍💼 Связаться с директором", callback_data='contact')]
-        ]
-    return InlineKeyboardMarkup(keyboard)
-
-def area_selection_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("до 500 м²", callback_data='area_500')],
-        [InlineKeyboardButton("500 - 1 000 м²", callback_data='area_1000')],
-        [InlineKeyboardButton("1 000 - 3 500 м²", callback_data='area_3500')],
-        [InlineKeyboardButton("более 3 500 м²", callback_data='area_5000')],
-        [InlineKeyboardButton("↩️ Назад", callback_data='cancel')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-def term_selection_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("6 месяцев", callback_data='term_6')],
-        [InlineKeyboardButton("1 год", callback_data='term_12')],
-        [InlineKeyboardButton("2 года", callback_data='term_24')],
-        [InlineKeyboardButton("3+ года", callback_data='term_36')],
-        [InlineKeyboardButton("↩️ Назад", callback_data='back_to_area')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
 # ===== ОСНОВНЫЕ ОБРАБОТЧИКИ =====
+def track(update: Update, action, details=None):
+    """Событие в журнал активности (буфер в памяти, без ожидания БД)"""
+    if update.effective_user:
+        activity.record(update.effective_user.id, action, details)
+
+@metrics.instrument_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    welcome_text = "🏭 *Добро пожаловать в официальный бот Евразийского Логистического Парка!*\n\nЗдесь вы можете получить всю информацию о складах класса А в Алматы.\n\nВыберите интересующий раздел:"
-    
+    track(update, 'start' if update.message else 'main_menu')
     if update.message:
-        await update.message.reply_text(welcome_text, parse_mode='Markdown', reply_markup=main_menu_keyboard())
+        await render.reply(update.message, ui.WELCOME_TEXT, parse_mode='Markdown', reply_markup=ui.MAIN_MENU_KEYBOARD)
     else:
-        await update.callback_query.edit_message_text(welcome_text, parse_mode='Markdown', reply_markup=main_menu_keyboard())
+        await render.edit(update.callback_query, ui.WELCOME_TEXT, parse_mode='Markdown', reply_markup=ui.MAIN_MENU_KEYBOARD)
     return ConversationHandler.END
 
+@metrics.instrument_handler
 async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     data = query.data
+    track(update, 'menu', data)
     
-    if data in KNOWLEDGE_BASE:
-        action_type = 'price' if data == 'price' else 'contact' if data == 'contact' else 'default'
-        await query.edit_message_text(text=KNOWLEDGE_BASE[data], parse_mode='Markdown', reply_markup=action_keyboard(action_type))
+    # Ответ на нажатие уходит вместе с перерисовкой (render.edit)
+    if data in ui.KNOWLEDGE_SCREENS:
+        text, keyboard = ui.KNOWLEDGE_SCREENS[data]
+        await render.edit(query, text, parse_mode='Markdown', reply_markup=keyboard)
     elif data == 'start_request':
-        await query.edit_message_text(
-            text="📋 *Оформление заявки*\n\nДавайте подберём оптимальное решение для вашего бизнеса.\n\n🔄 *Шаг 1 из 4*\nКакая площадь склада вас интересует?",
-            parse_mode='Markdown', reply_markup=area_selection_keyboard()
-        )
+        await render.edit(query, ui.REQUEST_START_TEXT, parse_mode='Markdown', reply_markup=ui.AREA_KEYBOARD)
         return AREA
     elif data == 'write_email':
-        await query.edit_message_text(
-            text="✉️ *Написать директору по развитию:*\n\nEmail: strategy.elp@gmail.com\n\nУкажите в теме письма:\n«Запрос по складам ELP»\n\nМы ответим в течение 24 часов.",
-            parse_mode='Markdown', reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("📝 Оставить заявку через бота", callback_data='start_request'),
-                InlineKeyboardButton("🏠 В главное меню", callback_data='main_menu')
-            ]])
-        )
+        await render.edit(query, ui.WRITE_EMAIL_TEXT, parse_mode='Markdown', reply_markup=ui.WRITE_EMAIL_KEYBOARD)
     elif data == 'schedule_tour':
-        await query.edit_message_text(
-            text="🗓️ *Запись на просмотр*\n\nДля записи на индивидуальный просмотр:\n1. Оставьте заявку через бота\n2. Директор по развитию свяжется с вами\n3. Согласуем удобное время\n\nПросмотры проводятся по будням с 10:00 до 17:00.",
-            parse_mode='Markdown', reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("📝 Оставить заявку", callback_data='start_request'),
-                InlineKeyboardButton("🏠 В меню", callback_data='main_menu')
-            ]])
-        )
+        await render.edit(query, ui.SCHEDULE_TOUR_TEXT, parse_mode='Markdown', reply_markup=ui.SCHEDULE_TOUR_KEYBOARD)
     elif data == 'main_menu':
         await start(update, context)
+    else:
+        await render.answer(query)
 
 # ===== ПРОЦЕСС ЗАЯВКИ =====
+@metrics.instrument_handler
 async def select_area(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     
     if query.data == 'cancel':
         await start(update, context)
         return ConversationHandler.END
     
-    area_map = {
-        'area_500': 'до 500 м²', 'area_1000': '500 - 1 000 м²',
-        'area_3500': '1 000 - 3 500 м²', 'area_5000': 'более 3 500 м²'
-    }
-    
+    track(update, 'funnel_area', query.data)
     context.user_data['lead'] = {
-        'area': area_map.get(query.data, query.data),
+        'area': ui.AREA_LABELS.get(query.data, query.data),
         'user_id': query.from_user.id,
         'username': query.from_user.username or query.from_user.first_name,
         'created': datetime.now().isoformat()
     }
     
-    await query.edit_message_text(
-        text=f"📋 *Оформление заявки*\n\n✅ Площадь: {context.user_data['lead']['area']}\n\n🔄 *Шаг 2 из 4*\nНа какой срок планируете аренду?",
-        parse_mode='Markdown', reply_markup=term_selection_keyboard()
+    await render.edit(
+        query, ui.render_step_term(context.user_data['lead']),
+        parse_mode='Markdown', reply_markup=ui.TERM_KEYBOARD
     )
     return TERM
 
+@metrics.instrument_handler
 async def select_term(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     
     if query.data == 'back_to_area':
-        await query.edit_message_text(
-            text="📋 *Оформление заявки*\n\n🔄 *Шаг 1 из 4*\nКакая площадь склада вас интересует?",
-            parse_mode='Markdown', reply_markup=area_selection_keyboard()
-        )
+        await render.edit(query, ui.REQUEST_AREA_TEXT, parse_mode='Markdown', reply_markup=ui.AREA_KEYBOARD)
         return AREA
     
-    term_map = {
-        'term_6': '6 месяцев', 'term_12': '1 год',
-        'term_24': '2 года', 'term_36': '3+ года'
-    }
-    
-    context.user_data['lead']['term'] = term_map.get(query.data, query.data)
+    track(update, 'funnel_term', query.data)
+    context.user_data['lead']['term'] = ui.TERM_LABELS.get(query.data, query.data)
     
-    await query.edit_message_text(
-        text=f"📋 *Оформление заявки*\n\n✅ Площадь: {context.user_data['lead']['area']}\n✅ Срок аренды: {context.user_data['lead']['term']}\n\n🔄 *Шаг 3 из 4*\nКак к вам обращаться? Отправьте ваше имя.",
-        parse_mode='Markdown'
-    )
+    await render.edit(query, ui.render_step_name(context.user_data['lead']), parse_mode='Markdown')
     return CONTACT
 
+@metrics.instrument_handler
 async def get_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message:
+        track(update, 'funnel_name')
         context.user_data['lead']['name'] = update.message.text
         
-        keyboard = [[
-            InlineKeyboardButton("📱 Отправить телефон", callback_data='send_phone'),
-            InlineKeyboardButton("📧 Указать email", callback_data='send_email')
-        ], [
-            InlineKeyboardButton("↩️ Назад", callback_data='back_to_term')
-        ]]
-        
-        await update.message.reply_text(
-            text=f"📋 *Оформление заявки*\n\n✅ Площадь: {context.user_data['lead']['area']}\n✅ Срок: {context.user_data['lead']['term']}\n✅ Имя: {context.user_data['lead']['name']}\n\n🔄 *Шаг 4 из 4*\nКак с вами связаться?",
-            parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard)
+        await render.reply(
+            update.message, ui.render_step_contact(context.user_data['lead']),
+            parse_mode='Markdown', reply_markup=ui.CONTACT_METHOD_KEYBOARD
         )
         return CONFIRM
 
+@metrics.instrument_handler
 async def confirm_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = None
-    if hasattr(update, 'callback_query'):
-        query = update.callback_query
-        if query:
-            await query.answer()
+    query = update.callback_query
     
     if query and query.data == 'back_to_term':
-        await query.edit_message_text(
-            text=f"📋 *Оформление заявки*\n\n✅ Площадь: {context.user_data['lead']['area']}\n✅ Срок аренды: {context.user_data['lead']['term']}\n\n🔄 *Шаг 3 из 4*\nКак к вам обращаться? Отправьте ваше имя.",
-            parse_mode='Markdown'
-        )
+        await render.edit(query, ui.render_step_name(context.user_data['lead']), parse_mode='Markdown')
         return CONTACT
     
     if query and query.data in ['send_phone', 'send_email']:
+        track(update, 'funnel_contact_method', query.data)
         context.user_data['contact_type'] = 'телефон' if query.data == 'send_phone' else 'email'
-        await query.edit_message_text(text=f"Отправьте ваш {context.user_data['contact_type']}:", parse_mode='Markdown')
+        await render.edit(
+            query, ui.CONTACT_PROMPT_TEMPLATE.format(contact_type=context.user_data['contact_type']),
+            parse_mode='Markdown'
+        )
         return CONFIRM
     
+    if query:
+        await render.answer(query)
+    
     if update.message:
+        deadline = breaker.Deadline(CONFIRM_DEADLINE)
         if update.message.contact:
             contact = update.message.contact.phone_number
             contact_type = 'телефон'
@@ -427,50 +347,69 @@ async def confirm_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
             contact = update.message.text
             contact_type = context.user_data.get('contact_type', 'контакт')
         
+        track(update, 'funnel_confirm', contact_type)
         lead = context.user_data['lead']
         lead['contact'] = contact
         lead['contact_type'] = contact_type
         
-        lead_id = save_lead_to_db(lead)
-        lead_id_display = f"#{lead_id}" if lead_id else f"lead_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        
-        # Отправляем email
-        email_sent = send_email_notification_sync(lead, lead_id_display)
-        
-        admin_message = (
-            f"🚀 *НОВАЯ ЗАЯВКА С БОТА ELP!*\n\n"
-            f"📋 ID: `{lead_id_display}`\n"
-            f"📧 Email: {'✅ Отправлен' if email_sent else '⚠️ Не отправлен'}\n"
-            f"👤 Имя: {lead['name']}\n"
-            f"👤 Username: @{lead['username']}\n"
-            f"📞 Контакт ({lead['contact_type']}): {lead['contact']}\n"
-            f"📐 Площадь: {lead['area']}\n"
-            f"📅 Срок: {lead['term']}\n"
-            f"⏰ Время: {datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n"
-            f"User ID: `{lead['user_id']}`"
-        )
-        
+        # Заявка на диске (fsync) до подтверждения: переживёт и сбой БД, и рестарт
         try:
-            await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=admin_message, parse_mode='Markdown')
-            logger.info(f"Заявка отправлена админу: {lead_id_display}")
+            await deadline.run(journal.append(lead))
+        except asyncio.TimeoutError:
+            logger.error(f"❌ Журнал заявок не ответил за {CONFIRM_DEADLINE:.0f} с, заявка сохраняется напрямую")
         except Exception as e:
-            logger.error(f"Ошибка отправки админу: {e}")
+            logger.error(f"❌ Заявка не записана в журнал, сохраняем напрямую: {e}")
         
-        keyboard = InlineKeyboardMarkup([[
-            InlineKeyboardButton("👨‍💼 Написать директору", callback_data='contact'),
-            InlineKeyboardButton("🏠 В главное меню", callback_data='main_menu')
-        ]])
-        
-        await update.message.reply_text(
-            text="✅ *Заявка успешно отправлена!*\n\nС вами свяжется **директор по развитию ELP** в ближайшее время.\n\n✉️ Контакты для связи:\n• Email: strategy.elp@gmail.com\n• Telegram: @elp_almaty_bot\n\nРабочие часы: Пн-Пт, 9:00-18:00",
-            parse_mode='Markdown', reply_markup=keyboard
-        )
+        # Подтверждение не ждёт БД: сохранение и уведомления идут в фоне
+        await render.reply(update.message, ui.LEAD_DONE_TEXT, parse_mode='Markdown', reply_markup=ui.LEAD_DONE_KEYBOARD)
+        context.application.create_task(persist_lead(lead, deadline), update=update)
         
         context.user_data.clear()
         return ConversationHandler.END
 
+async def persist_lead(lead, deadline):
+    """Сохранение подтверждённой заявки в БД и уведомление админа в пределах бюджета"""
+    lead_id, created = None, True
+    try:
+        # При ленивом запуске схема БД и очередь писем могут ещё готовиться;
+        # не дождались подготовки — это не сбой БД
+        await deadline.run(startup.ready())
+    except asyncio.TimeoutError:
+        logger.warning(f"⏱️ Запуск не завершился за {CONFIRM_DEADLINE:.0f} с, заявку догрузим из журнала")
+    else:
+        try:
+            lead_id, created = await deadline.run(db.call(save_lead_to_db, lead))
+        except asyncio.TimeoutError:
+            # Зависший запрос может ещё завершиться — повтор из журнала идемпотентен по uuid
+            logger.warning(f"⏱️ Заявка не сохранена за {CONFIRM_DEADLINE:.0f} с, догрузим из журнала")
+            if db.pool is not None:
+                db.pool.breaker.failure()
+        except breaker.CircuitOpenError as e:
+            logger.warning(f"🧯 Заявка не сохранена ({e}), догрузим из журнала")
+    # Несохранённую заявку позже догрузит из журнала replayer
+    journal.settle(lead, lead_id)
+    
+    # Повтор уже известной заявки: данные обновлены, админ о ней уже знает
+    if not created:
+        return
+    
+    lead_id_display = f"#{lead_id}" if lead_id else f"lead_{lead['uuid'][:8]}"
+    # Письмо и сообщение админу уходят в фоне; при всплеске заявок — сводкой
+    notifier.notify_lead(lead, lead_id_display)
+    # Заявке, оставшейся в журнале, повторное уведомление при догрузке не нужно
+    journal.mark_notified(lead)
+
+def on_replayed(results, unannounced):
+    """Заявки догружены из журнала: админ узнаёт о тех, о ком не успел до сбоя"""
+    if results:
+        invalidate_stats_cache()
+    for lead, lead_id in unannounced:
+        notifier.notify_lead(lead, f"#{lead_id}" if lead_id else f"lead_{lead['uuid'][:8]}")
+        journal.mark_notified(lead)
+
+@metrics.instrument_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Заявка отменена.", reply_markup=main_menu_keyboard())
+    await render.reply(update.message, ui.CANCEL_TEXT, reply_markup=ui.MAIN_MENU_KEYBOARD)
     context.user_data.clear()
     return ConversationHandler.END
 
@@ -480,7 +419,8 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ Доступ запрещён")
         return
     
-    stats = get_db_stats()
+    await startup.ready()
+    stats = await db.call(get_db_stats)
     stats_text = (
         f"📊 *Статистика бота ELP*\n\n"
         f"• Всего заявок: {stats['total']}\n"
@@ -490,29 +430,372 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📧 Email: {'✅ Настроен' if EMAIL_PASSWORD else '⚠️ Не настроен'}\n"
         f"🗄️ База данных: {'✅ Активна' if DATABASE_URL else '⚠️ В памяти'}"
     )
+    notify = notifier.notifier_stats()
+    if notify and notify['leads']:
+        stats_text += (
+            f"\n🔔 Уведомления: заявок {notify['leads']}, сразу {notify['instant']}, "
+            f"в сводках {notify['coalesced']} ({notify['digests']} сводок)"
+        )
+    tripped = breaker.open_breakers()
+    if tripped:
+        stats_text += f"\n🧯 Предохранители разомкнуты: {', '.join(tripped)}"
+    sweeper = context.bot_data.get('sweeper')
+    if sweeper is not None:
+        funnel = sweeper.snapshot()
+        stats_text += (
+            f"\n🧹 Диалоги: в памяти {funnel['tracked']}, воронок {funnel['conversations']}, "
+            f"брошено {sum(sweeper.abandoned.values())}"
+        )
+    wal = journal.journal_stats()
+    if wal and wal['pending']:
+        stats_text += f"\n📒 Журнал заявок: ждут загрузки в БД {wal['pending']}"
+    drawn = render.render_stats()
+    if drawn['saved']:
+        stats_text += f"\n🎨 Перерисовка: правок {drawn['edits']}, пропущено без изменений {drawn['saved']}"
+    mail = outbox.outbox_stats()
+    if mail:
+        stats_text += f"\n📬 Письма: отправлено {mail['sent']}, повторов {mail['retried']}, ошибок {mail['failed']}"
+    events = activity.activity_stats()
+    if events:
+        stats_text += (
+            f"\n🧭 Активность: записано {events['flushed']}, в буфере {events['backlog']}, "
+            f"отброшено {events['dropped'] + events['sampled_out']}"
+        )
+    limiter = context.bot.rate_limiter
+    if limiter is not None:
+        sending = limiter.snapshot()
+        stats_text += (
+            f"\n🚦 Исходящие: в очереди {sending['queued_reply'] + sending['queued_notify'] + sending['queued_bulk']}, "
+            f"задержано {sending['throttled']}, ответов 429: {sending['retry_after']}"
+        )
+    pool = db.pool_stats()
+    if pool:
+        stats_text += (
+            f"\n🔌 Пул БД: {pool['size'] - pool['idle']}/{pool['size']} занято (макс. {pool['max']}), "
+            f"ожидают: {pool['waiting']}, переподключений: {pool['reconnects']}"
+        )
     await update.message.reply_text(stats_text, parse_mode='Markdown')
 
+def load_leads_page(cursor=None, direction='older'):
+    """Страница заявок с курсорами для кнопок «новее» / «старше»"""
+    position = leads.decode_cursor(cursor) if cursor else None
+    rows, has_more = leads.fetch_leads_page(position, direction)
+    if not rows:
+        return ui.render_leads_page(rows)
+    has_newer = has_more if direction == 'newer' else position is not None
+    has_older = has_more if direction == 'older' else True
+    return ui.render_leads_page(
+        rows,
+        prev_cursor=leads.encode_cursor(rows[0]) if has_newer else None,
+        next_cursor=leads.encode_cursor(rows[-1]) if has_older else None
+    )
+
+async def admin_leads(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return
+    if not DATABASE_URL:
+        await update.message.reply_text("⚠️ База данных не настроена")
+        return
+    
+    await startup.ready()
+    text, keyboard = await db.call(load_leads_page)
+    await update.message.reply_text(text, parse_mode='HTML', reply_markup=keyboard)
+
+async def admin_leads_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if str(query.from_user.id) != ADMIN_CHAT_ID:
+        await query.answer("⛔ Доступ запрещён")
+        return
+    await query.answer()
+    
+    _, direction, cursor = query.data.split(':', 2)
+    text, keyboard = await db.call(load_leads_page, cursor, direction)
+    await query.edit_message_text(text, parse_mode='HTML', reply_markup=keyboard)
+
+async def admin_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return
+    if not DATABASE_URL:
+        await update.message.reply_text("⚠️ База данных не настроена")
+        return
+    
+    await startup.ready()
+    compress = bool(context.args) and context.args[0].lower() in ('gz', 'gzip')
+    suffix = '.csv.gz' if compress else '.csv'
+    await update.message.reply_text("⏳ Готовлю выгрузку заявок...")
+    
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        count = await db.call(leads.export_leads_csv, path, compress)
+        if os.path.getsize(path) > leads.TELEGRAM_UPLOAD_LIMIT:
+            await update.message.reply_text("⚠️ Файл больше 50 МБ. Попробуйте сжатую выгрузку: /export gz")
+            return
+        with open(path, 'rb') as f:
+            await update.message.reply_document(
+                document=f,
+                filename=f"elp_leads_{datetime.now().strftime('%Y%m%d_%H%M')}{suffix}",
+                caption=f"📦 Выгружено заявок: {count}"
+            )
+    except Exception as e:
+        logger.error(f"❌ Ошибка экспорта заявок: {e}")
+        await update.message.reply_text("❌ Не удалось выгрузить заявки")
+    finally:
+        os.remove(path)
+
+async def admin_funnel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/funnel [day|week] [N] — конверсия по шагам заявки из часовых сводок"""
+    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return
+    if not DATABASE_URL:
+        await update.message.reply_text("⚠️ База данных не настроена")
+        return
+    
+    args = [a.lower() for a in context.args or []]
+    period = 'week' if args and args[0] in ('week', 'w', 'неделя', 'недели') else 'day'
+    limit = FUNNEL_REPORT_WEEKS if period == 'week' else FUNNEL_REPORT_DAYS
+    count = min(max(int(args[-1]), 1), limit) if args and args[-1].isdigit() else limit
+    
+    await startup.ready()
+    try:
+        report = await db.call(funnel.fetch_report, period, count)
+    except Exception as e:
+        logger.error(f"❌ Ошибка отчёта по воронке: {e}")
+        await update.message.reply_text("❌ Не удалось построить отчёт")
+        return
+    await update.message.reply_text(ui.render_funnel_report(report, funnel.FUNNEL_STEPS))
+
+async def admin_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile [секунд] | /profile <N> upd | /profile stop — профиль CPU и памяти документом"""
+    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return
+    
+    args = [a.lower() for a in context.args or []]
+    if args and args[0] == 'stop':
+        if not profiler.active():
+            await update.message.reply_text("🔬 Профилирование не запущено")
+            return
+        await profiler.stop_profile()
+        return
+    if profiler.active():
+        await update.message.reply_text("⏳ Профилирование уже идёт. Досрочно завершить: /profile stop")
+        return
+    by_updates = len(args) > 1 and args[1].startswith(('upd', 'апд'))
+    try:
+        amount = float(args[0]) if args else profiler.PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        amount = None
+    # nan, inf, ноль и отрицательные сессию не задают; длительность ограничит PROFILE_MAX_SECONDS
+    if amount is None or not math.isfinite(amount) or (int(amount) if by_updates else amount) <= 0:
+        await update.message.reply_text("Использование: /profile [секунд] или /profile <N> upd")
+        return
+    seconds, updates = (None, int(amount)) if by_updates else (amount, None)
+    
+    chat_id = update.effective_chat.id
+    
+    async def send_report(summary, archive):
+        await context.bot.send_document(
+            chat_id=chat_id, document=archive,
+            filename=f"elp_profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
+            caption=summary[:1024]
+        )
+    
+    session = profiler.start_profile(context.application, send_report, seconds, updates)
+    limit = f"{updates} апдейтов (не дольше {session.seconds:.0f} с)" if by_updates else f"{session.seconds:.0f} с"
+    await update.message.reply_text(f"🔬 Профилирование запущено: {limit}. Отчёт придёт файлом")
+
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast <текст> — черновик с подтверждением, /broadcast — прогресс, /broadcast stop — остановка,
+    /broadcast resume — продолжение рассылки, прерванной ошибкой"""
+    if str(update.effective_user.id) != ADMIN_CHAT_ID:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return
+    if not DATABASE_URL:
+        await update.message.reply_text("⚠️ База данных не настроена")
+        return
+    
+    await startup.ready()
+    # Текст берём целиком, а не из context.args, чтобы сохранить переносы строк
+    text = update.message.text.partition(' ')[2].strip()
+    if not text:
+        current = await db.call(broadcast.get_broadcast)
+        await update.message.reply_text(ui.render_broadcast_status(current) if current else "📣 Рассылок ещё не было")
+    elif text.lower() == 'stop':
+        current = await db.call(broadcast.get_broadcast)
+        if current and await db.call(broadcast.set_status, current['id'], 'cancelled', ('running',)):
+            await broadcast.stop_broadcast()
+            current = await db.call(broadcast.get_broadcast, current['id'])
+            await update.message.reply_text(ui.render_broadcast_status(current))
+        else:
+            await update.message.reply_text("📣 Активной рассылки нет")
+    elif text.lower() == 'resume':
+        current = await broadcast.resume_failed(
+            context.bot, on_finish=lambda current: report_broadcast(context.bot, current)
+        )
+        if current is None:
+            await update.message.reply_text("📣 Прерванной ошибкой рассылки нет или уже идёт другая")
+        else:
+            await update.message.reply_text(f"📣 Рассылка #{current['id']} продолжена. Прогресс: /broadcast")
+    else:
+        broadcast_id, total = await db.call(broadcast.create_draft, text, update.effective_user.id)
+        await update.message.reply_text(
+            ui.render_broadcast_preview(text, total),
+            reply_markup=ui.broadcast_confirm_keyboard(broadcast_id, total)
+        )
+
+async def admin_broadcast_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if str(query.from_user.id) != ADMIN_CHAT_ID:
+        await query.answer("⛔ Доступ запрещён")
+        return
+    await query.answer()
+    
+    _, action, broadcast_id = query.data.split(':')
+    broadcast_id = int(broadcast_id)
+    if action == 'cancel':
+        await db.call(broadcast.set_status, broadcast_id, 'cancelled', ('draft',))
+        await query.edit_message_text("📣 Рассылка отменена")
+        return
+    
+    if not await db.call(broadcast.set_status, broadcast_id, 'running', ('draft',)):
+        await query.edit_message_text("📣 Эта рассылка уже запущена или отменена")
+        return
+    if not await broadcast.start_broadcast(context.bot, broadcast_id, on_finish=lambda current: report_broadcast(context.bot, current)):
+        await db.call(broadcast.set_status, broadcast_id, 'draft', ('running',))
+        await query.edit_message_text("⚠️ Уже идёт другая рассылка. Остановите её: /broadcast stop")
+        return
+    await query.edit_message_text("📣 Рассылка запущена. Прогресс: /broadcast")
+
+async def report_broadcast(bot, current):
+    """Итог рассылки админу — по счётчикам BroadcastRunner, без запроса к БД"""
+    await bot.send_message(chat_id=ADMIN_CHAT_ID, text=ui.render_broadcast_status(current), rate_limit_args={'lane': 'notify'})
+
 # ===== ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ =====
+@metrics.instrument_handler
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.lower()
+    track(update, 'text', update.message.text[:200])
+    intent = intents.detect_intent(update.message.text)
+    if intent is not None:
+        # Разделы и начало заявки из текста учитываются в /funnel наравне с кнопками
+        track(update, 'intent', intent)
     
-    if any(word in text for word in ['привет', 'здравств', 'hello', 'hi']):
-        await update.message.reply_text("Привет! Чем могу помочь?", reply_markup=main_menu_keyboard())
-    elif any(word in text for word in ['спасибо', 'благодар']):
-        await update.message.reply_text("Рад был помочь! 🤝")
+    if intent in ui.KNOWLEDGE_SCREENS:
+        text, keyboard = ui.KNOWLEDGE_SCREENS[intent]
+        await render.reply(update.message, text, parse_mode='Markdown', reply_markup=keyboard)
+    elif intent == 'request':
+        await render.reply(update.message, ui.REQUEST_START_TEXT, parse_mode='Markdown', reply_markup=ui.AREA_KEYBOARD)
+    elif intent == 'greeting':
+        await render.reply(update.message, ui.GREETING_TEXT, reply_markup=ui.MAIN_MENU_KEYBOARD)
+    elif intent == 'thanks':
+        await update.message.reply_text(ui.THANKS_TEXT)
     else:
-        await update.message.reply_text("Выберите интересующий раздел:", reply_markup=main_menu_keyboard())
+        await render.reply(update.message, ui.MENU_PROMPT_TEXT, reply_markup=ui.MAIN_MENU_KEYBOARD)
 
-# ===== ГЛАВНАЯ ФУНКЦИЯ =====
-def main():
-    if not TOKEN:
-        logger.error("❌ Токен бота не найден! Установите BOT_TOKEN в Render")
+# ===== ФОНОВЫЕ ЗАДАЧИ =====
+async def activity_maintenance(context: ContextTypes.DEFAULT_TYPE):
+    """Задача job queue: дневные сводки активности и ротация помесячных секций"""
+    await startup.ready()
+    try:
+        await db.call(activity.maintain, list(ui.KNOWLEDGE_BASE))
+    except Exception as e:
+        logger.error(f"❌ Ошибка обслуживания журнала активности: {e}")
+
+async def on_startup(application: Application):
+    startup.mark('initialize')
+    journal.open_journal()
+    activity.start_recorder()
+    notifier.start_notifier(application.bot, ADMIN_CHAT_ID)
+    # В режиме webhook HTTP-сервер поднимает server.run_webhook
+    if application.updater is not None:
+        await server.start_http(application)
+    if startup.LAZY:
+        startup.defer(deferred_init(application))
+    else:
+        await start_background(application)
+    startup.mark('post_init')
+
+async def deferred_init(application: Application):
+    """Ленивый запуск: DDL схемы и очередь писем — уже после того, как бот начал отвечать"""
+    with startup.phase('schema'):
+        await db.call(init_db)
+    with startup.phase('outbox'):
+        # Локальная очередь SQLite создаётся и при разомкнутом предохранителе БД
+        await db.call_local(outbox.init_outbox)
+    await start_background(application)
+
+async def start_background(application: Application):
+    """Фоновые задачи, которым нужны таблицы: отправка писем и продолжение рассылки.
+
+    В кластере они работают в одном процессе — том, что обслуживает чат админа;
+    журнал заявок у каждого процесса свой и догружается им самим.
+    """
+    journal.start_replayer(on_replayed=on_replayed)
+    if not cluster.owns(ADMIN_CHAT_ID):
         return
+    outbox.start_worker()
+    if DATABASE_URL:
+        await broadcast.resume_broadcasts(
+            application.bot, on_finish=lambda current: report_broadcast(application.bot, current)
+        )
+
+async def on_stop(application: Application):
+    # Подготовка, не успевшая завершиться, не должна запускать задачи после остановки
+    await startup.cancel_deferred()
+    # Незаконченный профиль отправляется админу, пока бот ещё может отправлять
+    await profiler.stop_profile()
+    # Рассылку останавливаем, пока бот ещё может отправлять; после старта она продолжится
+    await broadcast.stop_broadcast()
+    # Накопленные заявки уходят сводкой, не дожидаясь конца окна
+    await notifier.stop_notifier()
+    await journal.close_journal()
+
+async def on_shutdown(application: Application):
+    await startup.cancel_deferred()
+    await server.stop_http()
+    await outbox.stop_worker()
+    await activity.stop_recorder()
+    db.close_pool()
+
+# ===== ГЛАВНАЯ ФУНКЦИЯ =====
+def build_application(builder=None):
+    """Application со всеми обработчиками.
     
-    init_db()
+    builder можно передать свой — так нагрузочный тест направляет бота
+    на локальную заглушку Bot API (benchmarks/loadtest.py).
+    """
+    if builder is None:
+        builder = Application.builder().token(TOKEN)
+    builder = (
+        builder
+        .request(metrics.InstrumentedRequest(connection_pool_size=TELEGRAM_POOL_SIZE))
+        .rate_limiter(ratelimit.FloodControlLimiter())
+        .concurrent_updates(server.ChatOrderedUpdateProcessor(server.UPDATE_CONCURRENCY))
+        .persistence(persistence.create_persistence())
+        .post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown)
+    )
+    application = builder.build()
     
-    application = Application.builder().token(TOKEN).build()
+    metrics.register_collector('db_pool', 'Пул соединений PostgreSQL', db.pool_stats)
+    metrics.register_collector('outbox', 'Очередь писем', outbox.outbox_stats)
+    metrics.register_collector('activity', 'Журнал активности', activity.activity_stats)
+    metrics.register_collector('state', 'Запись состояния диалогов', lambda: application.persistence.stats)
+    metrics.register_collector('ratelimit', 'Планировщик исходящих сообщений', application.bot.rate_limiter.snapshot)
+    metrics.register_collector('startup', 'Этапы запуска', startup.startup_stats)
+    metrics.register_collector('notify', 'Уведомления о заявках', notifier.notifier_stats)
+    metrics.register_collector('breaker', 'Предохранители зависимостей', breaker.breaker_stats)
+    metrics.register_collector('journal', 'Журнал заявок', journal.journal_stats)
+    metrics.register_collector('api', 'API заявок для CRM', api.api_stats)
+    metrics.register_collector('render', 'Перерисовка сообщений', render.render_stats)
     
+    # Брошенные воронки и user_data давно молчащих пользователей не копятся в памяти
+    sweeper = persistence.FunnelSweeper(
+        application, FUNNEL_STEPS,
+        on_abandon=lambda user_id, step: activity.record(user_id, 'funnel_abandon', step)
+    )
     conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(select_area, pattern='^area_')],
         states={
@@ -523,20 +806,88 @@ def main():
                 CallbackQueryHandler(confirm_request),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_request),
                 MessageHandler(filters.CONTACT, confirm_request)
-            ]
+            ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, sweeper.on_timeout)]
         },
         fallbacks=[CommandHandler('cancel', cancel), CallbackQueryHandler(start, pattern='^cancel$')],
-        allow_reentry=True
+        allow_reentry=True,
+        # Без job queue PTB таймауты не планирует (и предупреждает об этом на каждом апдейте)
+        conversation_timeout=persistence.FUNNEL_IDLE_TIMEOUT if application.job_queue is not None else None,
+        name='lead_funnel',
+        persistent=True
     )
+    sweeper.track(conv_handler)
+    metrics.register_collector('funnel', 'Диалоги в памяти', sweeper.snapshot)
+    application.bot_data['sweeper'] = sweeper
+    if application.job_queue is None:
+        logger.warning(
+            "⚠️ Job queue недоступна (нужен python-telegram-bot[job-queue]): "
+            "брошенные диалоги не очищаются, журнал активности не обслуживается"
+        )
+    else:
+        application.job_queue.run_repeating(
+            sweeper.run, interval=persistence.FUNNEL_SWEEP_INTERVAL,
+            first=persistence.FUNNEL_SWEEP_INTERVAL, name='funnel_sweep'
+        )
+        if DATABASE_URL and cluster.owns(ADMIN_CHAT_ID):
+            application.job_queue.run_repeating(
+                activity_maintenance, interval=activity.ACTIVITY_MAINTENANCE_INTERVAL,
+                first=60, name='activity_maintenance'
+            )
     
+    application.add_handler(TypeHandler(Update, sweeper.touch), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("stats", admin_stats))
+    application.add_handler(CommandHandler("leads", admin_leads))
+    application.add_handler(CommandHandler("export", admin_export))
+    application.add_handler(CommandHandler("broadcast", admin_broadcast))
+    application.add_handler(CommandHandler("profile", admin_profile))
+    application.add_handler(CommandHandler("funnel", admin_funnel))
+    application.add_handler(CallbackQueryHandler(admin_leads_page, pattern='^leads:'))
+    application.add_handler(CallbackQueryHandler(admin_broadcast_action, pattern='^broadcast:'))
     application.add_handler(conv_handler)
     application.add_handler(CallbackQueryHandler(handle_menu))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    return application
+
+def main():
+    startup.mark('imports')
+    if not TOKEN:
+        logger.error("❌ Токен бота не найден! Установите BOT_TOKEN в Render")
+        return
+    
+    if cluster.WORKERS > 1 and cluster.WORKER_INDEX is None:
+        logger.info(f"🤖 Бот ELP запускается кластером из {cluster.WORKERS} обработчиков...")
+        asyncio.run(cluster.run_dispatcher(TOKEN, TELEGRAM_API_URL))
+        return
+    # Обработчик кластера ждёт свой шард до чтения состояния диалогов
+    cluster.acquire_shard_lock()
     
-    logger.info("🤖 Бот ELP запускается...")
-    application.run_polling()
+    # При ленивом запуске пул откроется первым запросом, а схему проверит deferred_init
+    if not startup.LAZY:
+        with startup.phase('schema'):
+            db.init_pool()
+            init_db()
+        with startup.phase('outbox'):
+            outbox.init_outbox()
+    
+    builder = Application.builder().token(TOKEN)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    if server.WEBHOOK_URL or cluster.WORKER_INDEX is not None:
+        builder = builder.updater(None)
+    with startup.phase('application'):
+        application = build_application(builder)
+    
+    if cluster.WORKER_INDEX is not None:
+        logger.info(f"🤖 Обработчик {cluster.WORKER_INDEX} кластера запускается...")
+        asyncio.run(server.run_webhook(application, worker=cluster.WORKER_INDEX))
+    elif server.WEBHOOK_URL:
+        logger.info("🤖 Бот ELP запускается в режиме webhook...")
+        asyncio.run(server.run_webhook(application))
+    else:
+        logger.info("🤖 Бот ELP запускается...")
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,103 @@
+"""Бенчмарк распознавания намерений в свободном тексте: прежний перебор
+`any(word in text ...)` против одного скомпилированного выражения из intents.py.
+
+Сравниваются три варианта на одном корпусе сообщений:
+  legacy  — как было в handle_text: только приветствие и благодарность;
+  scan    — тот же перебор, но по всей таблице ключей intents.py (так пришлось бы
+            расширять старый код, чтобы покрыть темы bot.js);
+  regex   — intents.detect_intent: один проход по тексту.
+
+Запуск: python benchmarks/intent_bench.py [сообщений]
+"""
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import intents
+
+PHRASES = (
+    "Привет!", "Здравствуйте, подскажите пожалуйста", "Спасибо большое",
+    "Сколько стоит аренда склада?", "какая цена за квадратный метр с OPEX",
+    "Нужна площадь около 5000 м2", "Где вы находитесь? Как доехать с БАКАД",
+    "Какая высота потолков и нагрузка на пол", "Когда сдача второго этапа",
+    "Кто у вас брокер", "есть ли парковка для фур и офисы",
+    "Кто девелопер проекта", "дайте телефон директора",
+    "Хочу оставить заявку", "hello, what is the rent price per sqm?",
+    "where is the warehouse located", "thanks!", "ок", "а если подробнее",
+    "Мы логистическая компания из Алматы, ищем склад класса А",
+)
+FILLER = (
+    "мы", "компания", "ищем", "склад", "для", "хранения", "товаров", "в", "Алматы",
+    "на", "длительный", "период", "и", "хотим", "узнать", "подробнее", "условия",
+)
+
+
+def build_corpus(size, seed=42):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        words = [rng.choice(FILLER) for _ in range(rng.randint(0, 25))]
+        words.insert(rng.randint(0, len(words)), rng.choice(PHRASES))
+        corpus.append(' '.join(words))
+    return corpus
+
+
+# ===== ПРЕЖНЯЯ РЕАЛИЗАЦИЯ (как в handle_text до intents.py) =====
+def legacy_intent(text):
+    text = text.lower()
+    if any(word in text for word in ['привет', 'здравств', 'hello', 'hi']):
+        return 'greeting'
+    elif any(word in text for word in ['спасибо', 'благодар']):
+        return 'thanks'
+    return None
+
+
+# Перебор по всей таблице: отдельное выражение на каждую основу, как any() по списку
+SCAN_TABLE = [
+    (name, [re.compile(r'(?<!\w)' + stem) for stem in stems])
+    for name, _, stems in intents.INTENTS
+]
+
+
+def scan_intent(text):
+    text = text.lower()
+    for name, patterns in SCAN_TABLE:
+        if any(pattern.search(text) for pattern in patterns):
+            return name
+    return None
+
+
+def bench(fn, corpus):
+    start = time.perf_counter()
+    for text in corpus:
+        fn(text)
+    return time.perf_counter() - start
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    corpus = build_corpus(size)
+    total_chars = sum(len(text) for text in corpus)
+    print(f"Корпус: {size} сообщений, в среднем {total_chars / size:.0f} символов\n")
+
+    results = {}
+    for name, fn in (('legacy', legacy_intent), ('scan', scan_intent), ('regex', intents.detect_intent)):
+        elapsed = min(bench(fn, corpus) for _ in range(3))
+        results[name] = elapsed
+        print(f"{name:<8} {elapsed * 1e6 / size:8.2f} мкс/сообщение   {size / elapsed:10.0f} сообщений/с")
+
+    # Полный перебор и один проход должны находить одно и то же намерение
+    mismatches = sum(scan_intent(text) != intents.detect_intent(text) for text in corpus)
+    print(f"\nУскорение regex относительно scan: x{results['scan'] / results['regex']:.1f}")
+    print(f"Расхождений scan/regex: {mismatches}")
+    recognized = sum(intents.detect_intent(text) is not None for text in corpus)
+    legacy_recognized = sum(legacy_intent(text) is not None for text in corpus)
+    print(f"Распознано: regex {recognized / size:.0%}, legacy {legacy_recognized / size:.0%}")
+
+
+if __name__ == '__main__':
+    main()
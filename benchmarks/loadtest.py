@@ -0,0 +1,420 @@
+"""Сквозной нагрузочный тест бота на локальной заглушке Telegram Bot API.
+
+Поднимает на 127.0.0.1:
+  • заглушку Bot API (getUpdates / sendMessage / editMessageText /
+    answerCallbackQuery и служебные методы) — бот работает в режиме polling;
+  • заглушку SMTP без TLS — очередь писем отправляет уведомления в неё;
+  • PostgreSQL — настоящий, если передан --database-url (или DATABASE_URL),
+    иначе бот работает без БД, как при пустом DATABASE_URL.
+
+Каждый виртуальный пользователь проходит /start → свободный текст → раздел
+меню → всю воронку заявки. Задержка шага — от отправки апдейта до первого
+ответа бота в этот чат (sendMessage/editMessageText). В отчёте — пропускная
+способность и p50/p95/p99 по обработчикам.
+
+Заглушки и пользователи работают в отдельном процессе, бот — в основном.
+Лимиты Telegram из ratelimit.py действуют и здесь (30 сообщений/с на бота):
+чтобы мерить предел самого бота, поднимите TELEGRAM_GLOBAL_RATE/_BURST.
+
+Запуск: python benchmarks/loadtest.py --users 2000 --ramp 10
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+import tempfile
+import multiprocessing
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+
+BOT_TOKEN = '123456:LOADTEST'
+BOT_ID = 123456
+ADMIN_CHAT_ID = 1
+FIRST_USER_ID = 10_000_000
+
+
+# ===== ЗАГЛУШКА BOT API =====
+class FakeBotApi:
+    """Минимальный Bot API: отдаёт апдейты через getUpdates и принимает ответы бота"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.updates = []
+        self.update_id = 0
+        self.message_id = 0
+        self.new_updates = asyncio.Event()
+        self.waiters = {}
+        self.calls = defaultdict(int)
+        self.web = web.Application(client_max_size=64 * 1024 * 1024)
+        self.web.router.add_post('/bot{token}/{method}', self.handle)
+        self._runner = None
+        self.port = None
+
+    async def start(self):
+        self._runner = web.AppRunner(self.web, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.port}/bot'
+
+    # ----- со стороны пользователей -----
+    def push(self, update):
+        self.update_id += 1
+        update['update_id'] = self.update_id
+        self.updates.append(update)
+        self.new_updates.set()
+
+    def expect(self, chat_id):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id] = future
+        return future
+
+    # ----- со стороны бота -----
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if method == 'getUpdates':
+            return self._ok(await self._get_updates(params))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == 'getMe':
+            return self._ok({'id': BOT_ID, 'is_bot': True, 'first_name': 'ELP', 'username': 'elp_loadtest_bot'})
+        if method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            return self._ok(self._bot_message(params, edit=method == 'editMessageText'))
+        # answerCallbackQuery, deleteWebhook, setWebhook и прочее — просто успех
+        return self._ok(True)
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        if offset:
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    def _bot_message(self, params, edit):
+        chat_id = int(params['chat_id'])
+        if edit:
+            message_id = int(params['message_id'])
+        else:
+            self.message_id += 1
+            message_id = self.message_id
+        waiter = self.waiters.pop(chat_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(message_id)
+        return {
+            'message_id': message_id, 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'ELP'},
+            'text': params.get('text', ''),
+        }
+
+    @staticmethod
+    def _ok(result):
+        return web.json_response({'ok': True, 'result': result})
+
+
+# ===== ЗАГЛУШКА SMTP =====
+class FakeSmtp:
+    """SMTP-сервер, который принимает любые письма и только считает их"""
+
+    def __init__(self):
+        self.received = 0
+        self._server = None
+        self.port = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._session, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _session(self, reader, writer):
+        writer.write(b'220 localhost ESMTP loadtest\r\n')
+        try:
+            while line := await reader.readline():
+                command = line[:4].upper()
+                if command == b'EHLO':
+                    writer.write(b'250-localhost\r\n250-AUTH PLAIN\r\n250 8BITMIME\r\n')
+                elif command == b'AUTH':
+                    writer.write(b'235 2.7.0 Authentication successful\r\n')
+                elif command == b'DATA':
+                    writer.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                    await writer.drain()
+                    while (await reader.readline()) not in (b'.\r\n', b''):
+                        pass
+                    self.received += 1
+                    writer.write(b'250 OK\r\n')
+                elif command == b'QUIT':
+                    writer.write(b'221 Bye\r\n')
+                    break
+                else:
+                    # HELO, MAIL, RCPT, RSET, NOOP
+                    writer.write(b'250 OK\r\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+# ===== ВИРТУАЛЬНЫЕ ПОЛЬЗОВАТЕЛИ =====
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+
+def message_update(user_id, text):
+    message = {
+        'message_id': random.randint(1, 1 << 30), 'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'}, 'from': _user(user_id), 'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'message': message}
+
+
+def callback_update(user_id, data, message_id):
+    return {'callback_query': {
+        'id': str(random.getrandbits(63)), 'from': _user(user_id), 'chat_instance': str(user_id), 'data': data,
+        'message': {
+            'message_id': message_id, 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'ELP'}, 'text': '…',
+        },
+    }}
+
+
+# (обработчик, тип апдейта, данные)
+SCENARIO = (
+    ('start', 'message', '/start'),
+    ('handle_text', 'message', 'Здравствуйте, сколько стоит аренда?'),
+    ('handle_menu', 'callback', 'specs'),
+    ('handle_menu', 'callback', 'start_request'),
+    ('select_area', 'callback', 'area_3500'),
+    ('select_term', 'callback', 'term_12'),
+    ('get_contact', 'message', 'Иван Петров'),
+    ('confirm_request', 'callback', 'send_phone'),
+    # {user_id}: у каждого пользователя свой номер, иначе заявки объединятся как дубли
+    ('confirm_request', 'message', '+7701{user_id:07d}'),
+)
+
+
+class LoadTest:
+    def __init__(self, api, args):
+        self.api = api
+        self.args = args
+        self.latencies = defaultdict(list)
+        self.completed = 0
+        self.timeouts = defaultdict(int)
+
+    async def run_user(self, user_id, delay):
+        await asyncio.sleep(delay)
+        message_id = None
+        for handler, kind, data in SCENARIO:
+            if kind == 'message':
+                update = message_update(user_id, data.format(user_id=user_id % 10 ** 7))
+            else:
+                update = callback_update(user_id, data, message_id)
+            waiter = self.api.expect(user_id)
+            started = time.perf_counter()
+            self.api.push(update)
+            try:
+                message_id = await asyncio.wait_for(waiter, self.args.step_timeout)
+            except asyncio.TimeoutError:
+                self.timeouts[handler] += 1
+                return
+            self.latencies[handler].append(time.perf_counter() - started)
+            if self.args.think:
+                await asyncio.sleep(random.uniform(0, self.args.think))
+        self.completed += 1
+
+    async def run(self):
+        users = range(FIRST_USER_ID, FIRST_USER_ID + self.args.users)
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            self.run_user(user_id, random.uniform(0, self.args.ramp)) for user_id in users
+        ))
+        return time.perf_counter() - started
+
+
+def percentile(values, p):
+    """Перцентиль методом ближайшего ранга по отсортированному списку"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def report(test, elapsed, api, smtp):
+    rows = {}
+    print(f"\nПользователей: {test.args.users}, прошли воронку: {test.completed}, время: {elapsed:.1f} с")
+    total_steps = sum(len(v) for v in test.latencies.values())
+    print(f"Шагов: {total_steps} ({total_steps / elapsed:.0f}/с), заявок: {test.completed / elapsed:.1f}/с\n")
+    print(f"{'обработчик':<16}{'шагов':>8}{'в сек':>9}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}{'max мс':>9}{'таймаут':>9}")
+    for handler in dict.fromkeys(h for h, _, _ in SCENARIO):
+        values = sorted(test.latencies[handler])
+        row = {
+            'count': len(values), 'rate': len(values) / elapsed,
+            'p50': percentile(values, 50) * 1000, 'p95': percentile(values, 95) * 1000,
+            'p99': percentile(values, 99) * 1000, 'max': (values[-1] if values else 0) * 1000,
+            'timeouts': test.timeouts[handler],
+        }
+        rows[handler] = row
+        print(f"{handler:<16}{row['count']:>8}{row['rate']:>9.1f}{row['p50']:>9.1f}{row['p95']:>9.1f}"
+              f"{row['p99']:>9.1f}{row['max']:>9.1f}{row['timeouts']:>9}")
+    print(f"\nВызовы Bot API: {dict(sorted(api.calls.items()))}")
+    print(f"Писем принято SMTP-заглушкой: {smtp.received}")
+    return {
+        'users': test.args.users, 'completed': test.completed, 'elapsed': elapsed,
+        'handlers': rows, 'api_calls': dict(api.calls), 'emails': smtp.received,
+    }
+
+
+# ===== ПРОЦЕСС-ДРАЙВЕР: заглушки и пользователи =====
+async def drive(args, conn):
+    api = FakeBotApi(latency=args.api_latency / 1000)
+    smtp = FakeSmtp()
+    await api.start()
+    await smtp.start()
+    conn.send((api.base_url, smtp.port))
+    loop = asyncio.get_running_loop()
+    # Ждём, пока бот запустит polling
+    await loop.run_in_executor(None, conn.recv)
+
+    test = LoadTest(api, args)
+    try:
+        elapsed = await test.run()
+        # Даём очереди писем дослать уведомления
+        deadline = time.monotonic() + 10
+        while smtp.received < test.completed and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        result = report(test, elapsed, api, smtp)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+    finally:
+        conn.send('done')
+        # Заглушки гасим только после остановки бота, иначе оборвётся его getUpdates
+        await loop.run_in_executor(None, conn.recv)
+        await smtp.stop()
+        await api.stop()
+
+
+def driver_main(args, conn):
+    asyncio.run(drive(args, conn))
+
+
+# ===== ПРОЦЕСС БОТА =====
+async def run_bot(args, conn):
+    base_url, smtp_port = conn.recv()
+    workdir = tempfile.mkdtemp(prefix='elp_loadtest_')
+    # Настройки модулей бота читаются при импорте, поэтому окружение — до import app
+    for name in ('WEBHOOK_URL', 'RENDER_EXTERNAL_URL', 'PORT'):
+        os.environ.pop(name, None)
+    os.environ.update({
+        'BOT_TOKEN': BOT_TOKEN, 'ADMIN_CHAT_ID': str(ADMIN_CHAT_ID),
+        'SMTP_SERVER': '127.0.0.1', 'SMTP_PORT': str(smtp_port), 'SMTP_STARTTLS': '0',
+        'EMAIL_PASSWORD': 'loadtest', 'OUTBOX_POLL_INTERVAL': '1',
+        'OUTBOX_PATH': os.path.join(workdir, 'outbox.sqlite3'),
+        'STATE_DB_PATH': os.path.join(workdir, 'bot_state.sqlite3'),
+        'UPDATE_CONCURRENCY': str(args.concurrency),
+        # Схема и очередь писем готовятся ниже явно, до начала замеров
+        'STARTUP_MODE': 'eager',
+    })
+    if args.pool_size:
+        os.environ['TELEGRAM_POOL_SIZE'] = str(args.pool_size)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    else:
+        os.environ.pop('DATABASE_URL', None)
+
+    import app
+    from telegram.ext import Application
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.ERROR)
+
+    app.db.init_pool()
+    app.init_db()
+    app.outbox.init_outbox()
+    application = app.build_application(Application.builder().token(BOT_TOKEN).base_url(base_url))
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.updater.start_polling(poll_interval=0, timeout=1)
+    await application.start()
+    try:
+        conn.send('go')
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        if args.metrics:
+            with open(args.metrics, 'w') as f:
+                f.write(app.metrics.render())
+        # Уведомления админу идут по лимиту одного чата (~1/с) и к концу прогона
+        # ещё в очереди; ждать их при остановке незачем
+        pending = [t for t in asyncio.all_tasks() if t.get_name().startswith('notify_admin_')]
+        for task in pending:
+            task.cancel()
+        print(f"Уведомлений админу не дождались (отменены): {len(pending)}")
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+        conn.send('stopped')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000, help='виртуальных пользователей')
+    parser.add_argument('--ramp', type=float, default=5, help='за сколько секунд подключаются все пользователи')
+    parser.add_argument('--think', type=float, default=0.0, help='пауза пользователя между шагами, до N секунд')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='задержка ответа Bot API, мс')
+    parser.add_argument('--concurrency', type=int, default=64, help='UPDATE_CONCURRENCY бота')
+    parser.add_argument('--pool-size', type=int, help='TELEGRAM_POOL_SIZE бота')
+    parser.add_argument('--step-timeout', type=float, default=30, help='сколько ждать ответа на шаг, с')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'), help='PostgreSQL для теста')
+    parser.add_argument('--json', help='сохранить результаты в JSON для сравнения прогонов')
+    parser.add_argument('--metrics', help='сохранить снимок /metrics бота после прогона')
+    parser.add_argument('--verbose', action='store_true', help='логи бота уровня INFO')
+    args = parser.parse_args()
+
+    # Заглушки и пользователи живут в отдельном процессе, чтобы не отнимать
+    # у бота время event loop и CPU и не искажать замеры
+    bot_conn, driver_conn = multiprocessing.Pipe()
+    driver = multiprocessing.Process(target=driver_main, args=(args, driver_conn), daemon=True)
+    driver.start()
+    try:
+        asyncio.run(run_bot(args, bot_conn))
+    finally:
+        driver.join(timeout=10)
+
+
+if __name__ == '__main__':
+    main()
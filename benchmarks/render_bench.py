@@ -0,0 +1,123 @@
+"""Микробенчмарк слоя отрисовки: пересборка клавиатур и текстов на каждый апдейт
+против готовых объектов из ui.py.
+
+Запуск: python benchmarks/render_bench.py [итераций]
+"""
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import ui
+
+LEAD = {
+    'area': '1 000 - 3 500 м²', 'term': '1 год', 'name': 'Иван', 'contact': '+77010000000',
+    'contact_type': 'телефон', 'user_id': 123456789, 'username': 'ivan'
+}
+
+
+# ===== ПРЕЖНЯЯ РЕАЛИЗАЦИЯ (как в app.py до ui.py) =====
+def legacy_main_menu_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("📐 Площади", callback_data='area'), InlineKeyboardButton("💰 Стоимость", callback_data='price')],
+        [InlineKeyboardButton("📍 Расположение", callback_data='location'), InlineKeyboardButton("⚙️ Характеристики", callback_data='specs')],
+        [InlineKeyboardButton("👨‍💼 Контакты", callback_data='contact'), InlineKeyboardButton("📅 Сроки", callback_data='timeline')],
+        [InlineKeyboardButton("📝 Оставить заявку", callback_data='start_request')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def legacy_action_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("📝 Оставить заявку", callback_data='start_request'), InlineKeyboardButton("💰 Узнать стоимость", callback_data='price')],
+        [InlineKeyboardButton("👨‍💼 Связаться с директором", callback_data='contact')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def legacy_area_selection_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("до 500 м²", callback_data='area_500')],
+        [InlineKeyboardButton("500 - 1 000 м²", callback_data='area_1000')],
+        [InlineKeyboardButton("1 000 - 3 500 м²", callback_data='area_3500')],
+        [InlineKeyboardButton("более 3 500 м²", callback_data='area_5000')],
+        [InlineKeyboardButton("↩️ Назад", callback_data='cancel')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def legacy_term_selection_keyboard():
+    keyboard = [
+        [InlineKeyboardButton("6 месяцев", callback_data='term_6')],
+        [InlineKeyboardButton("1 год", callback_data='term_12')],
+        [InlineKeyboardButton("2 года", callback_data='term_24')],
+        [InlineKeyboardButton("3+ года", callback_data='term_36')],
+        [InlineKeyboardButton("↩️ Назад", callback_data='back_to_area')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def legacy_update(lead):
+    """Один «типичный» проход воронки: меню, раздел, шаги заявки"""
+    legacy_main_menu_keyboard()
+    legacy_action_keyboard()
+    legacy_area_selection_keyboard()
+    f"📋 *Оформление заявки*\n\n✅ Площадь: {lead['area']}\n\n🔄 *Шаг 2 из 4*\nНа какой срок планируете аренду?"
+    legacy_term_selection_keyboard()
+    f"📋 *Оформление заявки*\n\n✅ Площадь: {lead['area']}\n✅ Срок аренды: {lead['term']}\n\n🔄 *Шаг 3 из 4*\nКак к вам обращаться? Отправьте ваше имя."
+    InlineKeyboardMarkup([[
+        InlineKeyboardButton("📱 Отправить телефон", callback_data='send_phone'),
+        InlineKeyboardButton("📧 Указать email", callback_data='send_email')
+    ], [
+        InlineKeyboardButton("↩️ Назад", callback_data='back_to_term')
+    ]])
+
+
+# ===== НОВАЯ РЕАЛИЗАЦИЯ =====
+def cached_update(lead):
+    ui.MAIN_MENU_KEYBOARD
+    ui.KNOWLEDGE_SCREENS['area']
+    ui.AREA_KEYBOARD
+    ui.render_step_term(lead)
+    ui.TERM_KEYBOARD
+    ui.render_step_name(lead)
+    ui.CONTACT_METHOD_KEYBOARD
+
+
+def measure(fn, iterations):
+    fn(LEAD)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn(LEAD)
+    elapsed = time.perf_counter() - started
+
+    # Пиковый объём памяти, выделяемой за один апдейт
+    tracemalloc.start()
+    peaks = []
+    for _ in range(100):
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(LEAD)
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+    return elapsed / iterations * 1e6, sorted(peaks)[len(peaks) // 2]
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    now = datetime.now().strftime('%d.%m.%Y %H:%M')
+    print(f"Итераций: {iterations}\n")
+    print(f"{'вариант':<16}{'мкс/апдейт':>12}{'байт/апдейт':>14}")
+    for name, fn in (('пересборка', legacy_update), ('ui.py', cached_update)):
+        us, peak = measure(fn, iterations)
+        print(f"{name:<16}{us:>12.2f}{peak:>14}")
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        ui.render_email(LEAD, '#1', now)
+    print(f"\nШаблон email: {(time.perf_counter() - started) / iterations * 1e6:.2f} мкс/письмо")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+
+# ===== НАСТРОЙКИ ПРЕДОХРАНИТЕЛЕЙ =====
+# Сколько сбоев подряд размыкают предохранитель
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', 5))
+# Сколько секунд вызовы отклоняются сразу, прежде чем пропустить пробный
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Зависимость считается недоступной — вызов отклонён без ожидания"""
+
+
+class CircuitBreaker:
+    """Предохранитель зависимости: closed → open → half_open → closed.
+
+    После BREAKER_FAILURES сбоев подряд вызовы сразу отклоняются
+    (CircuitOpenError), а не ждут сетевых таймаутов. Через reset_timeout
+    пропускается один пробный вызов: удачный замыкает предохранитель,
+    неудачный снова размыкает. Вызывается и из event loop, и из потоков БД.
+    """
+
+    def __init__(self, name, failures=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.threshold = failures
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_at = None
+        self._lock = threading.Lock()
+        self.stats = {'failures': 0, 'rejected': 0, 'opened': 0}
+
+    def allow(self):
+        """Можно ли обращаться к зависимости сейчас (в half_open — только одному пробному вызову)"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN and now - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probe_at = None
+            # Пробный вызов, зависший дольше reset_timeout, не держит предохранитель вечно
+            if self.state == HALF_OPEN and (self._probe_at is None or now - self._probe_at >= self.reset_timeout):
+                self._probe_at = now
+                return True
+            self.stats['rejected'] += 1
+            return False
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name}: зависимость недоступна, повтор через {self.retry_in():.0f} с")
+
+    def fail_fast(self):
+        """CircuitOpenError, если вызов заведомо будет отклонён. В отличие от check()
+        пробный вызов не занимает — его получит check() в месте самого обращения"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                rejected = now - self._opened_at < self.reset_timeout
+            else:
+                rejected = self.state == HALF_OPEN and self._probe_at is not None \
+                    and now - self._probe_at < self.reset_timeout
+            if rejected:
+                self.stats['rejected'] += 1
+        if rejected:
+            raise CircuitOpenError(f"{self.name}: зависимость недоступна, повтор через {self.retry_in():.0f} с")
+
+    def retry_in(self):
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info(f"✅ Предохранитель {self.name} замкнут: зависимость снова отвечает")
+            self.state = CLOSED
+            self._failures = 0
+            self._probe_at = None
+
+    def failure(self):
+        with self._lock:
+            self.stats['failures'] += 1
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.threshold):
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._probe_at = None
+                self.stats['opened'] += 1
+                logger.error(
+                    f"🧯 Предохранитель {self.name} разомкнут после {self._failures} сбоев, "
+                    f"вызовы отклоняются {self.reset_timeout:.0f} с"
+                )
+
+    def snapshot(self):
+        return dict(self.stats, state=STATE_CODES[self.state], consecutive=self._failures)
+
+
+breakers = {}
+
+
+def get(name, **kwargs):
+    """Предохранитель зависимости по имени (создаётся при первом обращении)"""
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name, **kwargs)
+    return breakers[name]
+
+
+def open_breakers():
+    return [name for name, b in breakers.items() if b.state != CLOSED]
+
+
+def breaker_stats():
+    """Для /metrics: <имя>_state (0 — замкнут, 1 — проба, 2 — разомкнут) и счётчики"""
+    stats = {}
+    for name, b in breakers.items():
+        stats.update({f'{name}_{key}': value for key, value in b.snapshot().items()})
+    return stats
+
+
+# ===== БЮДЖЕТ ВРЕМЕНИ =====
+class Deadline:
+    """Общий бюджет времени на цепочку вызовов: каждый следующий получает остаток"""
+
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    async def run(self, awaitable):
+        """asyncio.TimeoutError, если бюджет исчерпан раньше, чем awaitable завершился"""
+        return await asyncio.wait_for(awaitable, self.remaining())
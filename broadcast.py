@@ -0,0 +1,368 @@
+import os
+import asyncio
+import logging
+
+from telegram.error import BadRequest, Forbidden, TelegramError
+
+import db
+
+# ===== НАСТРОЙКИ РАССЫЛКИ =====
+# Сколько получателей читается из БД и фиксируется за один шаг
+BROADCAST_CHUNK_SIZE = int(os.environ.get('BROADCAST_CHUNK_SIZE', 200))
+# Одновременных отправок; темп всё равно задаёт ratelimit (полоса 'bulk')
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', 30))
+# Сколько при остановке ждать уже начатые отправки, прежде чем оборвать их
+BROADCAST_STOP_TIMEOUT = float(os.environ.get('BROADCAST_STOP_TIMEOUT', 10))
+# Повторы шага рассылки при сбое БД: пауза растёт от BASE вдвое до MAX секунд
+BROADCAST_RETRIES = int(os.environ.get('BROADCAST_RETRIES', 5))
+BROADCAST_RETRY_BASE = float(os.environ.get('BROADCAST_RETRY_BASE', 2))
+BROADCAST_RETRY_MAX = float(os.environ.get('BROADCAST_RETRY_MAX', 60))
+
+logger = logging.getLogger(__name__)
+
+
+# ===== ТАБЛИЦЫ =====
+def init_broadcast_tables(cursor):
+    """Рассылки и журнал доставки: по нему рассылка продолжается после рестарта"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            status VARCHAR(20) DEFAULT 'draft',
+            created_by BIGINT,
+            total INTEGER DEFAULT 0,
+            last_user_id BIGINT DEFAULT 0,
+            delivered INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            unknown INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER REFERENCES broadcasts (id) ON DELETE CASCADE,
+            user_id BIGINT,
+            status VARCHAR(20) DEFAULT 'sending',
+            error TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (broadcast_id, user_id)
+        )
+    ''')
+    # Получатели читаются по возрастанию user_id
+    cursor.execute('CREATE INDEX IF NOT EXISTS leads_user_id_idx ON leads (user_id)')
+
+
+# ===== ЗАПРОСЫ =====
+BROADCAST_COLUMNS = 'id, text, status, total, last_user_id, delivered, blocked, failed, unknown'
+
+
+def _fetch_broadcast(cursor, where, params=()):
+    cursor.execute(f'SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE {where} ORDER BY id DESC LIMIT 1', params)
+    row = cursor.fetchone()
+    return dict(zip(BROADCAST_COLUMNS.split(', '), row)) if row else None
+
+
+def create_draft(text, created_by):
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(DISTINCT user_id) FROM leads WHERE user_id IS NOT NULL')
+        total = cursor.fetchone()[0]
+        cursor.execute(
+            'INSERT INTO broadcasts (text, created_by, total) VALUES (%s, %s, %s) RETURNING id',
+            (text, created_by, total)
+        )
+        broadcast_id = cursor.fetchone()[0]
+        cursor.close()
+        return broadcast_id, total
+    return db.pool.run(query)
+
+
+def get_broadcast(broadcast_id=None):
+    """Рассылка по id или последняя созданная"""
+    def query(conn):
+        cursor = conn.cursor()
+        if broadcast_id is None:
+            row = _fetch_broadcast(cursor, "status <> 'draft'")
+        else:
+            row = _fetch_broadcast(cursor, 'id = %s', (broadcast_id,))
+        cursor.close()
+        return row
+    return db.pool.run(query)
+
+
+def set_status(broadcast_id, status, expected):
+    """Смена статуса только из ожидаемого — защита от двойного нажатия кнопки"""
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE broadcasts SET status = %s,
+                finished_at = CASE WHEN %s IN ('done', 'cancelled', 'failed') THEN CURRENT_TIMESTAMP END
+            WHERE id = %s AND status = ANY(%s)
+        ''', (status, status, broadcast_id, list(expected)))
+        changed = cursor.rowcount
+        cursor.close()
+        return changed > 0
+    return db.pool.run(query)
+
+
+def running_broadcasts():
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+        rows = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        return rows
+    return db.pool.run(query)
+
+
+def mark_unknown(broadcast_id):
+    """Отправки, прерванные падением процесса: дошли они или нет — неизвестно,
+    поэтому повторно не отправляются (лучше потерять одно сообщение, чем задвоить)"""
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE broadcast_deliveries SET status = 'unknown', updated_at = CURRENT_TIMESTAMP
+            WHERE broadcast_id = %s AND status = 'sending'
+        ''', (broadcast_id,))
+        count = cursor.rowcount
+        cursor.execute('UPDATE broadcasts SET unknown = unknown + %s WHERE id = %s', (count, broadcast_id))
+        cursor.close()
+        return count
+    return db.pool.run(query)
+
+
+def claim_chunk(broadcast_id, after_user_id):
+    """Следующая порция получателей после чекпоинта.
+
+    Возвращает (все user_id порции, захваченные этим процессом). Уже
+    записанные в журнал получатели не захватываются — повторной отправки нет.
+    """
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT DISTINCT user_id FROM leads
+            WHERE user_id > %s ORDER BY user_id LIMIT %s
+        ''', (after_user_id, BROADCAST_CHUNK_SIZE))
+        user_ids = [row[0] for row in cursor.fetchall()]
+        claimed = []
+        if user_ids:
+            cursor.execute('''
+                INSERT INTO broadcast_deliveries (broadcast_id, user_id)
+                SELECT %s, unnest(%s::bigint[])
+                ON CONFLICT DO NOTHING
+                RETURNING user_id
+            ''', (broadcast_id, user_ids))
+            claimed = sorted(row[0] for row in cursor.fetchall())
+        cursor.close()
+        return user_ids, claimed
+    return db.pool.run(query)
+
+
+def save_chunk(broadcast_id, results, released, checkpoint):
+    """Итоги порции одной транзакцией: статусы доставки, счётчики и чекпоинт.
+
+    released — захваченные, но не начатые отправки (остановка посреди порции):
+    их захват снимается, чтобы после возобновления они ушли.
+    """
+    def query(conn):
+        cursor = conn.cursor()
+        if results:
+            db.execute_values(cursor, '''
+                UPDATE broadcast_deliveries AS d
+                SET status = v.status, error = v.error, updated_at = CURRENT_TIMESTAMP
+                FROM (VALUES %s) AS v (broadcast_id, user_id, status, error)
+                WHERE d.broadcast_id = v.broadcast_id AND d.user_id = v.user_id
+            ''', [(broadcast_id, uid, status, error) for uid, (status, error) in results.items()],
+                template='(%s, %s::bigint, %s, %s)', page_size=len(results))
+        if released:
+            cursor.execute(
+                'DELETE FROM broadcast_deliveries WHERE broadcast_id = %s AND user_id = ANY(%s)',
+                (broadcast_id, released)
+            )
+        counts = {'delivered': 0, 'blocked': 0, 'failed': 0}
+        for status, _ in results.values():
+            counts[status] += 1
+        cursor.execute('''
+            UPDATE broadcasts SET
+                delivered = delivered + %s, blocked = blocked + %s, failed = failed + %s,
+                last_user_id = GREATEST(last_user_id, %s)
+            WHERE id = %s
+        ''', (counts['delivered'], counts['blocked'], counts['failed'], checkpoint, broadcast_id))
+        cursor.close()
+    db.pool.run(query)
+
+
+# ===== ОТПРАВКА =====
+class BroadcastRunner:
+    """Рассылка одного сообщения всем user_id из leads порциями с чекпоинтами.
+
+    on_finish(broadcast) получает итог — завершённую ('done') или прерванную
+    ошибкой ('failed') рассылку. Счётчики ведутся и в памяти: отчёт о сбое
+    не зависит от БД, которая могла его вызвать.
+    """
+
+    def __init__(self, bot, broadcast, on_finish=None):
+        self.bot = bot
+        self.broadcast = dict(broadcast)
+        self.id = broadcast['id']
+        self.text = broadcast['text']
+        self.checkpoint = broadcast['last_user_id']
+        self.on_finish = on_finish
+        self.task = None
+        self._stopping = False
+
+    def start(self):
+        self.task = asyncio.create_task(self._run(), name=f'broadcast_{self.id}')
+        return self.task
+
+    async def stop(self):
+        """Новые отправки не начинаются, начатые дожидаются ответа Telegram:
+        оборванный запрос мог дойти, и его пришлось бы считать неизвестным"""
+        if self.task is None or self.task.done():
+            return
+        self._stopping = True
+        try:
+            await asyncio.wait_for(asyncio.shield(self.task), BROADCAST_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _retrying(self, fn, *args):
+        """Шаг рассылки в БД с повторами: временный сбой не обрывает рассылку"""
+        for attempt in range(BROADCAST_RETRIES + 1):
+            try:
+                return await db.call(fn, *args)
+            except Exception as e:
+                if attempt == BROADCAST_RETRIES:
+                    raise
+                delay = min(BROADCAST_RETRY_BASE * 2 ** attempt, BROADCAST_RETRY_MAX)
+                logger.warning(f"⚠️ Рассылка #{self.id}: сбой БД, повтор через {delay:.0f} с: {e}")
+                await asyncio.sleep(delay)
+
+    async def _deliver(self, user_id):
+        try:
+            await self.bot.send_message(chat_id=user_id, text=self.text, rate_limit_args={'lane': 'bulk'})
+            return 'delivered', None
+        except Forbidden as e:
+            return 'blocked', str(e)
+        except BadRequest as e:
+            # Пользователь удалил аккаунт или никогда не писал боту
+            if 'chat not found' in str(e).lower():
+                return 'blocked', str(e)
+            return 'failed', str(e)
+        except TelegramError as e:
+            return 'failed', str(e)
+
+    async def _send_chunk(self, user_ids, claimed):
+        results = {}
+        started = set()
+        semaphore = asyncio.Semaphore(BROADCAST_WORKERS)
+
+        async def send(user_id):
+            async with semaphore:
+                if self._stopping:
+                    return
+                started.add(user_id)
+                results[user_id] = await self._deliver(user_id)
+
+        completed = False
+        try:
+            await asyncio.gather(*(send(user_id) for user_id in claimed))
+            completed = not self._stopping
+        finally:
+            # Чекпоинт двигается только за полностью обработанную порцию
+            released = [user_id for user_id in claimed if user_id not in started]
+            checkpoint = user_ids[-1] if completed else self.checkpoint
+            # Отправленное не повторяется: при сбое сохранения повторяется только запись итогов
+            await self._retrying(save_chunk, self.id, results, released, checkpoint)
+            self.checkpoint = checkpoint
+            for status, _ in results.values():
+                self.broadcast[status] += 1
+
+    async def _run(self):
+        logger.info(f"📣 Рассылка #{self.id} запущена с user_id > {self.checkpoint}")
+        try:
+            while True:
+                user_ids, claimed = await self._retrying(claim_chunk, self.id, self.checkpoint)
+                if not user_ids:
+                    break
+                await self._send_chunk(user_ids, claimed)
+                if self._stopping:
+                    logger.info(f"⏸️ Рассылка #{self.id} остановлена на user_id {self.checkpoint}")
+                    return
+        except asyncio.CancelledError:
+            logger.info(f"⏸️ Рассылка #{self.id} остановлена на user_id {self.checkpoint}")
+            raise
+        except Exception as e:
+            logger.error(f"❌ Рассылка #{self.id} прервана на user_id {self.checkpoint}: {e}")
+            await self._finish('failed')
+            return
+        await self._finish('done')
+        logger.info(f"✅ Рассылка #{self.id} завершена")
+
+    async def _finish(self, status):
+        """Итоговый статус и отчёт. Статус 'failed' не ставится, если БД всё ещё
+        недоступна: тогда рассылка останется 'running' и продолжится после рестарта"""
+        self.broadcast['status'] = status
+        try:
+            await self._retrying(set_status, self.id, status, ('running',))
+        except Exception as e:
+            logger.error(f"❌ Рассылка #{self.id}: статус {status} не сохранён: {e}")
+            if status == 'failed':
+                self.broadcast['status'] = 'running'
+        if self.on_finish is not None:
+            try:
+                await self.on_finish(dict(self.broadcast))
+            except Exception as e:
+                logger.error(f"❌ Отчёт о рассылке #{self.id} не отправлен: {e}")
+
+
+runner = None
+
+
+async def start_broadcast(bot, broadcast_id, on_finish=None):
+    """Запуск (или продолжение после рестарта) рассылки в фоне"""
+    global runner
+    if runner is not None and runner.task is not None and not runner.task.done():
+        return False
+    broadcast = await db.call(get_broadcast, broadcast_id)
+    runner = BroadcastRunner(bot, broadcast, on_finish)
+    runner.start()
+    return True
+
+
+async def resume_failed(bot, on_finish=None):
+    """Продолжение последней рассылки, прерванной ошибкой, с её чекпоинта.
+    Возвращает рассылку или None, если продолжать нечего"""
+    current = await db.call(get_broadcast)
+    if current is None or current['status'] != 'failed':
+        return None
+    if not await db.call(set_status, current['id'], 'running', ('failed',)):
+        return None
+    # Отправки последней порции, итоги которой не удалось записать, повторно не уходят
+    await db.call(mark_unknown, current['id'])
+    if not await start_broadcast(bot, current['id'], on_finish):
+        await db.call(set_status, current['id'], 'failed', ('running',))
+        return None
+    return current
+
+
+async def resume_broadcasts(bot, on_finish=None):
+    """Продолжение рассылки, прерванной рестартом или редеплоем"""
+    for broadcast_id in await db.call(running_broadcasts):
+        lost = await db.call(mark_unknown, broadcast_id)
+        if lost:
+            logger.warning(f"⚠️ Рассылка #{broadcast_id}: {lost} отправок прервано сбоем, повторно не отправляются")
+        await start_broadcast(bot, broadcast_id, on_finish)
+        return
+
+
+async def stop_broadcast():
+    """Остановка при выключении бота: статус остаётся 'running', после старта рассылка продолжится"""
+    if runner is not None:
+        await runner.stop()
@@ -0,0 +1,336 @@
+import os
+import sys
+import time
+import fcntl
+import signal
+import asyncio
+import logging
+import secrets
+
+import aiohttp
+from aiohttp import web
+from telegram import Bot, Update
+
+import db
+import api
+import metrics
+import server
+
+# ===== НАСТРОЙКИ КЛАСТЕРА =====
+# Число процессов-обработчиков; 1 — прежний режим одним процессом
+WORKERS = max(1, int(os.environ.get('WORKERS', 1)))
+# Номер обработчика; выставляет диспетчер при запуске, у диспетчера и одиночного бота пусто
+WORKER_INDEX = int(os.environ['WORKER_INDEX']) if os.environ.get('WORKER_INDEX') else None
+# Внутренние порты обработчиков: CLUSTER_BASE_PORT + номер, только на 127.0.0.1
+CLUSTER_BASE_PORT = int(os.environ.get('CLUSTER_BASE_PORT', 9100))
+# Секрет внутренних запросов диспетчер → обработчик; по умолчанию новый на каждый запуск
+CLUSTER_SECRET = os.environ.get('CLUSTER_SECRET') or secrets.token_urlsafe(32)
+# Сколько апдейтов одного обработчика пересылается одним запросом
+CLUSTER_BATCH_SIZE = int(os.environ.get('CLUSTER_BATCH_SIZE', 100))
+# Пауза перед перезапуском упавшего обработчика (удваивается до минуты)
+CLUSTER_RESTART_DELAY = float(os.environ.get('CLUSTER_RESTART_DELAY', 1))
+# Ключ advisory-блокировки шардов в PostgreSQL: (ключ, номер обработчика)
+SHARD_LOCK_KEY = 0x454C50
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(key, workers=WORKERS):
+    """Номер обработчика для чата: все апдейты одного чата попадают в один процесс"""
+    return int(key) % workers if key is not None else 0
+
+
+def owns(chat_id):
+    """Обрабатывает ли этот процесс чат; в режиме одного процесса — всегда.
+
+    Процесс, которому достался чат админа, выполняет и общие для кластера
+    обязанности: очередь писем, рассылку, обслуживание журнала активности.
+    """
+    return WORKER_INDEX is None or shard_of(chat_id) == WORKER_INDEX
+
+
+# ===== БЛОКИРОВКА ШАРДА =====
+_shard_lock = None
+
+
+def acquire_shard_lock():
+    """Один процесс на шард: при редеплое новый обработчик ждёт, пока старый
+    с тем же номером завершится, и только потом читает состояние диалогов.
+
+    Блокировка держится до конца процесса: в PostgreSQL — отдельным
+    соединением вне пула, без БД — flock на файл рядом с хранилищем состояния.
+    """
+    global _shard_lock
+    if WORKER_INDEX is None:
+        return
+    started = time.monotonic()
+    if db.pool is not None:
+        db.load_driver()
+        conn = db.psycopg2.connect(
+            db.DATABASE_URL, connect_timeout=db.DB_CONNECT_TIMEOUT,
+            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+        )
+        conn.autocommit = True
+        cursor = conn.cursor()
+        while True:
+            cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', (SHARD_LOCK_KEY, WORKER_INDEX))
+            if cursor.fetchone()[0]:
+                break
+            if time.monotonic() - started < 1:
+                logger.info(f"⏳ Шард {WORKER_INDEX} занят другим процессом, ждём")
+            time.sleep(1)
+        _shard_lock = conn
+    else:
+        from persistence import STATE_DB_PATH
+        lock_file = open(f'{STATE_DB_PATH}.shard-{WORKER_INDEX}.lock', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info(f"⏳ Шард {WORKER_INDEX} занят другим процессом, ждём")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        _shard_lock = lock_file
+    logger.info(f"🔒 Шард {WORKER_INDEX}/{WORKERS} за процессом {os.getpid()} ({time.monotonic() - started:.2f} с)")
+
+
+# ===== ДИСПЕТЧЕР =====
+class WorkerProcess:
+    """Процесс-обработчик: запуск, перезапуск при падении и упорядоченная пересылка"""
+
+    def __init__(self, index, env):
+        self.index = index
+        self.port = CLUSTER_BASE_PORT + index
+        self.env = dict(env, WORKER_INDEX=str(index), PORT=str(self.port))
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.queue = asyncio.Queue()
+        self.process = None
+        self.stats = {'forwarded': 0, 'batches': 0, 'retries': 0, 'restarts': 0}
+        self._stopping = False
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def supervise(self):
+        delay = CLUSTER_RESTART_DELAY
+        while not self._stopping:
+            started = time.monotonic()
+            self.process = await asyncio.create_subprocess_exec(sys.executable, APP_PATH, env=self.env)
+            logger.info(f"🧩 Обработчик {self.index} запущен (pid {self.process.pid}, порт {self.port})")
+            code = await self.process.wait()
+            if self._stopping:
+                return
+            delay = CLUSTER_RESTART_DELAY if time.monotonic() - started > 60 else min(delay * 2, 60)
+            self.stats['restarts'] += 1
+            logger.error(f"❌ Обработчик {self.index} завершился с кодом {code}, перезапуск через {delay:.0f} с")
+            await asyncio.sleep(delay)
+
+    async def forward(self, session):
+        """Пересылка пачками строго по порядку: следующая пачка — только после
+        подтверждения предыдущей, поэтому апдейты чата не обгоняют друг друга"""
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < CLUSTER_BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            while True:
+                try:
+                    async with session.post(
+                        f'{self.url}/internal/updates', json=batch,
+                        headers={'X-Cluster-Secret': CLUSTER_SECRET}
+                    ) as response:
+                        if response.status == 200:
+                            break
+                        logger.warning(f"⚠️ Обработчик {self.index} ответил {response.status}")
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    # Обработчик ещё стартует или перезапускается — апдейты ждут в очереди
+                    pass
+                self.stats['retries'] += 1
+                await asyncio.sleep(0.5)
+            self.stats['forwarded'] += len(batch)
+            self.stats['batches'] += 1
+
+    async def load(self, session):
+        """Нагрузка обработчика из его /health"""
+        report = {'worker': self.index, 'alive': self.alive, 'pending': self.queue.qsize(), **self.stats}
+        if self.process is not None:
+            report['pid'] = self.process.pid
+        try:
+            async with session.get(f'{self.url}/health', timeout=aiohttp.ClientTimeout(total=1)) as response:
+                health = await response.json()
+            report.update(
+                status=health['status'], update_queue=health['update_queue'],
+                in_flight=health['in_flight'], updates_received=health['updates_received']
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError):
+            report['status'] = 'unreachable'
+        return report
+
+    async def stop(self, timeout=30):
+        self._stopping = True
+        if not self.alive:
+            return
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"❌ Обработчик {self.index} не остановился за {timeout} с, завершаем принудительно")
+            self.process.kill()
+            await self.process.wait()
+
+
+class Dispatcher:
+    """Приём апдейтов (webhook или long polling) и раздача по обработчикам по chat_id"""
+
+    def __init__(self, token, base_url=None, workers=WORKERS):
+        kwargs = {'base_url': base_url} if base_url else {}
+        self.bot = Bot(token, **kwargs)
+        self.received = 0
+        env = dict(os.environ)
+        for name in ('WEBHOOK_URL', 'RENDER_EXTERNAL_URL'):
+            env.pop(name, None)
+        # Общий лимит Telegram (~30 сообщений/с на бота) делится между процессами
+        for name, default in (('TELEGRAM_GLOBAL_RATE', 30), ('TELEGRAM_GLOBAL_BURST', 30)):
+            env[name] = str(float(os.environ.get(name, default)) / workers)
+        env.update(WORKERS=str(workers), CLUSTER_SECRET=CLUSTER_SECRET, HTTP_HOST='127.0.0.1')
+        self.workers = [WorkerProcess(index, env) for index in range(workers)]
+        self.web = web.Application()
+        self.web.router.add_get('/', self.handle_health)
+        self.web.router.add_get('/health', self.handle_health)
+        self.web.router.add_get('/metrics', self.handle_metrics)
+        if server.WEBHOOK_URL:
+            self.web.router.add_post(server.WEBHOOK_PATH, self.handle_webhook)
+        if api.enabled():
+            self.web.router.add_get('/api/{tail:.*}', self.handle_api)
+        self._api_requests = 0
+        self._session = None
+        self._runner = None
+        metrics.register_collector('cluster', 'Диспетчер обработчиков', self.cluster_stats)
+
+    def route(self, update):
+        key = server.update_chat_key(update)
+        self.workers[shard_of(key, len(self.workers))].queue.put_nowait(update.to_dict())
+        self.received += 1
+
+    # ----- HTTP -----
+    async def handle_webhook(self, request):
+        if not server.check_webhook_secret(request):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        self.route(Update.de_json(data, self.bot))
+        return web.Response()
+
+    async def handle_health(self, request):
+        loads = await asyncio.gather(*(worker.load(self._session) for worker in self.workers))
+        return web.json_response({
+            'status': 'ok' if all(load['status'] == 'ok' for load in loads) else 'degraded',
+            'mode': 'cluster',
+            'updates_received': self.received,
+            'workers': loads,
+        })
+
+    async def handle_metrics(self, request):
+        return await server.metrics_response(request)
+
+    async def handle_api(self, request):
+        """API заявок отвечает обработчик (у диспетчера нет БД): запросы по очереди
+        уходят живым обработчикам, сжатие — на стороне диспетчера"""
+        alive = [worker for worker in self.workers if worker.alive]
+        if not alive:
+            return web.json_response({'error': 'unavailable'}, status=503)
+        worker = alive[self._api_requests % len(alive)]
+        self._api_requests += 1
+        headers = {
+            name: request.headers[name] for name in ('Authorization', 'If-None-Match') if name in request.headers
+        }
+        # Обработчик отвечает без сжатия: кодировку под клиента выбирает диспетчер
+        headers['Accept-Encoding'] = 'identity'
+        try:
+            async with self._session.get(f'{worker.url}{request.path_qs}', headers=headers) as upstream:
+                body = await upstream.read()
+                response = web.Response(status=upstream.status, body=body if upstream.status != 304 else None)
+                for name in ('Content-Type', 'ETag', 'Cache-Control', 'Vary', 'WWW-Authenticate'):
+                    if name in upstream.headers:
+                        response.headers[name] = upstream.headers[name]
+        except aiohttp.ClientError as e:
+            logger.error(f"❌ Обработчик {worker.index} не ответил на запрос API: {e}")
+            return web.json_response({'error': 'unavailable'}, status=503)
+        if len(body) >= api.LEADS_API_GZIP_MIN:
+            response.enable_compression()
+        return response
+
+    def cluster_stats(self):
+        stats = {'received': self.received, 'workers_alive': sum(worker.alive for worker in self.workers)}
+        for worker in self.workers:
+            stats[f'worker{worker.index}_pending'] = worker.queue.qsize()
+            for key, value in worker.stats.items():
+                stats[f'worker{worker.index}_{key}'] = value
+        return stats
+
+    # ----- приём апдейтов -----
+    async def poll(self):
+        await self.bot.delete_webhook()
+        offset = None
+        while True:
+            try:
+                updates = await self.bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except Exception as e:
+                logger.error(f"❌ Ошибка getUpdates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                self.route(update)
+                offset = update.update_id + 1
+
+    async def run(self):
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                pass
+
+        await self.bot.initialize()
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        tasks = [asyncio.create_task(worker.supervise()) for worker in self.workers]
+        tasks += [asyncio.create_task(worker.forward(self._session)) for worker in self.workers]
+        port = int(server.HTTP_PORT or 8080)
+        self._runner = web.AppRunner(self.web, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, server.HTTP_HOST, port).start()
+        logger.info(f"🌐 Диспетчер слушает {server.HTTP_HOST}:{port}, обработчиков: {len(self.workers)}")
+
+        if server.WEBHOOK_URL:
+            await self.bot.set_webhook(
+                url=server.WEBHOOK_URL.rstrip('/') + server.WEBHOOK_PATH,
+                secret_token=server.WEBHOOK_SECRET,
+                max_connections=server.WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            tasks.append(asyncio.create_task(self.poll()))
+        try:
+            await stop_event.wait()
+        finally:
+            await self.shutdown(tasks)
+
+    async def shutdown(self, tasks):
+        logger.info("🛑 Остановка кластера")
+        await self._runner.cleanup()
+        # Даём обработчикам дополучить уже принятые апдейты
+        deadline = time.monotonic() + 10
+        while any(w.queue.qsize() and w.alive for w in self.workers) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._session.close()
+        await self.bot.shutdown()
+
+
+async def run_dispatcher(token, base_url=None):
+    await Dispatcher(token, base_url).run()
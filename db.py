@@ -0,0 +1,299 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import breaker
+
+# ===== НАСТРОЙКИ ПУЛА =====
+DATABASE_URL = os.environ.get('DATABASE_URL')
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 5))
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 5))
+# Соединение, простоявшее дольше этого времени, проверяется SELECT 1 перед выдачей
+DB_HEALTHCHECK_INTERVAL = float(os.environ.get('DB_HEALTHCHECK_INTERVAL', 30))
+# Сколько ждать свободное соединение, прежде чем вернуть ошибку
+DB_ACQUIRE_TIMEOUT = float(os.environ.get('DB_ACQUIRE_TIMEOUT', 10))
+# Предел выполнения одного запроса на сервере (statement_timeout), 0 — без предела:
+# зависший запрос не держит поток пула бесконечно
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 60000))
+
+logger = logging.getLogger(__name__)
+
+# psycopg2 загружается при открытии пула, а не при импорте: без DATABASE_URL
+# драйвер не нужен вовсе, а с ним — не задерживает импорт бота
+psycopg2 = None
+pg_pool = None
+# Ошибки, после которых соединение считается оборванным (заполняется вместе с драйвером)
+DISCONNECT_ERRORS = ()
+# Запрос отменён по statement_timeout: это тоже OperationalError, но соединение цело
+QUERY_TIMEOUT_ERRORS = ()
+
+
+def load_driver():
+    global psycopg2, pg_pool, DISCONNECT_ERRORS, QUERY_TIMEOUT_ERRORS
+    if psycopg2 is None:
+        import psycopg2.pool
+        import psycopg2.errors
+        pg_pool = psycopg2.pool
+        DISCONNECT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+        QUERY_TIMEOUT_ERRORS = (psycopg2.errors.QueryCanceled,)
+
+
+# Ключ advisory-блокировки DDL: несколько процессов кластера (cluster.py)
+# стартуют одновременно, а параллельные CREATE ... IF NOT EXISTS конфликтуют
+SCHEMA_LOCK_KEY = 0x454C5001
+
+
+def schema_lock(cursor):
+    """Сериализация создания схемы между процессами до конца транзакции"""
+    cursor.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_LOCK_KEY,))
+
+
+def execute_values(cursor, sql, argslist, **kwargs):
+    """psycopg2.extras.execute_values; к этому моменту драйвер уже загружен пулом"""
+    from psycopg2.extras import execute_values as run
+    return run(cursor, sql, argslist, **kwargs)
+
+
+class PoolTimeout(Exception):
+    """Нет свободного соединения в пуле"""
+
+
+class DatabasePool:
+    """Общий пул соединений PostgreSQL с проверкой здоровья и переподключением.
+
+    Все обращения к БД выполняются в отдельном пуле потоков размером с пул
+    соединений, поэтому event loop бота никогда не блокируется на сети.
+    """
+
+    def __init__(self, dsn, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self._pool = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+        self._executor = ThreadPoolExecutor(max_workers=maxconn, thread_name_prefix='db')
+        self.breaker = breaker.get('db')
+        self._stats = {
+            'checkouts': 0,
+            'in_use': 0,
+            'waiting': 0,
+            'healthchecks': 0,
+            'reconnects': 0,
+            'errors': 0,
+            'timeouts': 0,
+            'wait_seconds_total': 0.0,
+        }
+
+    # ----- жизненный цикл -----
+    def open(self):
+        """Создание пула (повторный вызов ничего не делает)"""
+        with self._lock:
+            if self._pool is not None:
+                return
+            load_driver()
+            timeout = DB_STATEMENT_TIMEOUT_MS
+            self._pool = pg_pool.ThreadedConnectionPool(
+                self.minconn, self.maxconn, self.dsn,
+                connect_timeout=DB_CONNECT_TIMEOUT,
+                options=f'-c statement_timeout={timeout}' if timeout > 0 else None,
+                keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+            )
+            logger.info(f"✅ Пул PostgreSQL создан ({self.minconn}-{self.maxconn} соединений)")
+
+    def close(self):
+        """Закрытие всех соединений и пула потоков"""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+        self._executor.shutdown(wait=False)
+
+    @property
+    def opened(self):
+        return self._pool is not None
+
+    def _bump(self, key, delta=1):
+        with self._stats_lock:
+            self._stats[key] += delta
+
+    # ----- выдача соединений -----
+    def _acquire(self):
+        started = time.monotonic()
+        self._bump('waiting')
+        try:
+            if not self._slots.acquire(timeout=DB_ACQUIRE_TIMEOUT):
+                self._bump('timeouts')
+                raise PoolTimeout(f"нет свободного соединения за {DB_ACQUIRE_TIMEOUT} с")
+        finally:
+            self._bump('waiting', -1)
+            self._bump('wait_seconds_total', time.monotonic() - started)
+
+        try:
+            if self._pool is None:
+                self.open()
+            conn = self._pool.getconn()
+            if self._needs_healthcheck(conn):
+                conn = self._healthcheck(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+        self._bump('checkouts')
+        self._bump('in_use')
+        return conn
+
+    def _release(self, conn, broken=False):
+        self._last_used[id(conn)] = time.monotonic()
+        try:
+            if broken or conn.closed:
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+            else:
+                self._pool.putconn(conn)
+        finally:
+            self._bump('in_use', -1)
+            self._slots.release()
+
+    def _needs_healthcheck(self, conn):
+        if conn.closed:
+            return True
+        last_used = self._last_used.get(id(conn))
+        return last_used is None or time.monotonic() - last_used > DB_HEALTHCHECK_INTERVAL
+
+    def _healthcheck(self, conn):
+        """SELECT 1 на простаивавшем соединении, при обрыве — новое соединение"""
+        self._bump('healthchecks')
+        try:
+            if conn.closed:
+                raise psycopg2.InterfaceError('connection already closed')
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return conn
+        except DISCONNECT_ERRORS as e:
+            logger.warning(f"⚠️ Соединение с БД оборвано, переподключаемся: {e}")
+            self._bump('reconnects')
+            self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+            return self._pool.getconn()
+
+    @contextmanager
+    def connection(self):
+        """Соединение из пула; транзакция фиксируется при успешном выходе.
+
+        При разомкнутом предохранителе сразу CircuitOpenError: недоступная БД
+        не держит каждый запрос до таймаута соединения. Сбоем БД считаются
+        обрывы и нехватка соединений, а не ошибки самих запросов.
+        """
+        self.breaker.check()
+        try:
+            conn = self._acquire()
+        except (PoolTimeout,) + DISCONNECT_ERRORS:
+            self.breaker.failure()
+            raise
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except QUERY_TIMEOUT_ERRORS:
+            # Сервер не успел выполнить запрос — для предохранителя это сбой
+            self._bump('errors')
+            conn.rollback()
+            self.breaker.failure()
+            raise
+        except DISCONNECT_ERRORS:
+            broken = True
+            self._bump('errors')
+            self.breaker.failure()
+            raise
+        except Exception:
+            self._bump('errors')
+            if not conn.closed:
+                conn.rollback()
+            # Ошибка запроса — значит, сервер отвечает
+            self.breaker.success()
+            raise
+        else:
+            self.breaker.success()
+        finally:
+            self._release(conn, broken=broken)
+
+    def run(self, fn, *args):
+        """Синхронный вызов fn(conn, *args) с одним повтором при оборванном соединении"""
+        with metrics.track_dependency('db', fn.__qualname__.replace('.<locals>', '')):
+            try:
+                with self.connection() as conn:
+                    return fn(conn, *args)
+            except QUERY_TIMEOUT_ERRORS:
+                # Повтор запроса, не уложившегося в statement_timeout, только удвоит ожидание
+                raise
+            except DISCONNECT_ERRORS as e:
+                logger.warning(f"⚠️ Повтор запроса после обрыва соединения: {e}")
+                self._bump('reconnects')
+                with self.connection() as conn:
+                    return fn(conn, *args)
+
+    async def call(self, fn, *args):
+        """Выполнение синхронной функции в пуле потоков БД, не блокируя event loop.
+
+        Разомкнутый предохранитель отклоняет вызов ещё в event loop: иначе
+        вызовы ждали бы в очереди за потоками, зависшими на недоступной БД.
+        """
+        self.breaker.fail_fast()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def stats(self):
+        """Метрики пула для /stats и мониторинга"""
+        stats = dict(self._stats)
+        stats['size'] = len(self._pool._pool) + len(self._pool._used) if self._pool else 0
+        stats['idle'] = len(self._pool._pool) if self._pool else 0
+        stats['min'] = self.minconn
+        stats['max'] = self.maxconn
+        return stats
+
+
+pool = DatabasePool(DATABASE_URL) if DATABASE_URL else None
+
+
+def init_pool():
+    """Создание пула при старте; при недоступной БД пул откроется при первом запросе"""
+    if pool is None:
+        return
+    try:
+        pool.open()
+    except Exception as e:
+        logger.error(f"❌ Не удалось открыть пул БД, повторим при первом запросе: {e}")
+
+
+def close_pool():
+    if pool is not None:
+        pool.close()
+
+
+async def call(fn, *args):
+    """Запуск fn(*args) вне event loop (в потоках пула БД или в стандартном executor)"""
+    if pool is not None:
+        return await pool.call(fn, *args)
+    return await call_local(fn, *args)
+
+
+async def call_local(fn, *args):
+    """Запуск fn(*args) в стандартном executor — для локальных хранилищ (SQLite),
+    которые должны работать и при разомкнутом предохранителе БД"""
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+def pool_stats():
+    if pool is None:
+        return None
+    return pool.stats()
@@ -0,0 +1,246 @@
+import os
+import logging
+from datetime import datetime, timedelta, timezone
+
+import db
+
+# ===== НАСТРОЙКИ АНАЛИТИКИ ВОРОНКИ =====
+# Час сворачивается, когда после его конца прошло столько секунд: события
+# пишутся в БД пачками с задержкой (activity.ACTIVITY_FLUSH_INTERVAL)
+FUNNEL_ROLLUP_DELAY = float(os.environ.get('FUNNEL_ROLLUP_DELAY', 300))
+# Сколько часов сворачивать за один запуск — первый запуск на большой истории не растягивается
+FUNNEL_ROLLUP_MAX_HOURS = int(os.environ.get('FUNNEL_ROLLUP_MAX_HOURS', 24 * 7))
+# Переход засчитывается, если предыдущий шаг был не раньше стольких часов назад
+FUNNEL_STEP_WINDOW_HOURS = int(os.environ.get('FUNNEL_STEP_WINDOW_HOURS', 24))
+# Раздел базы знаний «привёл» к заявке, если его смотрели за столько дней до неё
+FUNNEL_ATTRIBUTION_DAYS = int(os.environ.get('FUNNEL_ATTRIBUTION_DAYS', 7))
+
+# Шаги по порядку: handle_menu('start_request') или намерение «заявка» в тексте,
+# select_area, select_term, get_contact, confirm_request
+FUNNEL_STEPS = ['request', 'area', 'term', 'name', 'confirm']
+STEP_SQL = '''
+    CASE
+        WHEN action = 'menu' AND details = 'start_request' THEN 'request'
+        WHEN action = 'intent' AND details = 'request' THEN 'request'
+        WHEN action = 'funnel_area' THEN 'area'
+        WHEN action = 'funnel_term' THEN 'term'
+        WHEN action = 'funnel_name' THEN 'name'
+        WHEN action = 'funnel_confirm' THEN 'confirm'
+    END
+'''
+STEP_ACTIONS = ('menu', 'intent', 'funnel_area', 'funnel_term', 'funnel_name', 'funnel_confirm')
+# Время шага хранится гистограммой: медиана складывается из часов, а сырые времена — нет.
+# Четыре корзины на удвоение — точность медианы около 10%
+BUCKETS_PER_DOUBLING = 4
+
+logger = logging.getLogger(__name__)
+
+
+def init_funnel_tables(cursor):
+    """Часовые сводки воронки: пользователи на шагах и разделах, гистограммы времени шагов"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS funnel_hourly (
+            hour TIMESTAMP,
+            step VARCHAR(20),
+            section VARCHAR(50),
+            users INTEGER NOT NULL,
+            events INTEGER NOT NULL,
+            PRIMARY KEY (hour, step, section)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS funnel_step_time (
+            hour TIMESTAMP,
+            step VARCHAR(20),
+            bucket SMALLINT,
+            transitions INTEGER NOT NULL,
+            PRIMARY KEY (hour, step, bucket)
+        )
+    ''')
+
+
+def _utc_hour():
+    return datetime.now(timezone.utc).replace(tzinfo=None, minute=0, second=0, microsecond=0)
+
+
+# ===== СВОРАЧИВАНИЕ =====
+def _rollup_steps(cursor, start, end):
+    """Пользователи на каждом шаге по часам; section пустой"""
+    cursor.execute(f'''
+        INSERT INTO funnel_hourly (hour, step, section, users, events)
+        SELECT date_trunc('hour', created_at), step, '', COUNT(DISTINCT user_id), COUNT(*)
+        FROM (
+            SELECT user_id, created_at, {STEP_SQL} AS step
+            FROM user_activity
+            WHERE created_at >= %s AND created_at < %s AND action IN %s
+        ) events
+        WHERE step IS NOT NULL
+        GROUP BY 1, 2
+    ''', (start, end, STEP_ACTIONS))
+
+
+def _rollup_sections(cursor, start, end, sections):
+    """Просмотры разделов базы знаний и заявки, перед которыми раздел смотрели"""
+    cursor.execute('''
+        INSERT INTO funnel_hourly (hour, step, section, users, events)
+        SELECT date_trunc('hour', created_at), 'knowledge', details, COUNT(DISTINCT user_id), COUNT(*)
+        FROM user_activity
+        WHERE created_at >= %s AND created_at < %s AND action IN ('menu', 'intent') AND details = ANY(%s)
+        GROUP BY 1, 3
+    ''', (start, end, sections))
+    cursor.execute('''
+        INSERT INTO funnel_hourly (hour, step, section, users, events)
+        SELECT date_trunc('hour', c.created_at), 'knowledge_lead', v.details, COUNT(DISTINCT c.user_id), COUNT(*)
+        FROM user_activity c
+        CROSS JOIN LATERAL (
+            SELECT DISTINCT details FROM user_activity v
+            WHERE v.user_id = c.user_id AND v.action IN ('menu', 'intent') AND v.details = ANY(%s)
+                AND v.created_at >= c.created_at - %s AND v.created_at < c.created_at
+        ) v
+        WHERE c.created_at >= %s AND c.created_at < %s AND c.action = 'funnel_confirm'
+        GROUP BY 1, 3
+    ''', (sections, timedelta(days=FUNNEL_ATTRIBUTION_DAYS), start, end))
+
+
+def _rollup_step_time(cursor, start, end):
+    """Гистограммы времени от предыдущего шага до текущего, по часу текущего.
+
+    Один проход окном по событиям пользователя: для каждого шага берётся
+    последнее предшествующее событие предыдущего шага.
+    """
+    window = timedelta(hours=FUNNEL_STEP_WINDOW_HOURS)
+    previous = [
+        f"WHEN '{step}' THEN MAX(CASE WHEN step = '{prev}' THEN created_at END) OVER w"
+        for prev, step in zip(FUNNEL_STEPS, FUNNEL_STEPS[1:])
+    ]
+    cursor.execute(f'''
+        INSERT INTO funnel_step_time (hour, step, bucket, transitions)
+        SELECT date_trunc('hour', created_at), step,
+            floor({BUCKETS_PER_DOUBLING} * ln(greatest(extract(epoch FROM created_at - previous_at), 1)) / ln(2)),
+            COUNT(*)
+        FROM (
+            SELECT created_at, step, CASE step {' '.join(previous)} END AS previous_at
+            FROM (
+                SELECT user_id, created_at, {STEP_SQL} AS step
+                FROM user_activity
+                WHERE created_at >= %s AND created_at < %s AND action IN %s
+            ) events
+            WHERE step IS NOT NULL
+            WINDOW w AS (PARTITION BY user_id ORDER BY created_at ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING)
+        ) transitions
+        WHERE created_at >= %s AND previous_at > created_at - %s
+        GROUP BY 1, 2, 3
+    ''', (start - window, end, STEP_ACTIONS, start, window))
+
+
+def rollup(cursor, sections):
+    """Сворачивание завершённых часов с прошлой отметки. Возвращает
+    (свёрнуто часов, момент, до которого всё свёрнуто).
+
+    Часы пересчитываются целиком (DELETE + INSERT), поэтому повторный
+    запуск после сбоя ничего не удваивает.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    ready = (now - timedelta(seconds=FUNNEL_ROLLUP_DELAY)).replace(minute=0, second=0, microsecond=0)
+    cursor.execute("SELECT rolled_until FROM activity_rollup_state WHERE name = 'funnel_hourly'")
+    row = cursor.fetchone()
+    if row is not None:
+        start = row[0]
+    else:
+        cursor.execute('SELECT MIN(created_at) FROM user_activity')
+        oldest = cursor.fetchone()[0]
+        start = oldest.replace(minute=0, second=0, microsecond=0) if oldest is not None else ready
+    end = min(ready, start + timedelta(hours=FUNNEL_ROLLUP_MAX_HOURS))
+    if start >= end:
+        return 0, start
+    for table in ('funnel_hourly', 'funnel_step_time'):
+        cursor.execute(f'DELETE FROM {table} WHERE hour >= %s AND hour < %s', (start, end))
+    _rollup_steps(cursor, start, end)
+    _rollup_sections(cursor, start, end, list(sections))
+    _rollup_step_time(cursor, start, end)
+    cursor.execute('''
+        INSERT INTO activity_rollup_state (name, rolled_until) VALUES ('funnel_hourly', %s)
+        ON CONFLICT (name) DO UPDATE SET rolled_until = EXCLUDED.rolled_until
+    ''', (end,))
+    return int((end - start).total_seconds() // 3600), end
+
+
+# ===== ОТЧЁТ =====
+def _median(histogram):
+    """Медиана по гистограмме {корзина: переходов} — середина корзины, секунды"""
+    total = sum(histogram.values())
+    if not total:
+        return None
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen * 2 >= total:
+            return 2 ** ((bucket + 0.5) / BUCKETS_PER_DOUBLING)
+
+
+def fetch_report(period='day', count=7):
+    """Воронка за последние count дней или недель (UTC) — только из часовых сводок.
+
+    Пользователь считается один раз в час: сумма по часам — это число
+    входов в шаг, а не уникальных пользователей за период.
+    """
+    this_hour = _utc_hour()
+    if period == 'week':
+        first = this_hour.date() - timedelta(days=this_hour.weekday() + 7 * (count - 1))
+    else:
+        first = this_hour.date() - timedelta(days=count - 1)
+    since = datetime.combine(first, datetime.min.time())
+
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute("SELECT rolled_until FROM activity_rollup_state WHERE name = 'funnel_hourly'")
+        row = cursor.fetchone()
+        cursor.execute('''
+            SELECT date_trunc(%s, hour)::date, step, section, SUM(users)
+            FROM funnel_hourly WHERE hour >= %s
+            GROUP BY 1, 2, 3
+        ''', (period, since))
+        counts = cursor.fetchall()
+        cursor.execute('''
+            SELECT date_trunc(%s, hour)::date, step, bucket, SUM(transitions)
+            FROM funnel_step_time WHERE hour >= %s
+            GROUP BY 1, 2, 3
+        ''', (period, since))
+        times = cursor.fetchall()
+        cursor.close()
+        return row, counts, times
+
+    row, counts, times = db.pool.run(query)
+
+    periods = {}
+    total = {'steps': {}, 'times': {}}
+    sections = {}
+
+    def slot(start):
+        return periods.setdefault(start, {'start': start, 'steps': {}, 'times': {}})
+
+    for start, step, section, users in counts:
+        if step == 'knowledge' or step == 'knowledge_lead':
+            views, leads = sections.get(section, (0, 0))
+            sections[section] = (views + users, leads) if step == 'knowledge' else (views, leads + users)
+            continue
+        for target in (slot(start), total):
+            target['steps'][step] = target['steps'].get(step, 0) + users
+    for start, step, bucket, transitions in times:
+        for target in (slot(start), total):
+            histogram = target['times'].setdefault(step, {})
+            histogram[bucket] = histogram.get(bucket, 0) + transitions
+
+    for target in list(periods.values()) + [total]:
+        target['medians'] = {step: _median(histogram) for step, histogram in target.pop('times').items()}
+    return {
+        'period': period,
+        'since': first,
+        'rolled_until': row[0] if row else None,
+        'periods': [periods[start] for start in sorted(periods, reverse=True)],
+        'total': total,
+        'sections': sorted(
+            ((section, views, leads) for section, (views, leads) in sections.items()),
+            key=lambda item: (-item[2], -item[1])
+        ),
+    }
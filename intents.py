@@ -0,0 +1,82 @@
+import re
+
+# ===== ИНДЕКС НАМЕРЕНИЙ =====
+# Все ключевые слова собраны в одно регулярное выражение: текст просматривается
+# один раз, а не по разу на каждое слово. Ключи — основы слов (русские и
+# английские) и начинаются с границы слова, чтобы «hi» не находилось в «this».
+# Приоритет решает, что ответить, если совпало несколько тем:
+# «привет, сколько стоит аренда?» — это вопрос о цене, а не приветствие.
+INTENTS = (
+    # (намерение, приоритет, основы слов — фрагменты regex)
+    ('request', 100, (
+        r'заявк', r'оформ', r'арендова', r'снять\b', r'забронир',
+        r'request', r'apply', r'book\b',
+    )),
+    ('price', 90, (
+        r'стоим', r'стоит', r'цен[аыуе]', r'расцен', r'прайс', r'тариф', r'сколько\b',
+        r'тенге', r'opex', r'опекс', r'price', r'cost', r'rate\b', r'rent\b',
+    )),
+    ('area', 80, (
+        r'площад', r'метраж', r'квадрат', r'кв\.? ?м', r'м²', r'м2\b', r'корпус',
+        r'area\b', r'size\b', r'sqm\b', r'square',
+    )),
+    ('specs', 70, (
+        r'характеристик', r'техническ', r'высот', r'нагрузк', r'колонн', r'док[иао]в?\b',
+        r'пожар', r'класс[а ]', r'spec', r'ceiling', r'height', r'dock',
+    )),
+    ('location', 60, (
+        r'располож', r'местонахожд', r'местоположен', r'адрес', r'где\b', r'локаци',
+        r'добрат', r'доехат', r'проезд', r'координат', r'карт[аеуы]\b', r'бакад',
+        r'location', r'address', r'where\b',
+    )),
+    ('timeline', 50, (
+        r'срок', r'когда\b', r'этап', r'сдач', r'ввод', r'готовност',
+        r'timeline', r'deadline', r'when\b',
+    )),
+    ('broker', 45, (
+        r'брокер', r'агент', r'bright rich', r'corfac', r'broker', r'agent',
+    )),
+    ('infrastructure', 40, (
+        r'инфраструктур', r'абк', r'абч', r'офис', r'парковк', r'стоянк', r'душ',
+        r'санузл', r'infrastructure', r'parking', r'office',
+    )),
+    ('developer', 35, (
+        r'девелопер', r'застройщик', r'инвестор', r'developer',
+    )),
+    ('contact', 30, (
+        r'контакт', r'директор', r'связат', r'связь', r'телефон', r'почт', r'e-?mail',
+        r'менеджер', r'contact', r'phone', r'manager',
+    )),
+    ('about', 20, (
+        r'elp\b', r'елп\b', r'логистическ', r'о компании', r'about',
+    )),
+    ('thanks', 15, (
+        r'спасиб', r'благодар', r'thank', r'thx\b',
+    )),
+    ('greeting', 10, (
+        r'привет', r'здравств', r'добрый', r'доброе', r'салем', r'салам',
+        r'hello', r'hi\b', r'hey\b',
+    )),
+)
+
+INTENT_PRIORITY = {name: priority for name, priority, _ in INTENTS}
+
+# Каждое намерение — именованная группа; match.lastgroup сразу даёт его имя
+INTENT_PATTERN = re.compile(r'(?<!\w)(?:' + '|'.join(
+    f"(?P<{name}>{'|'.join(stems)})"
+    for name, _, stems in INTENTS
+) + ')')
+
+
+def find_intents(text):
+    """Все найденные намерения по убыванию приоритета (при равенстве — по порядку в тексте)"""
+    found = {}
+    for match in INTENT_PATTERN.finditer(text.lower()):
+        found.setdefault(match.lastgroup, match.start())
+    return sorted(found, key=lambda name: (-INTENT_PRIORITY[name], found[name]))
+
+
+def detect_intent(text):
+    """Главное намерение сообщения или None"""
+    intents = find_intents(text)
+    return intents[0] if intents else None
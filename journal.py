@@ -0,0 +1,359 @@
+import os
+import json
+import uuid
+import asyncio
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import leads
+import breaker
+
+# ===== НАСТРОЙКИ ЖУРНАЛА ЗАЯВОК =====
+# Локальный журнал: заявка попадает сюда (с fsync) до ответа пользователю
+LEADS_JOURNAL_PATH = os.environ.get('LEADS_JOURNAL_PATH', 'leads.journal')
+# Как часто пытаться догрузить в PostgreSQL заявки, которые не удалось сохранить сразу
+JOURNAL_REPLAY_INTERVAL = float(os.environ.get('JOURNAL_REPLAY_INTERVAL', 30))
+JOURNAL_REPLAY_BATCH = int(os.environ.get('JOURNAL_REPLAY_BATCH', 500))
+# Журнал переписывается без загруженных заявок, когда вырастает больше этого
+JOURNAL_COMPACT_BYTES = int(os.environ.get('JOURNAL_COMPACT_BYTES', 1024 * 1024))
+# Без БД журнал — единственная копия заявок: хранится столько последних,
+# более старые вытесняются (админ о них уже уведомлён)
+JOURNAL_MAX_PENDING = int(os.environ.get('JOURNAL_MAX_PENDING', 10000))
+
+logger = logging.getLogger(__name__)
+
+
+class LeadJournal:
+    """Append-only журнал заявок в JSON Lines.
+
+    Запись 'lead' — заявка с uuid, записью 'done' отмечается её сохранение
+    в PostgreSQL, записью 'notified' — уведомление админа о ней. Заявки без
+    'done' после рестарта снова ждут загрузки, а без 'notified' — уведомления.
+    Записи, пришедшие одновременно, пишутся одним write + fsync (групповая
+    фиксация), поэтому всплеск заявок не упирается в число fsync в секунду.
+
+    max_pending — предел хранимых заявок для работы без БД, где их некуда загрузить.
+    """
+
+    def __init__(self, path, max_pending=None):
+        self.path = path
+        self.max_pending = max_pending
+        self.pending = {}
+        self.in_flight = set()
+        self.failed = set()
+        self.notified = set()
+        # Готовые строки 'lead' незагруженных заявок: из них собирается сжатый журнал
+        self._lines = {}
+        self._live_bytes = 0
+        self._size = 0
+        self._file = None
+        self._queue = []
+        self._writer = None
+        # Один поток: записи в файл идут строго по очереди
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+        self.stats = {'appended': 0, 'fsyncs': 0, 'saved': 0, 'replayed': 0, 'compactions': 0, 'evicted': 0}
+
+    # ----- файл -----
+    def open(self):
+        """Чтение журнала: заявки без отметки о сохранении возвращаются в очередь"""
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for number, line in enumerate(f, 1):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Оборванная последняя строка — запись не была подтверждена fsync
+                        logger.warning(f"⚠️ Журнал заявок: строка {number} повреждена и пропущена")
+                        continue
+                    if record['op'] == 'lead':
+                        self.pending[record['uuid']] = record['lead']
+                        self._lines[record['uuid']] = line.rstrip(b'\n') + b'\n'
+                    elif record['op'] == 'notified':
+                        if record['uuid'] in self.pending:
+                            self.notified.add(record['uuid'])
+                    elif record['op'] == 'done':
+                        self._forget(record['uuid'])
+        self._file = open(self.path, 'ab')
+        self._size = self._file.tell()
+        self._live_bytes = sum(len(line) for line in self._lines.values())
+        if self.pending:
+            logger.warning(f"⚠️ В журнале заявок {len(self.pending)} не загруженных в БД")
+
+    def _write(self, lines):
+        self._file.write(b''.join(lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.stats['fsyncs'] += 1
+
+    def _compact(self, keep):
+        """Журнал заново из строк keep: новый файл с fsync подменяет старый атомарно"""
+        data = b''.join(keep)
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self._file.close()
+        self._file = open(self.path, 'ab')
+        self.stats['compactions'] += 1
+        return len(data)
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        while self._queue:
+            batch, self._queue = self._queue, []
+            lines = [line for line, _ in batch]
+            try:
+                await loop.run_in_executor(self._executor, self._write, lines)
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи журнала заявок: {e}")
+                for _, future in batch:
+                    if future is not None and not future.done():
+                        future.set_exception(e)
+                continue
+            self._size += sum(len(line) for line in lines)
+            for _, future in batch:
+                if future is not None and not future.done():
+                    future.set_result(None)
+            # В файле нужны только записи незагруженных заявок (и отметки об уведомлении).
+            # Новые заявки попадают в pending до постановки в очередь, поэтому журнал
+            # сжимается, лишь когда очередь пуста: иначе их строки записались бы дважды
+            if not self._queue and self._size > max(JOURNAL_COMPACT_BYTES, 2 * self._live_bytes):
+                keep = list(self._lines.values()) + [
+                    self._line({'op': 'notified', 'uuid': lead_uuid}) for lead_uuid in self.notified
+                ]
+                self._size = await loop.run_in_executor(self._executor, self._compact, keep)
+
+    @staticmethod
+    def _line(record):
+        return json.dumps(record, ensure_ascii=False, default=str).encode('utf-8') + b'\n'
+
+    def _enqueue(self, record, wait):
+        line = record if isinstance(record, bytes) else self._line(record)
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self._queue.append((line, future))
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._flush(), name='journal_writer')
+        return future
+
+    # ----- заявки -----
+    async def append(self, lead):
+        """Запись заявки на диск; возвращает после fsync. Проставляет lead['uuid']"""
+        lead.setdefault('uuid', str(uuid.uuid4()))
+        lead.setdefault('submitted_at', datetime.now().isoformat())
+        line = self._line({'op': 'lead', 'uuid': lead['uuid'], 'lead': lead})
+        self.pending[lead['uuid']] = dict(lead)
+        self._lines[lead['uuid']] = line
+        self._live_bytes += len(line)
+        self.in_flight.add(lead['uuid'])
+        self.stats['appended'] += 1
+        if self.max_pending is not None and len(self.pending) > self.max_pending:
+            self._evict()
+        await self._enqueue(line, wait=True)
+
+    def _forget(self, lead_uuid):
+        self.notified.discard(lead_uuid)
+        line = self._lines.pop(lead_uuid, None)
+        if line is not None:
+            self._live_bytes -= len(line)
+        return self.pending.pop(lead_uuid, None)
+
+    def _evict(self):
+        """Без БД: самые старые заявки вне обработки выходят из журнала"""
+        excess = len(self.pending) - self.max_pending
+        for lead_uuid in [u for u in self.pending if u not in self.in_flight][:excess]:
+            self._forget(lead_uuid)
+            self._enqueue({'op': 'done', 'uuid': lead_uuid, 'lead_id': None}, wait=False)
+            if not self.stats['evicted']:
+                logger.warning(f"⚠️ Журнал заявок без БД достиг {self.max_pending} заявок, старые вытесняются")
+            self.stats['evicted'] += 1
+
+    def release(self, lead_uuid):
+        """Прямое сохранение закончено (успешно или нет) — дальше заявкой занимается replayer"""
+        self.in_flight.discard(lead_uuid)
+
+    def mark_done(self, lead_uuid, lead_id):
+        """Заявка в PostgreSQL. Без fsync: потеря этой записи приведёт лишь
+        к повторной загрузке, а она идемпотентна по uuid"""
+        self.in_flight.discard(lead_uuid)
+        if self._forget(lead_uuid) is not None:
+            self._enqueue({'op': 'done', 'uuid': lead_uuid, 'lead_id': lead_id}, wait=False)
+
+    def mark_notified(self, lead_uuid):
+        """Админ уведомлён. Без fsync: потеря записи приведёт лишь к повторному уведомлению"""
+        if lead_uuid in self.pending and lead_uuid not in self.notified:
+            self.notified.add(lead_uuid)
+            self._enqueue({'op': 'notified', 'uuid': lead_uuid}, wait=False)
+
+    def unannounced(self):
+        """Восстановленные из журнала заявки, о которых админ не уведомлён"""
+        return [
+            lead for lead_uuid, lead in self.pending.items()
+            if lead_uuid not in self.notified and lead_uuid not in self.in_flight
+        ]
+
+    def replayable(self, limit):
+        return [
+            lead for lead_uuid, lead in self.pending.items()
+            if lead_uuid not in self.in_flight and lead_uuid not in self.failed
+        ][:limit]
+
+    async def close(self):
+        if self._writer is not None:
+            await self._writer
+        if self._file is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._file.close)
+            self._file = None
+        self._executor.shutdown(wait=False)
+
+
+# ===== ДОГРУЗКА В БД =====
+class JournalReplayer:
+    """Фоновая загрузка заявок из журнала в PostgreSQL порциями.
+
+    on_replayed(results, unannounced): results — {uuid: (id, новая_ли)},
+    unannounced — [(заявка, id)] новых заявок, о которых админ ещё не знает
+    (процесс упал после ответа пользователю, но до уведомления).
+    """
+
+    def __init__(self, journal, on_replayed=None):
+        self.journal = journal
+        self.on_replayed = on_replayed
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name='journal_replayer')
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _replay_batch(self, batch):
+        try:
+            return await db.call(leads.replay_leads, batch)
+        except db.DISCONNECT_ERRORS + (db.PoolTimeout, breaker.CircuitOpenError):
+            raise
+        except Exception as e:
+            if len(batch) == 1:
+                # Заявка, которую БД не принимает, не должна держать остальные;
+                # в журнале она остаётся и будет загружена после рестарта
+                self.journal.failed.add(batch[0]['uuid'])
+                logger.error(f"❌ Заявка {batch[0]['uuid']} из журнала не загружена: {e}")
+                return {}
+            results = {}
+            for lead in batch:
+                results.update(await self._replay_batch([lead]))
+            return results
+
+    async def _run(self):
+        while True:
+            batch = self.journal.replayable(JOURNAL_REPLAY_BATCH)
+            if batch:
+                try:
+                    results = await self._replay_batch(batch)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning(f"⚠️ БД недоступна, {len(self.journal.pending)} заявок ждут в журнале: {e}")
+                    results = None
+                if results:
+                    unannounced = [
+                        (self.journal.pending[lead_uuid], lead_id)
+                        for lead_uuid, (lead_id, created) in results.items()
+                        if created and lead_uuid in self.journal.pending and lead_uuid not in self.journal.notified
+                    ]
+                    for lead_uuid, (lead_id, _) in results.items():
+                        self.journal.mark_done(lead_uuid, lead_id)
+                    self.journal.stats['replayed'] += len(results)
+                    logger.info(f"✅ Из журнала загружено заявок: {len(results)}")
+                    if self.on_replayed is not None:
+                        self.on_replayed(results, unannounced)
+                    if len(batch) == JOURNAL_REPLAY_BATCH:
+                        continue
+            await asyncio.sleep(JOURNAL_REPLAY_INTERVAL)
+
+
+journal = None
+replayer = None
+
+
+def journal_path():
+    """У каждого обработчика кластера свой журнал"""
+    index = os.environ.get('WORKER_INDEX')
+    return LEADS_JOURNAL_PATH if index is None else f'{LEADS_JOURNAL_PATH}.{index}'
+
+
+def open_journal():
+    """Журнал ведётся и без БД: тогда он — единственная копия заявок на диске"""
+    global journal
+    journal = LeadJournal(journal_path(), max_pending=JOURNAL_MAX_PENDING if db.pool is None else None)
+    try:
+        journal.open()
+    except Exception as e:
+        logger.error(f"❌ Ошибка открытия журнала заявок: {e}")
+        journal = None
+
+
+def start_replayer(on_replayed=None):
+    """Догрузка в БД; без БД — только уведомление о заявках, оставшихся без него после сбоя"""
+    global replayer
+    if journal is None:
+        return
+    if db.pool is None:
+        unannounced = [(lead, None) for lead in journal.unannounced()]
+        if unannounced and on_replayed is not None:
+            on_replayed({}, unannounced)
+        return
+    replayer = JournalReplayer(journal, on_replayed)
+    replayer.start()
+
+
+async def close_journal():
+    if replayer is not None:
+        await replayer.stop()
+    if journal is not None:
+        await journal.close()
+
+
+async def append(lead):
+    """Заявка в журнал до подтверждения; без журнала — только uuid"""
+    if journal is None:
+        lead.setdefault('uuid', str(uuid.uuid4()))
+        return
+    await journal.append(lead)
+
+
+def settle(lead, lead_id):
+    """Итог прямого сохранения: с id — заявка в БД, без — ждёт replayer (без БД — остаётся в журнале)"""
+    if journal is None:
+        return
+    if lead_id is None:
+        journal.release(lead['uuid'])
+    else:
+        journal.stats['saved'] += 1
+        journal.mark_done(lead['uuid'], lead_id)
+
+
+def mark_notified(lead):
+    if journal is not None:
+        journal.mark_notified(lead['uuid'])
+
+
+def journal_stats():
+    if journal is None:
+        return None
+    return dict(journal.stats, pending=len(journal.pending), failed=len(journal.failed))
@@ -0,0 +1,405 @@
+import os
+import re
+import csv
+import gzip
+import hashlib
+import logging
+from datetime import datetime
+
+import db
+
+# ===== НАСТРОЙКИ ВЫГРУЗОК =====
+LEADS_PAGE_SIZE = int(os.environ.get('LEADS_PAGE_SIZE', 10))
+# Сколько строк серверный курсор отдаёт за один сетевой запрос
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 2000))
+# Bot API не принимает от бота файлы больше 50 МБ
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+# Повторная заявка с тем же контактом в пределах окна (от последней подачи)
+# объединяется с предыдущей, 0 — не объединять
+LEAD_DEDUP_WINDOW_HOURS = float(os.environ.get('LEAD_DEDUP_WINDOW_HOURS', 72))
+# Код страны для номеров без него (8 701 ... и 701 ...)
+DEFAULT_PHONE_COUNTRY = os.environ.get('DEFAULT_PHONE_COUNTRY', '7')
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+EXPORT_COLUMNS = (
+    'id', 'created_at', 'status', 'name', 'contact', 'contact_type',
+    'area', 'term', 'username', 'user_id', 'notes', 'updated_at', 'submissions'
+)
+
+logger = logging.getLogger(__name__)
+
+
+# ===== ДЕДУПЛИКАЦИЯ =====
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+def normalize_phone(value):
+    """Номер в E.164 (+77011234567) или None, если цифр слишком мало/много"""
+    digits = re.sub(r'\D', '', value)
+    if not value.strip().startswith('+'):
+        if len(digits) == 11 and digits.startswith('8') and DEFAULT_PHONE_COUNTRY == '7':
+            digits = '7' + digits[1:]
+        elif len(digits) == 10:
+            digits = DEFAULT_PHONE_COUNTRY + digits
+    return '+' + digits if 8 <= len(digits) <= 15 else None
+
+
+def normalize_contact(contact):
+    """Контакт в каноническом виде: email в нижнем регистре, телефон в E.164.
+
+    Тип определяется по самому значению (в поле «email» часто присылают
+    телефон и наоборот); нераспознанное сравнивается без регистра и пробелов.
+    """
+    value = (contact or '').strip()
+    if EMAIL_RE.match(value):
+        return value.lower()
+    phone = normalize_phone(value) if re.search(r'\d', value) else None
+    if phone is not None and not re.search(r'[^\d\s()+\-.]', value):
+        return phone
+    return re.sub(r'\s+', '', value.lower()) or None
+
+
+def contact_hash(contact):
+    """Ключ поиска дублей: sha256 нормализованного контакта (сам контакт в индекс не попадает)"""
+    normalized = normalize_contact(contact)
+    if normalized is None:
+        return None
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def init_dedup_columns(cursor):
+    """Колонки дедупликации и заполнение их для заявок, сохранённых раньше"""
+    cursor.execute('ALTER TABLE leads ADD COLUMN IF NOT EXISTS contact_hash VARCHAR(64)')
+    cursor.execute('ALTER TABLE leads ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP')
+    cursor.execute('ALTER TABLE leads ADD COLUMN IF NOT EXISTS submissions INTEGER DEFAULT 1')
+    cursor.execute('ALTER TABLE leads ALTER COLUMN updated_at SET DEFAULT CURRENT_TIMESTAMP')
+    cursor.execute('UPDATE leads SET updated_at = created_at WHERE updated_at IS NULL')
+    cursor.execute('UPDATE leads SET submissions = 1 WHERE submissions IS NULL')
+    # Окно дедупликации считается от последней подачи, а не от updated_at:
+    # тот сдвигается при любом изменении строки (лента изменений, init_change_feed)
+    cursor.execute('ALTER TABLE leads ADD COLUMN IF NOT EXISTS last_submitted_at TIMESTAMP')
+    cursor.execute('ALTER TABLE leads ALTER COLUMN last_submitted_at SET DEFAULT CURRENT_TIMESTAMP')
+    cursor.execute('SELECT 1 FROM leads WHERE last_submitted_at IS NULL LIMIT 1')
+    if cursor.fetchone() is not None:
+        # Заполнение без триггеров: иначе все старые заявки разом попали бы в ленту изменений
+        cursor.execute('ALTER TABLE leads DISABLE TRIGGER USER')
+        cursor.execute('UPDATE leads SET last_submitted_at = COALESCE(updated_at, created_at) WHERE last_submitted_at IS NULL')
+        cursor.execute('ALTER TABLE leads ENABLE TRIGGER USER')
+
+    cursor.execute('SELECT id, contact FROM leads WHERE contact_hash IS NULL AND contact IS NOT NULL')
+    rows = [(lead_id, contact_hash(contact)) for lead_id, contact in cursor.fetchall()]
+    rows = [row for row in rows if row[1] is not None]
+    if rows:
+        db.execute_values(cursor, '''
+            UPDATE leads SET contact_hash = v.contact_hash
+            FROM (VALUES %s) AS v (id, contact_hash)
+            WHERE leads.id = v.id
+        ''', rows, page_size=1000)
+        logger.info(f"✅ Ключи дедупликации проставлены для {len(rows)} заявок")
+
+    # Поиск последней заявки с тем же контактом — одно чтение по индексу
+    cursor.execute('CREATE INDEX IF NOT EXISTS leads_contact_submitted_idx ON leads (contact_hash, last_submitted_at)')
+    cursor.execute('DROP INDEX IF EXISTS leads_contact_hash_idx')
+
+
+def init_change_feed(cursor):
+    """Ключ ленты изменений (updated_at, id): любое изменение строки сдвигает updated_at"""
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION leads_touch_updated_at() RETURNS trigger AS $$
+        BEGIN
+            -- Явно выставленный updated_at (слияние повторной заявки) не трогаем
+            IF NEW IS DISTINCT FROM OLD AND NEW.updated_at IS NOT DISTINCT FROM OLD.updated_at THEN
+                NEW.updated_at := CURRENT_TIMESTAMP;
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    cursor.execute('DROP TRIGGER IF EXISTS leads_touch_updated_at ON leads')
+    cursor.execute('''
+        CREATE TRIGGER leads_touch_updated_at
+        BEFORE UPDATE ON leads
+        FOR EACH ROW EXECUTE FUNCTION leads_touch_updated_at()
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS leads_updated_id_idx ON leads (updated_at, id)')
+
+
+def init_submissions_table(cursor):
+    """Принятые подачи по uuid из журнала заявок: повторная загрузка ничего не задваивает"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lead_submissions (
+            uuid UUID PRIMARY KEY,
+            lead_id INTEGER,
+            loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Создала ли подача новую заявку: повторная загрузка после сбоя должна знать,
+    # уведомлять ли админа
+    cursor.execute('ALTER TABLE lead_submissions ADD COLUMN IF NOT EXISTS created BOOLEAN')
+
+
+def _upsert_lead(conn, lead_data, key):
+    """Вставка заявки или слияние с предыдущей за один запрос к серверу.
+
+    Оба оператора уходят одной посылкой: advisory-блокировка по ключу
+    сериализует одновременные заявки с одним контактом (иначе обе не увидят
+    друг друга и вставятся), а следующий оператор получает свежий снимок уже
+    после неё. Возвращает (id, создана_ли_новая_заявка).
+    """
+    cursor = conn.cursor()
+    params = {
+        'key': key,
+        'window': LEAD_DEDUP_WINDOW_HOURS,
+        'user_id': lead_data['user_id'],
+        'username': lead_data.get('username', ''),
+        'name': lead_data['name'],
+        'contact': lead_data['contact'],
+        'contact_type': lead_data['contact_type'],
+        'area': lead_data['area'],
+        'term': lead_data['term'],
+        'submitted_at': lead_data.get('submitted_at'),
+    }
+    cursor.execute('''
+        SELECT pg_advisory_xact_lock(hashtext(%(key)s));
+        WITH existing AS (
+            SELECT id FROM leads
+            WHERE %(window)s > 0 AND contact_hash = %(key)s
+                AND last_submitted_at > CURRENT_TIMESTAMP - make_interval(secs => %(window)s * 3600)
+            ORDER BY last_submitted_at DESC
+            LIMIT 1
+            FOR UPDATE
+        ), merged AS (
+            UPDATE leads SET
+                username = %(username)s, name = %(name)s,
+                contact = %(contact)s, contact_type = %(contact_type)s,
+                area = %(area)s, term = %(term)s,
+                updated_at = CURRENT_TIMESTAMP, submissions = leads.submissions + 1,
+                last_submitted_at = GREATEST(leads.last_submitted_at, COALESCE(%(submitted_at)s::timestamp, CURRENT_TIMESTAMP))
+            FROM existing WHERE leads.id = existing.id
+            RETURNING leads.id
+        ), inserted AS (
+            INSERT INTO leads (user_id, username, name, contact, contact_type, area, term, status, contact_hash,
+                created_at, last_submitted_at)
+            SELECT %(user_id)s, %(username)s, %(name)s, %(contact)s, %(contact_type)s, %(area)s, %(term)s, 'new', %(key)s,
+                COALESCE(%(submitted_at)s::timestamp, CURRENT_TIMESTAMP), COALESCE(%(submitted_at)s::timestamp, CURRENT_TIMESTAMP)
+            WHERE NOT EXISTS (SELECT 1 FROM existing)
+            RETURNING id
+        )
+        SELECT id, FALSE FROM merged
+        UNION ALL
+        SELECT id, TRUE FROM inserted
+    ''', params)
+    lead_id, created = cursor.fetchone()
+    cursor.close()
+    return lead_id, created
+
+
+def _insert_lead(conn, lead_data):
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO leads (user_id, username, name, contact, contact_type, area, term, status, created_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, COALESCE(%s::timestamp, CURRENT_TIMESTAMP))
+        RETURNING id
+    ''', (
+        lead_data['user_id'],
+        lead_data.get('username', ''),
+        lead_data['name'],
+        lead_data['contact'],
+        lead_data['contact_type'],
+        lead_data['area'],
+        lead_data['term'],
+        'new',
+        lead_data.get('submitted_at')
+    ))
+    lead_id = cursor.fetchone()[0]
+    cursor.close()
+    return lead_id, True
+
+
+def _save_lead(conn, lead_data):
+    key = contact_hash(lead_data.get('contact'))
+    if key is None:
+        # Без контакта сравнивать не по чему — обычная вставка
+        return _insert_lead(conn, lead_data)
+    return _upsert_lead(conn, lead_data, key)
+
+
+def _save_submission(conn, lead_data):
+    """Заявка с uuid из журнала сохраняется ровно один раз.
+
+    Захват uuid и сама заявка — одна транзакция. Одновременная попытка с тем
+    же uuid ждёт на первичном ключе до её фиксации и получает уже готовый id.
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        'INSERT INTO lead_submissions (uuid) VALUES (%s) ON CONFLICT DO NOTHING',
+        (lead_data['uuid'],)
+    )
+    if not cursor.rowcount:
+        cursor.execute('SELECT lead_id FROM lead_submissions WHERE uuid = %s', (lead_data['uuid'],))
+        lead_id = cursor.fetchone()[0]
+        cursor.close()
+        return lead_id, False
+    lead_id, created = _save_lead(conn, lead_data)
+    cursor.execute(
+        'UPDATE lead_submissions SET lead_id = %s, created = %s WHERE uuid = %s',
+        (lead_id, created, lead_data['uuid'])
+    )
+    cursor.close()
+    return lead_id, created
+
+
+def upsert_lead(lead_data):
+    """Сохранение заявки с объединением повторов. Возвращает (id, новая_ли)"""
+    if lead_data.get('uuid'):
+        return db.pool.run(_save_submission, lead_data)
+    return db.pool.run(_save_lead, lead_data)
+
+
+def _replay_leads(conn, batch):
+    cursor = conn.cursor()
+    uuids = [lead_data['uuid'] for lead_data in batch]
+    # Все uuid порции захватываются одним запросом; уже загруженные не захватятся
+    cursor.execute('''
+        INSERT INTO lead_submissions (uuid) SELECT unnest(%s::uuid[])
+        ON CONFLICT DO NOTHING
+        RETURNING uuid
+    ''', (uuids,))
+    claimed = {str(row[0]) for row in cursor.fetchall()}
+    results = {}
+    for lead_data in batch:
+        if lead_data['uuid'] in claimed:
+            results[lead_data['uuid']] = _save_lead(conn, lead_data)
+    if results:
+        db.execute_values(cursor, '''
+            UPDATE lead_submissions SET lead_id = v.lead_id, created = v.created
+            FROM (VALUES %s) AS v (uuid, lead_id, created)
+            WHERE lead_submissions.uuid = v.uuid
+        ''', [(uuid, lead_id, created) for uuid, (lead_id, created) in results.items()],
+            template='(%s::uuid, %s, %s)', page_size=len(results))
+    loaded = [uuid for uuid in uuids if uuid not in claimed]
+    if loaded:
+        cursor.execute(
+            'SELECT uuid, lead_id, COALESCE(created, FALSE) FROM lead_submissions WHERE uuid = ANY(%s::uuid[])',
+            (loaded,)
+        )
+        for uuid, lead_id, created in cursor.fetchall():
+            results[str(uuid)] = (lead_id, created)
+    cursor.close()
+    return results
+
+
+def replay_leads(batch):
+    """Загрузка порции заявок из журнала одной транзакцией.
+
+    Возвращает {uuid: (id, новая_ли)}; для заявок, загруженных раньше (до сбоя),
+    новая_ли — сохранённый итог той загрузки.
+    """
+    return db.pool.run(_replay_leads, batch)
+
+
+# ===== ПОСТРАНИЧНЫЙ ПРОСМОТР =====
+def encode_cursor(row, field='created_at'):
+    """Позиция (created_at, id) строки для callback_data (лимит Telegram — 64 байта)"""
+    return f"{row[field].strftime(CURSOR_FORMAT)}:{row['id']}"
+
+
+def decode_cursor(value):
+    created_at, lead_id = value.split(':')
+    return datetime.strptime(created_at, CURSOR_FORMAT), int(lead_id)
+
+
+def fetch_leads_page(cursor=None, direction='older', limit=LEADS_PAGE_SIZE):
+    """Страница заявок от новых к старым по ключу (created_at, id).
+
+    direction='older' — строки строго после курсора, 'newer' — строго перед ним.
+    Возвращает (строки, есть_ли_ещё_в_этом_направлении).
+    """
+    def query(conn):
+        sql = 'SELECT id, created_at, status, name, contact, contact_type, area, term FROM leads'
+        params = []
+        if cursor is not None:
+            sql += ' WHERE (created_at, id) < (%s, %s)' if direction == 'older' else ' WHERE (created_at, id) > (%s, %s)'
+            params.extend(cursor)
+        sql += ' ORDER BY created_at DESC, id DESC' if direction == 'older' else ' ORDER BY created_at ASC, id ASC'
+        sql += ' LIMIT %s'
+        params.append(limit + 1)
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        columns = [c.name for c in cur.description]
+        rows = [dict(zip(columns, r)) for r in cur.fetchall()]
+        cur.close()
+        return rows
+
+    rows = db.pool.run(query)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'newer':
+        rows.reverse()
+    return rows, has_more
+
+
+# ===== ЛЕНТА ИЗМЕНЕНИЙ =====
+def fetch_lead_changes(position=None, limit=100, settle=0):
+    """Заявки, изменённые после позиции (updated_at, id), по возрастанию ключа.
+
+    Изменения моложе settle секунд не отдаются: транзакция, начатая раньше,
+    могла ещё не зафиксироваться, и её строка появилась бы позади курсора.
+    Возвращает (строки, есть_ли_ещё).
+    """
+    def query(conn):
+        sql = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM leads WHERE updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)"
+        params = [settle]
+        if position is not None:
+            sql += ' AND (updated_at, id) > (%s, %s)'
+            params.extend(position)
+        sql += ' ORDER BY updated_at, id LIMIT %s'
+        params.append(limit + 1)
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        rows = [dict(zip(EXPORT_COLUMNS, r)) for r in cur.fetchall()]
+        cur.close()
+        return rows
+
+    rows = db.pool.run(query)
+    return rows[:limit], len(rows) > limit
+
+
+def fetch_lead(lead_id):
+    def query(conn):
+        cur = conn.cursor()
+        cur.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM leads WHERE id = %s", (lead_id,))
+        row = cur.fetchone()
+        cur.close()
+        return dict(zip(EXPORT_COLUMNS, row)) if row else None
+
+    return db.pool.run(query)
+
+
+# ===== ЭКСПОРТ =====
+def export_leads_csv(path, compress=False):
+    """Потоковая выгрузка всей таблицы leads в CSV через серверный курсор.
+
+    В памяти одновременно держится не больше EXPORT_FETCH_SIZE строк, поэтому
+    расход памяти не зависит от размера таблицы. Возвращает число строк.
+    """
+    opener = gzip.open if compress else open
+
+    def dump(conn):
+        count = 0
+        # utf-8-sig — чтобы Excel правильно открыл кириллицу
+        with opener(path, 'wt', encoding='utf-8-sig', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_COLUMNS)
+            cur = conn.cursor(name='leads_export')
+            cur.itersize = EXPORT_FETCH_SIZE
+            cur.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM leads ORDER BY id")
+            for row in cur:
+                writer.writerow(row)
+                count += 1
+            cur.close()
+        return count
+
+    count = db.pool.run(dump)
+    logger.info(f"✅ Выгружено заявок: {count} ({os.path.getsize(path)} байт)")
+    return count
@@ -0,0 +1,198 @@
+import os
+import time
+import bisect
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+
+from telegram.request import HTTPXRequest
+
+import startup
+
+# ===== НАСТРОЙКИ МЕТРИК =====
+# Если задан, /metrics требует заголовок «Authorization: Bearer <токен>»
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Границы корзин гистограмм, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger(__name__)
+
+
+# ===== ТИПЫ МЕТРИК =====
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+# Замеры идут и из event loop, и из потоков пула БД / SMTP, поэтому под блокировкой
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labels, labels)} {value}'
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [счётчики по корзинам (не накопительные), сумма, количество]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            snapshot = {labels: (list(s[0]), s[1], s[2]) for labels, s in self._series.items()}
+        names = self.labels + ('le',)
+        for labels, (counts, total, count) in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield f'{self.name}_bucket{_format_labels(names, labels + (bound,))} {cumulative}'
+            yield f'{self.name}_bucket{_format_labels(names, labels + ("+Inf",))} {count}'
+            yield f'{self.name}_sum{_format_labels(self.labels, labels)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labels, labels)} {count}'
+
+
+# ===== РЕЕСТР =====
+_metrics = []
+_collectors = []
+
+
+def _register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def register_collector(prefix, documentation, fn):
+    """Показатели, которые снимаются в момент запроса /metrics.
+
+    fn() -> {ключ: число} или None; каждый ключ становится метрикой elp_<prefix>_<ключ>.
+    """
+    _collectors.append((f'elp_{prefix}', documentation, fn))
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus (version 0.0.4)"""
+    lines = []
+    for metric in _metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    for prefix, documentation, fn in _collectors:
+        try:
+            values = fn()
+        except Exception as e:
+            logger.error(f"❌ Ошибка сбора метрик {prefix}: {e}")
+            continue
+        for key, value in (values or {}).items():
+            if isinstance(value, (int, float)):
+                lines.append(f'# HELP {prefix}_{key} {documentation}: {key}')
+                lines.append(f'# TYPE {prefix}_{key} gauge')
+                lines.append(f'{prefix}_{key} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+HANDLER_DURATION = _register(Histogram(
+    'elp_handler_duration_seconds', 'Время обработки апдейта обработчиком', ('handler',)))
+HANDLER_CALLS = _register(Counter(
+    'elp_handler_calls_total', 'Вызовы обработчиков по исходу', ('handler', 'outcome')))
+HANDLER_IN_FLIGHT = _register(Gauge(
+    'elp_handler_in_flight', 'Апдейты, которые обрабатываются прямо сейчас', ('handler',)))
+DEPENDENCY_DURATION = _register(Histogram(
+    'elp_dependency_duration_seconds', 'Время вызовов внешних зависимостей', ('dependency', 'operation')))
+DEPENDENCY_ERRORS = _register(Counter(
+    'elp_dependency_errors_total', 'Ошибки вызовов внешних зависимостей', ('dependency', 'operation')))
+THROTTLE_DELAY = _register(Histogram(
+    'elp_ratelimit_delay_seconds', 'Ожидание исходящего запроса в планировщике лимитов Telegram', ('lane',)))
+
+
+# ===== ЗАМЕРЫ =====
+def instrument_handler(handler):
+    """Декоратор обработчика PTB: время, исход и число одновременных вызовов"""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        HANDLER_IN_FLIGHT.inc(name)
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = await handler(update, context)
+            outcome = 'ok'
+            if startup.first_response is None:
+                startup.mark_first_response()
+            return result
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, name)
+            HANDLER_CALLS.inc(name, outcome)
+            HANDLER_IN_FLIGHT.dec(name)
+
+    return wrapper
+
+
+@contextmanager
+def track_dependency(dependency, operation):
+    """Замер одного вызова БД / SMTP / Bot API; работает и в потоках пула"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        DEPENDENCY_ERRORS.inc(dependency, operation)
+        raise
+    finally:
+        DEPENDENCY_DURATION.observe(time.perf_counter() - started, dependency, operation)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTP-клиент Bot API с замером каждого метода (sendMessage, editMessageText, ...)"""
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        operation = url.rsplit('/', 1)[-1]
+        with track_dependency('telegram', operation):
+            code, payload = await super().do_request(url, method, request_data, **timeouts)
+        # Ответы с ошибкой (429, 400, ...) разбирает уже PTB, здесь их только считаем
+        if code >= 400:
+            DEPENDENCY_ERRORS.inc('telegram', operation)
+        return code, payload
@@ -0,0 +1,170 @@
+import os
+import asyncio
+import logging
+from datetime import datetime
+
+import outbox
+import ui
+
+# ===== НАСТРОЙКИ УВЕДОМЛЕНИЙ =====
+# Заявки, пришедшие в течение окна после предыдущего уведомления, копятся и
+# уходят одной сводкой (одно сообщение админу и одно письмо); 0 — без сводок
+NOTIFY_DIGEST_WINDOW = float(os.environ.get('NOTIFY_DIGEST_WINDOW', 60))
+
+logger = logging.getLogger(__name__)
+
+
+class LeadNotifier:
+    """Уведомления о заявках админу в Telegram и на email со склейкой всплесков.
+
+    Первая заявка после затишья уходит сразу и открывает окно. Заявки внутри
+    окна копятся; по его окончании уходят одной сводкой, и окно открывается
+    заново. Если за окно ничего не пришло — снова затишье.
+
+    Письмо о каждой заявке ставится в очередь (outbox) сразу, с отсрочкой до
+    конца окна; сводное письмо собирает уже OutboxWorker при отправке, поэтому
+    рестарт внутри окна письма не теряет. В памяти копится только сводка для
+    Telegram — сами заявки к этому моменту уже в БД и журнале.
+    """
+
+    def __init__(self, bot, chat_id, window=NOTIFY_DIGEST_WINDOW):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.window = window
+        self._pending = []
+        self._timer = None
+        self._window_ends = 0.0
+        self._tasks = set()
+        self.stats = {'leads': 0, 'instant': 0, 'coalesced': 0, 'digests': 0, 'messages': 0, 'emails': 0}
+
+    def submit(self, lead, lead_id_display):
+        """Заявка на уведомление; не ждёт ни Bot API, ни очереди писем"""
+        item = (dict(lead), lead_id_display, datetime.now().strftime('%d.%m.%Y %H:%M'))
+        self.stats['leads'] += 1
+        loop = asyncio.get_running_loop()
+        if self._timer is not None:
+            email = loop.create_task(self._queue_email(item, self._window_ends - loop.time()))
+            self._pending.append((item, email))
+            self.stats['coalesced'] += 1
+            return
+        self.stats['instant'] += 1
+        if self.window > 0:
+            self._window_ends = loop.time() + self.window
+            self._timer = asyncio.create_task(self._run_window(), name='notify_admin_window')
+        email = loop.create_task(self._queue_email(item))
+        self._spawn(self._send_single(item, email), f'notify_admin_{lead_id_display}')
+
+    def _spawn(self, coro, name):
+        task = asyncio.create_task(coro, name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_window(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await asyncio.sleep(max(0.0, self._window_ends - loop.time()))
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, []
+                self._window_ends = loop.time() + self.window
+                self._flush(batch)
+        finally:
+            self._timer = None
+
+    def _flush(self, batch):
+        # Одна заявка за окно — обычным уведомлением, без заголовка сводки
+        if len(batch) == 1:
+            item, email = batch[0]
+            self._spawn(self._send_single(item, email), f'notify_admin_{item[1]}')
+        else:
+            self._spawn(self._send_digest(batch), 'notify_admin_digest')
+
+    # ----- отправка -----
+    async def _queue_email(self, item, delay=0):
+        if not outbox.EMAIL_PASSWORD:
+            return False
+        lead, lead_id_display, time = item
+        try:
+            subject, body = ui.render_email(lead, lead_id_display, time)
+            await outbox.enqueue_email(
+                subject, body, payload={'lead': lead, 'lead_id': lead_id_display, 'time': time}, delay=delay
+            )
+        except Exception as e:
+            logger.error(f"❌ Ошибка постановки email в очередь: {e}")
+            return False
+        self.stats['emails'] += 1
+        return True
+
+    async def _send(self, text):
+        try:
+            # Полоса ниже ответов пользователям: уведомление может подождать
+            await self.bot.send_message(
+                chat_id=self.chat_id, text=text, parse_mode='Markdown',
+                rate_limit_args={'lane': 'notify'}
+            )
+            self.stats['messages'] += 1
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка отправки админу: {e}")
+            return False
+
+    async def _send_single(self, item, email):
+        lead, lead_id_display, time = item
+        email_queued = await email
+        text = ui.render_admin_lead(
+            lead, lead_id_display,
+            email_status='📬 В очереди' if email_queued else '⚠️ Не отправлен',
+            time=time
+        )
+        if await self._send(text):
+            logger.info(f"Заявка отправлена админу: {lead_id_display}")
+
+    async def _send_digest(self, batch):
+        self.stats['digests'] += 1
+        queued = await asyncio.gather(*(email for _, email in batch))
+        items = [item for item, _ in batch]
+        texts = ui.render_admin_digest(items, '📬 Сводное письмо в очереди' if all(queued) else '⚠️ Не отправлен')
+        sent = 0
+        for text in texts:
+            sent += await self._send(text)
+        if sent:
+            logger.info(f"Сводка из {len(items)} заявок отправлена админу")
+
+    async def close(self):
+        """Остановка: накопленное уходит сводкой сразу, не дожидаясь конца окна"""
+        if self._timer is not None:
+            self._timer.cancel()
+            try:
+                await self._timer
+            except asyncio.CancelledError:
+                pass
+        if self._pending:
+            batch, self._pending = self._pending, []
+            self._flush(batch)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+notifier = None
+
+
+def start_notifier(bot, chat_id):
+    global notifier
+    notifier = LeadNotifier(bot, chat_id)
+
+
+async def stop_notifier():
+    if notifier is not None:
+        await notifier.close()
+
+
+def notify_lead(lead, lead_id_display):
+    if notifier is not None:
+        notifier.submit(lead, lead_id_display)
+
+
+def notifier_stats():
+    if notifier is None:
+        return None
+    return dict(notifier.stats, pending=len(notifier._pending))
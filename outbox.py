@@ -0,0 +1,442 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import ui
+import metrics
+import breaker
+
+# ===== EMAIL НАСТРОЙКИ =====
+SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', 20))
+# Gmail закрывает простаивающие сессии, поэтому держим её открытой не дольше этого
+SMTP_IDLE_TIMEOUT = float(os.environ.get('SMTP_IDLE_TIMEOUT', 240))
+# Отключается только для локального SMTP без TLS (нагрузочный тест)
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') != '0'
+EMAIL_USER = os.environ.get('EMAIL_USER', 'strategy.elp@gmail.com')
+EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD', '')
+EMAIL_TO = os.environ.get('EMAIL_TO', 'strategy.elp@gmail.com')
+
+# ===== НАСТРОЙКИ ОЧЕРЕДИ =====
+# Локальный журнал: основная очередь без PostgreSQL и запасная при его сбое
+OUTBOX_PATH = os.environ.get('OUTBOX_PATH', 'outbox.sqlite3')
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', 15))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 20))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 8))
+OUTBOX_RETRY_BASE = float(os.environ.get('OUTBOX_RETRY_BASE', 30))
+OUTBOX_RETRY_MAX = float(os.environ.get('OUTBOX_RETRY_MAX', 3600))
+
+logger = logging.getLogger(__name__)
+
+
+# ===== ХРАНИЛИЩА =====
+class PostgresOutboxStore:
+    """Очередь писем в таблице email_outbox"""
+
+    def init(self):
+        with db.pool.connection() as conn:
+            cursor = conn.cursor()
+            db.schema_lock(cursor)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS email_outbox (
+                    id SERIAL PRIMARY KEY,
+                    recipient VARCHAR(200),
+                    subject TEXT,
+                    body TEXT,
+                    status VARCHAR(20) DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at DOUBLE PRECISION DEFAULT 0,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    sent_at TIMESTAMP
+                )
+            ''')
+            # Данные заявки: такие письма, готовые одновременно, уходят одной сводкой
+            cursor.execute('ALTER TABLE email_outbox ADD COLUMN IF NOT EXISTS payload TEXT')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS email_outbox_pending_idx
+                ON email_outbox (next_attempt_at) WHERE status = 'pending'
+            ''')
+            cursor.close()
+
+    def _execute(self, sql, params=(), fetch=False):
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            rows = cursor.fetchall() if fetch else None
+            cursor.close()
+            return rows
+        return db.pool.run(query)
+
+    def enqueue(self, recipient, subject, body, payload=None, not_before=0):
+        return self._execute(
+            'INSERT INTO email_outbox (recipient, subject, body, payload, next_attempt_at) VALUES (%s, %s, %s, %s, %s) RETURNING id',
+            (recipient, subject, body, payload, not_before), fetch=True
+        )[0][0]
+
+    def due(self, limit):
+        return self._execute('''
+            SELECT id, recipient, subject, body, attempts, payload FROM email_outbox
+            WHERE status = 'pending' AND next_attempt_at <= %s
+            ORDER BY id LIMIT %s
+        ''', (time.time(), limit), fetch=True)
+
+    def mark_sent(self, message_id):
+        self._execute(
+            "UPDATE email_outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP WHERE id = %s",
+            (message_id,)
+        )
+
+    def mark_retry(self, message_id, attempts, next_attempt_at, error):
+        self._execute(
+            'UPDATE email_outbox SET attempts = %s, next_attempt_at = %s, last_error = %s WHERE id = %s',
+            (attempts, next_attempt_at, error, message_id)
+        )
+
+    def mark_failed(self, message_id, attempts, error):
+        self._execute(
+            "UPDATE email_outbox SET status = 'failed', attempts = %s, last_error = %s WHERE id = %s",
+            (attempts, error, message_id)
+        )
+
+    def pending_count(self):
+        return self._execute(
+            "SELECT COUNT(*) FROM email_outbox WHERE status = 'pending'", fetch=True
+        )[0][0]
+
+
+class SqliteOutboxStore:
+    """Очередь писем в локальном файле SQLite (режим без PostgreSQL)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def init(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS email_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                recipient TEXT,
+                subject TEXT,
+                body TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                last_error TEXT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                sent_at TEXT
+            )
+        ''')
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(email_outbox)')]
+        if 'payload' not in columns:
+            self._conn.execute('ALTER TABLE email_outbox ADD COLUMN payload TEXT')
+
+    def _execute(self, sql, params=(), fetch=False):
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            return cursor.fetchall() if fetch else cursor.lastrowid
+
+    def enqueue(self, recipient, subject, body, payload=None, not_before=0):
+        return self._execute(
+            'INSERT INTO email_outbox (recipient, subject, body, payload, next_attempt_at) VALUES (?, ?, ?, ?, ?)',
+            (recipient, subject, body, payload, not_before)
+        )
+
+    def due(self, limit):
+        return self._execute('''
+            SELECT id, recipient, subject, body, attempts, payload FROM email_outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY id LIMIT ?
+        ''', (time.time(), limit), fetch=True)
+
+    def mark_sent(self, message_id):
+        self._execute(
+            "UPDATE email_outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (message_id,)
+        )
+
+    def mark_retry(self, message_id, attempts, next_attempt_at, error):
+        self._execute(
+            'UPDATE email_outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?',
+            (attempts, next_attempt_at, error, message_id)
+        )
+
+    def mark_failed(self, message_id, attempts, error):
+        self._execute(
+            "UPDATE email_outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+            (attempts, error, message_id)
+        )
+
+    def pending_count(self):
+        return self._execute(
+            "SELECT COUNT(*) FROM email_outbox WHERE status = 'pending'", fetch=True
+        )[0][0]
+
+
+def _call(store, fn, *args):
+    """Вызов хранилища вне event loop; локальный журнал SQLite работает и при разомкнутом предохранителе БД"""
+    return (db.call_local if isinstance(store, SqliteOutboxStore) else db.call)(fn, *args)
+
+
+# ===== SMTP СЕССИЯ =====
+class SmtpSession:
+    """Долгоживущее SMTP-соединение: STARTTLS и логин один раз на серию писем.
+
+    smtplib и email.mime импортируются при первой отправке — на холодный
+    старт бота они не влияют.
+    """
+
+    def __init__(self):
+        self._server = None
+        self._last_used = 0.0
+
+    def _connect(self):
+        import smtplib
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        if SMTP_STARTTLS:
+            server.starttls()
+        server.login(EMAIL_USER, EMAIL_PASSWORD)
+        self._server = server
+        logger.info(f"✅ SMTP-сессия открыта ({SMTP_SERVER}:{SMTP_PORT})")
+
+    def _alive(self):
+        import smtplib
+        if self._server is None:
+            return False
+        if time.monotonic() - self._last_used > SMTP_IDLE_TIMEOUT:
+            self.close()
+            return False
+        try:
+            return self._server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            self.close()
+            return False
+
+    def send(self, recipient, subject, body):
+        import smtplib
+        from email.mime.text import MIMEText
+        from email.mime.multipart import MIMEMultipart
+
+        msg = MIMEMultipart('alternative')
+        msg['Subject'] = subject
+        msg['From'] = f"ELP Telegram Bot <{EMAIL_USER}>"
+        msg['To'] = recipient
+        msg.attach(MIMEText(body, 'html'))
+
+        with metrics.track_dependency('smtp', 'send'):
+            if not self._alive():
+                self._connect()
+            try:
+                self._server.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # Сервер закрыл сессию между проверкой и отправкой — одна повторная попытка
+                self._connect()
+                self._server.send_message(msg)
+        self._last_used = time.monotonic()
+
+    def close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception:
+            pass
+        self._server = None
+
+
+# ===== ФОНОВЫЙ ОБРАБОТЧИК =====
+class OutboxWorker:
+    """Разбирает очередь писем в фоне с повторами и экспоненциальной задержкой.
+
+    Письма о заявках (с payload), ставшие готовыми одновременно, отправляются
+    одним сводным письмом: заявки попадают в очередь сразу, а склеиваются
+    только при отправке, поэтому рестарт их не теряет.
+    """
+
+    def __init__(self, stores):
+        self.stores = stores
+        self.session = SmtpSession()
+        # Один поток: SMTP-сессия не потокобезопасна
+        self._executor = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # SMTP недоступен — письма ждут в очереди, попытки не расходуются
+        self.breaker = breaker.get('smtp')
+        self.stats = {'sent': 0, 'retried': 0, 'failed': 0}
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='smtp')
+        self._task = asyncio.create_task(self._run(), name='outbox_worker')
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.session.close)
+        self._executor.shutdown(wait=False)
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            full_batch = False
+            for store in self.stores:
+                try:
+                    batch = await _call(store, store.due, OUTBOX_BATCH_SIZE)
+                    for recipient, subject, body, messages in self._group(batch):
+                        if not self.breaker.allow():
+                            batch = ()
+                            break
+                        await self._deliver(loop, store, messages, recipient, subject, body)
+                    full_batch = full_batch or len(batch) == OUTBOX_BATCH_SIZE
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"❌ Ошибка обработки очереди писем: {e}")
+
+            if full_batch:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    def _group(batch):
+        """(получатель, тема, тело, [(id, попыток)]): заявки одного получателя — одной сводкой"""
+        leads = {}
+        for message_id, recipient, subject, body, attempts, payload in batch:
+            if payload is None:
+                yield recipient, subject, body, [(message_id, attempts)]
+            else:
+                leads.setdefault(recipient, []).append((message_id, attempts, subject, body, payload))
+        for recipient, rows in leads.items():
+            if len(rows) == 1:
+                message_id, attempts, subject, body, _ = rows[0]
+                yield recipient, subject, body, [(message_id, attempts)]
+                continue
+            items = [
+                (item['lead'], item['lead_id'], item['time'])
+                for item in (json.loads(row[4]) for row in rows)
+            ]
+            subject, body = ui.render_email_digest(items)
+            yield recipient, subject, body, [(row[0], row[1]) for row in rows]
+
+    async def _deliver(self, loop, store, messages, recipient, subject, body):
+        ids = ', '.join(f'#{message_id}' for message_id, _ in messages)
+        try:
+            await loop.run_in_executor(self._executor, self.session.send, recipient, subject, body)
+        except Exception as e:
+            self.breaker.failure()
+            await loop.run_in_executor(self._executor, self.session.close)
+            for message_id, attempts in messages:
+                attempts += 1
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    self.stats['failed'] += 1
+                    await _call(store, store.mark_failed, message_id, attempts, str(e))
+                    logger.error(f"❌ Письмо #{message_id} не отправлено после {attempts} попыток: {e}")
+                    continue
+                delay = min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+                delay *= random.uniform(0.8, 1.2)
+                self.stats['retried'] += 1
+                await _call(store, store.mark_retry, message_id, attempts, time.time() + delay, str(e))
+                logger.warning(f"⚠️ Письмо #{message_id}: попытка {attempts} не удалась, повтор через {delay:.0f} с: {e}")
+            return
+
+        self.breaker.success()
+        self.stats['sent'] += 1
+        for message_id, _ in messages:
+            await _call(store, store.mark_sent, message_id)
+        logger.info(f"✅ Email {ids} отправлен на {recipient}")
+
+
+store = None
+# Запасной локальный журнал на случай, если PostgreSQL недоступен в момент заявки
+fallback_store = None
+worker = None
+
+
+def init_outbox():
+    """Создание хранилища очереди (PostgreSQL или локальный SQLite)"""
+    global store, fallback_store
+    if not EMAIL_PASSWORD:
+        logger.warning("⚠️ Пароль email не настроен, уведомления не отправляются")
+        return
+    try:
+        fallback_store = SqliteOutboxStore(OUTBOX_PATH)
+        fallback_store.init()
+    except Exception as e:
+        logger.error(f"❌ Ошибка открытия локальной очереди писем: {e}")
+        fallback_store = None
+    store = fallback_store
+    if db.pool is not None:
+        try:
+            store = PostgresOutboxStore()
+            store.init()
+        except Exception as e:
+            logger.error(f"❌ Ошибка инициализации очереди писем в БД: {e}")
+            store = fallback_store
+    if store is not None:
+        logger.info(f"✅ Очередь писем готова ({type(store).__name__})")
+
+
+def start_worker():
+    global worker
+    stores = [s for s in (store, fallback_store) if s is not None]
+    if not stores:
+        return
+    worker = OutboxWorker(list(dict.fromkeys(stores)))
+    worker.start()
+
+
+async def stop_worker():
+    if worker is not None:
+        await worker.stop()
+
+
+async def enqueue_email(subject, body, recipient=EMAIL_TO, payload=None, delay=0):
+    """Постановка письма в очередь; возвращает id или None, если email не настроен.
+
+    payload — данные заявки для сводного письма, delay — через сколько секунд
+    письмо можно отправлять (конец окна сводки).
+    """
+    if store is None:
+        return None
+    payload = json.dumps(payload, ensure_ascii=False, default=str) if payload is not None else None
+    not_before = time.time() + delay if delay > 0 else 0
+    try:
+        message_id = await _call(store, store.enqueue, recipient, subject, body, payload, not_before)
+    except Exception as e:
+        if fallback_store is None or store is fallback_store:
+            raise
+        logger.warning(f"⚠️ Очередь в БД недоступна, письмо записано в локальный журнал: {e}")
+        message_id = await _call(fallback_store, fallback_store.enqueue, recipient, subject, body, payload, not_before)
+    if worker is not None and not delay:
+        worker.wakeup()
+    return message_id
+
+
+def outbox_stats():
+    if worker is None:
+        return None
+    return dict(worker.stats)
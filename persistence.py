@@ -0,0 +1,489 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+import functools
+from collections import OrderedDict, defaultdict
+
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput
+
+import db
+import startup
+
+# ===== НАСТРОЙКИ ХРАНЕНИЯ СОСТОЯНИЯ =====
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', 'bot_state.sqlite3')
+# Как часто Application сбрасывает изменённые диалоги в хранилище
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', 5))
+# Диалоги старше этого срока при рестарте не восстанавливаются
+STATE_TTL = float(os.environ.get('STATE_TTL', 7 * 24 * 3600))
+# Незаконченная воронка, в которой пользователь молчит дольше этого, считается брошенной
+FUNNEL_IDLE_TIMEOUT = float(os.environ.get('FUNNEL_IDLE_TIMEOUT', 24 * 3600))
+# Сколько пользователей держать в памяти; сверх этого вытесняются давно молчащие (LRU)
+FUNNEL_MAX_TRACKED = int(os.environ.get('FUNNEL_MAX_TRACKED', 20000))
+FUNNEL_SWEEP_INTERVAL = float(os.environ.get('FUNNEL_SWEEP_INTERVAL', 300))
+
+logger = logging.getLogger(__name__)
+
+
+# ===== ХРАНИЛИЩА =====
+class SqliteStateStore:
+    """Состояние диалогов в локальном файле SQLite"""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def init(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS bot_user_data (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT,
+                updated_at REAL
+            )
+        ''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS bot_conversations (
+                name TEXT,
+                key TEXT,
+                state INTEGER,
+                updated_at REAL,
+                PRIMARY KEY (name, key)
+            )
+        ''')
+
+    def load_user(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT data FROM bot_user_data WHERE user_id = ?', (user_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_conversations(self, name, since):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT key, state, updated_at FROM bot_conversations WHERE name = ? AND updated_at >= ?',
+                (name, since)
+            ).fetchall()
+        return {tuple(json.loads(key)): (state, updated_at) for key, state, updated_at in rows}
+
+    def write_batch(self, users, conversations):
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.executemany('''
+                    INSERT INTO bot_user_data (user_id, data, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+                ''', [(uid, data, now) for uid, data in users.items() if data is not None])
+                self._conn.executemany(
+                    'DELETE FROM bot_user_data WHERE user_id = ?',
+                    [(uid,) for uid, data in users.items() if data is None]
+                )
+                self._conn.executemany('''
+                    INSERT INTO bot_conversations (name, key, state, updated_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (name, key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+                ''', [(name, key, state, now) for (name, key), state in conversations.items() if state is not None])
+                self._conn.executemany(
+                    'DELETE FROM bot_conversations WHERE name = ? AND key = ?',
+                    [(name, key) for (name, key), state in conversations.items() if state is None]
+                )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+
+class PostgresStateStore:
+    """Состояние диалогов в PostgreSQL — переживает редеплой и засыпание сервиса"""
+
+    def init(self):
+        with db.pool.connection() as conn:
+            cursor = conn.cursor()
+            db.schema_lock(cursor)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_user_data (
+                    user_id BIGINT PRIMARY KEY,
+                    data TEXT,
+                    updated_at DOUBLE PRECISION
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_conversations (
+                    name VARCHAR(50),
+                    key VARCHAR(100),
+                    state INTEGER,
+                    updated_at DOUBLE PRECISION,
+                    PRIMARY KEY (name, key)
+                )
+            ''')
+            cursor.close()
+
+    def load_user(self, user_id):
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('SELECT data FROM bot_user_data WHERE user_id = %s', (user_id,))
+            row = cursor.fetchone()
+            cursor.close()
+            return row
+        row = db.pool.run(query)
+        return json.loads(row[0]) if row else None
+
+    def load_conversations(self, name, since):
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT key, state, updated_at FROM bot_conversations WHERE name = %s AND updated_at >= %s',
+                (name, since)
+            )
+            rows = cursor.fetchall()
+            cursor.close()
+            return rows
+        return {tuple(json.loads(key)): (state, updated_at) for key, state, updated_at in db.pool.run(query)}
+
+    def write_batch(self, users, conversations):
+        now = time.time()
+
+        def write(conn):
+            cursor = conn.cursor()
+            upserts = [(uid, data, now) for uid, data in users.items() if data is not None]
+            if upserts:
+                db.execute_values(cursor, '''
+                    INSERT INTO bot_user_data (user_id, data, updated_at) VALUES %s
+                    ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+                ''', upserts)
+            deletes = [uid for uid, data in users.items() if data is None]
+            if deletes:
+                cursor.execute('DELETE FROM bot_user_data WHERE user_id = ANY(%s)', (deletes,))
+            upserts = [(name, key, state, now) for (name, key), state in conversations.items() if state is not None]
+            if upserts:
+                db.execute_values(cursor, '''
+                    INSERT INTO bot_conversations (name, key, state, updated_at) VALUES %s
+                    ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state, updated_at = EXCLUDED.updated_at
+                ''', upserts)
+            for (name, key), state in conversations.items():
+                if state is None:
+                    cursor.execute('DELETE FROM bot_conversations WHERE name = %s AND key = %s', (name, key))
+            cursor.close()
+        db.pool.run(write)
+
+
+# ===== PERSISTENCE ДЛЯ PTB =====
+class FunnelPersistence(BasePersistence):
+    """Персистентность воронки заявки: состояния ConversationHandler и user_data.
+
+    user_data восстанавливается лениво — при первом апдейте пользователя после
+    рестарта (refresh_user_data). Изменения копятся в памяти и пишутся одной
+    пачкой после каждого прохода Application.update_persistence; неизменённые
+    данные повторно не пишутся.
+    """
+
+    def __init__(self, store, update_interval=STATE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        self._prepared = None
+        self._restored = set()
+        self._written = {}
+        self._pending_users = {}
+        self._pending_conversations = {}
+        self._write_task = None
+        # Восстановленные диалоги для FunnelSweeper: {name: {key: (состояние, время)}}
+        # и брошенные до рестарта, которые завершаются при загрузке: {name: {key: состояние}}
+        self.restored_conversations = {}
+        self.expired_conversations = {}
+        self.stats = {'restored': 0, 'written': 0, 'skipped': 0, 'batches': 0, 'errors': 0}
+
+    # ----- хранилище -----
+    def _call(self, fn, *args):
+        """Вызов хранилища вне event loop; SQLite работает и при разомкнутом предохранителе БД"""
+        return (db.call_local if isinstance(self.store, SqliteStateStore) else db.call)(fn, *args)
+
+    async def _prepare(self):
+        """Открытие хранилища и его DDL — при первом обращении, в потоке БД.
+
+        Первое обращение — восстановление диалогов внутри Application.initialize,
+        а не сборка приложения: build_application остаётся без ввода-вывода.
+        """
+        if self._prepared is None:
+            self._prepared = asyncio.ensure_future(self._init_store())
+        await asyncio.shield(self._prepared)
+
+    async def _init_store(self):
+        with startup.phase('state'):
+            try:
+                await self._call(self.store.init)
+            except Exception as e:
+                logger.error(f"❌ Хранилище диалогов недоступно ({type(self.store).__name__}), используем SQLite: {e}")
+                self.store = SqliteStateStore(STATE_DB_PATH)
+                await self._call(self.store.init)
+        logger.info(f"✅ Состояние диалогов хранится в {type(self.store).__name__}")
+
+    # ----- загрузка -----
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        await self._prepare()
+        loaded = await self._call(self.store.load_conversations, name, time.time() - STATE_TTL)
+        cutoff = time.time() - FUNNEL_IDLE_TIMEOUT
+        self.restored_conversations[name] = {key: value for key, value in loaded.items() if value[1] >= cutoff}
+        self.expired_conversations[name] = {key: state for key, (state, updated_at) in loaded.items() if updated_at < cutoff}
+        logger.info(
+            f"✅ Восстановлено диалогов '{name}': {len(self.restored_conversations[name])}, "
+            f"брошенных до рестарта: {len(self.expired_conversations[name])}"
+        )
+        # Таймауты диалогов PTB не переживают рестарт: брошенные возвращаются как END —
+        # PTB сам завершит их и удалит из хранилища при следующей записи
+        return {
+            key: ConversationHandler.END if updated_at < cutoff else state
+            for key, (state, updated_at) in loaded.items()
+        }
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._restored:
+            return
+        self._restored.add(user_id)
+        if user_data:
+            return
+        try:
+            await self._prepare()
+            stored = await self._call(self.store.load_user, user_id)
+        except Exception as e:
+            logger.error(f"❌ Ошибка восстановления данных пользователя {user_id}: {e}")
+            return
+        if stored:
+            user_data.update(stored)
+            self._written[user_id] = json.dumps(stored, sort_keys=True, ensure_ascii=False)
+            self.stats['restored'] += 1
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # ----- отложенная запись -----
+    async def update_user_data(self, user_id, data):
+        payload = json.dumps(data, sort_keys=True, ensure_ascii=False) if data else None
+        if self._written.get(user_id) == payload:
+            self.stats['skipped'] += 1
+            return
+        self._pending_users[user_id] = payload
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._restored.discard(user_id)
+        # В хранилище ничего не записано — удалять нечего
+        if user_id not in self._written and self._pending_users.get(user_id) is None:
+            self._pending_users.pop(user_id, None)
+            return
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    def _schedule_write(self):
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_behind(), name='state_write_behind')
+
+    async def _write_behind(self):
+        # Даём остальным update_* текущего прохода попасть в ту же пачку
+        await asyncio.sleep(0)
+        while self._pending_users or self._pending_conversations:
+            users, self._pending_users = self._pending_users, {}
+            conversations, self._pending_conversations = self._pending_conversations, {}
+            try:
+                await self._prepare()
+                await self._call(self.store.write_batch, users, conversations)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"❌ Ошибка записи состояния диалогов: {e}")
+                # Вернём в очередь то, что не перезаписано более свежими данными
+                for uid, data in users.items():
+                    self._pending_users.setdefault(uid, data)
+                for key, state in conversations.items():
+                    self._pending_conversations.setdefault(key, state)
+                return
+            for uid, data in users.items():
+                if data is None:
+                    self._written.pop(uid, None)
+                else:
+                    self._written[uid] = data
+            self.stats['batches'] += 1
+            self.stats['written'] += len(users) + len(conversations)
+
+    async def flush(self):
+        if self._write_task is not None and not self._write_task.done():
+            await self._write_task
+        if self._pending_users or self._pending_conversations:
+            await self._write_behind()
+
+
+# ===== ОЧИСТКА БРОШЕННЫХ ДИАЛОГОВ =====
+class FunnelSweeper:
+    """Брошенные воронки и память под user_data давно молчащих пользователей.
+
+    Воронку, в которой пользователь молчит дольше FUNNEL_IDLE_TIMEOUT, завершает
+    сам ConversationHandler (conversation_timeout), вызывая on_timeout из
+    состояния TIMEOUT: шаг, на котором её бросили, передаётся в on_abandon, а
+    user_data пользователя убирается из памяти и хранилища. Шаг известен
+    благодаря track(): обработчики воронки обёрнуты и сообщают новое состояние.
+
+    touch() отмечает каждый апдейт (обработчик в группе -1); периодическая
+    задача job queue убирает user_data пользователей вне воронки, молчащих
+    дольше FUNNEL_IDLE_TIMEOUT, а сверх FUNNEL_MAX_TRACKED — самых давних.
+    """
+
+    def __init__(self, application, steps, on_abandon=None):
+        self.application = application
+        self.steps = steps
+        self.on_abandon = on_abandon
+        self.name = None
+        # user_id -> (время последнего апдейта, chat_id), от давних к свежим
+        self._seen = OrderedDict()
+        # (chat_id, user_id) -> состояние незаконченной воронки
+        self._states = {}
+        self._seeded = False
+        self.abandoned = defaultdict(int)
+        self.stats = {'expired': 0, 'evicted': 0, 'sweeps': 0}
+
+    def track(self, conversation):
+        """Обёртка обработчиков воронки: состояние, которое они возвращают, запоминается"""
+        self.name = conversation.name
+        handlers = list(conversation.entry_points) + list(conversation.fallbacks)
+        for state, state_handlers in conversation.states.items():
+            if state != ConversationHandler.TIMEOUT:
+                handlers.extend(state_handlers)
+        for handler in handlers:
+            handler.callback = self._tracked(handler.callback)
+
+    def _tracked(self, callback):
+        @functools.wraps(callback)
+        async def tracked(update, context):
+            state = await callback(update, context)
+            key = self._key(update)
+            if state == ConversationHandler.END:
+                self._states.pop(key, None)
+            elif state is not None:
+                self._states[key] = state
+            return state
+        return tracked
+
+    @staticmethod
+    def _key(update):
+        # Ключ диалога ConversationHandler при per_chat и per_user
+        return (update.effective_chat.id, update.effective_user.id)
+
+    async def touch(self, update, context):
+        if not self._seeded:
+            self._seed()
+        user = update.effective_user
+        if user is None:
+            return
+        chat = update.effective_chat
+        self._seen[user.id] = (time.time(), chat.id if chat else user.id)
+        self._seen.move_to_end(user.id)
+
+    def _seed(self):
+        """Диалоги, восстановленные при старте, ещё не получали апдейтов — берём их из хранилища"""
+        self._seeded = True
+        persistence = self.application.persistence
+        for (chat_id, user_id), state in getattr(persistence, 'expired_conversations', {}).pop(self.name, {}).items():
+            self._abandon(user_id, state)
+        restored = getattr(persistence, 'restored_conversations', {}).pop(self.name, {})
+        for key, (state, _) in restored.items():
+            self._states.setdefault(key, state)
+        seen = OrderedDict(
+            (user_id, (updated_at, chat_id))
+            for (chat_id, user_id), (_, updated_at) in sorted(restored.items(), key=lambda item: item[1][1])
+            if user_id not in self._seen
+        )
+        seen.update(self._seen)
+        self._seen = seen
+
+    def _abandon(self, user_id, state):
+        step = self.steps.get(state, str(state))
+        self.abandoned[step] += 1
+        if self.on_abandon is not None:
+            self.on_abandon(user_id, step)
+
+    def _drop(self, user_id, reason):
+        if user_id in self.application.user_data:
+            self.application.drop_user_data(user_id)
+        self.stats[reason] += 1
+
+    async def on_timeout(self, update, context):
+        """Обработчик состояния TIMEOUT: воронку бросили, после него PTB её завершит"""
+        key = self._key(update)
+        state = self._states.pop(key, None)
+        if state is not None:
+            self._abandon(key[1], state)
+        self._seen.pop(key[1], None)
+        self._drop(key[1], 'expired')
+
+    def sweep(self, now=None):
+        if not self._seeded:
+            self._seed()
+        cutoff = (now or time.time()) - FUNNEL_IDLE_TIMEOUT
+        excess = len(self._seen) - FUNNEL_MAX_TRACKED
+        for user_id, (seen, chat_id) in list(self._seen.items()):
+            if excess > 0:
+                reason = 'evicted'
+            elif seen < cutoff:
+                reason = 'expired'
+            else:
+                break
+            # Пользователя в воронке не трогаем: её завершит conversation_timeout
+            if (chat_id, user_id) in self._states:
+                continue
+            del self._seen[user_id]
+            excess -= 1
+            self._drop(user_id, reason)
+        self.stats['sweeps'] += 1
+
+    async def run(self, context):
+        """Задача job queue"""
+        self.sweep()
+
+    def snapshot(self):
+        stats = dict(self.stats, tracked=len(self._seen), conversations=len(self._states))
+        stats.update({f'abandoned_{step}': count for step, count in self.abandoned.items()})
+        return stats
+
+
+def create_persistence():
+    """PostgreSQL при наличии DATABASE_URL, иначе локальный SQLite-файл.
+    Без ввода-вывода: хранилище открывается при первом обращении (_prepare)"""
+    store = PostgresStateStore() if db.pool is not None else SqliteStateStore(STATE_DB_PATH)
+    return FunnelPersistence(store)
@@ -0,0 +1,215 @@
+import io
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+
+# ===== НАСТРОЙКИ ПРОФИЛИРОВАНИЯ =====
+PROFILE_DEFAULT_SECONDS = float(os.environ.get('PROFILE_DEFAULT_SECONDS', 30))
+# Верхняя граница сеанса — и для режима «N апдейтов»
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 600))
+# Период выборки стека event loop, секунды
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+# Глубина стека, которую tracemalloc запоминает для каждого выделения
+PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get('PROFILE_TRACEMALLOC_FRAMES', 10))
+PROFILE_TOP = 25
+
+logger = logging.getLogger(__name__)
+
+
+class StackSampler(threading.Thread):
+    """Выборочный профилировщик: поток раз в interval снимает стек потока event loop.
+
+    Интерпретатор не трассируется, поэтому накладные расходы — только сама
+    выборка; это время «по часам», ожидание в select тоже попадает в отчёт.
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        super().__init__(name='profile_sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _frame_label(frame):
+    filename, line, name = frame
+    return f"{os.path.basename(filename)}:{line}:{name}"
+
+
+class ProfileSession:
+    """Сеанс /profile: выборка CPU и tracemalloc на время или до N апдейтов"""
+
+    def __init__(self, application, seconds=None, updates=None):
+        self.application = application
+        self.seconds = min(seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+        self.updates = updates
+        self.seen = 0
+        self.started = None
+        self.elapsed = 0.0
+        self._done = asyncio.Event()
+        self._sampler = None
+        self._owns_tracemalloc = False
+        self._baseline = None
+        self.peak = 0
+
+    def _count(self, update):
+        self.seen += 1
+        if self.updates is not None and self.seen >= self.updates:
+            self._done.set()
+
+    def stop(self):
+        self._done.set()
+
+    async def run(self):
+        """Профилирование до конца сеанса; возвращает (краткий отчёт, zip-архив)"""
+        import tracemalloc
+
+        loop = asyncio.get_running_loop()
+        # Счётчик апдейтов подключается к обработчику очереди только на время сеанса
+        observers = self.application.update_processor.observers
+        observers.add(self._count)
+        self._owns_tracemalloc = not tracemalloc.is_tracing()
+        if self._owns_tracemalloc:
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        self._baseline = await loop.run_in_executor(None, tracemalloc.take_snapshot)
+        self._sampler = StackSampler(threading.get_ident())
+        self.started = time.monotonic()
+        self._sampler.start()
+        try:
+            await asyncio.wait_for(self._done.wait(), self.seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.elapsed = time.monotonic() - self.started
+            await loop.run_in_executor(None, self._sampler.stop)
+            observers.discard(self._count)
+        try:
+            snapshot = await loop.run_in_executor(None, tracemalloc.take_snapshot)
+            self.peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            if self._owns_tracemalloc:
+                tracemalloc.stop()
+        return await loop.run_in_executor(None, self._build_report, snapshot)
+
+    # ----- отчёт -----
+    def _cpu_lines(self):
+        sampler = self._sampler
+        total = max(sampler.samples, 1)
+        own = Counter()
+        cumulative = Counter()
+        for stack, count in sampler.stacks.items():
+            own[stack[-1]] += count
+            for frame in set(stack):
+                cumulative[frame] += count
+        lines = [f"CPU: {sampler.samples} выборок стека event loop раз в {sampler.interval * 1000:.0f} мс", ""]
+        lines.append(f"{'своё %':>8}{'всего %':>9}  функция")
+        for frame, count in own.most_common(PROFILE_TOP):
+            lines.append(f"{count * 100 / total:8.1f}{cumulative[frame] * 100 / total:9.1f}  {_frame_label(frame)}")
+        lines += ["", "По включительному времени:"]
+        for frame, count in cumulative.most_common(PROFILE_TOP):
+            lines.append(f"{count * 100 / total:8.1f}%  {_frame_label(frame)}")
+        return lines
+
+    def _memory_lines(self, snapshot):
+        import tracemalloc
+
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        snapshot = snapshot.filter_traces(filters)
+        baseline = self._baseline.filter_traces(filters)
+        lines = ["Память (tracemalloc): прирост за сеанс по строкам кода", ""]
+        for stat in snapshot.compare_to(baseline, 'lineno')[:PROFILE_TOP]:
+            frame = stat.traceback[0]
+            lines.append(
+                f"{stat.size_diff / 1024:+10.1f} КБ {stat.count_diff:+8d} блоков  "
+                f"{os.path.basename(frame.filename)}:{frame.lineno}"
+            )
+        lines += ["", "Всего занято по строкам кода:"]
+        for stat in snapshot.statistics('lineno')[:PROFILE_TOP]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size / 1024:10.1f} КБ {stat.count:8d} блоков  {os.path.basename(frame.filename)}:{frame.lineno}")
+        if self.peak:
+            lines.append(f"\nПик отслеживаемой памяти: {self.peak / 1024 / 1024:.1f} МБ")
+        return lines, snapshot
+
+    def _build_report(self, snapshot):
+        import pickle
+        import zipfile
+
+        header = [
+            f"Профиль ELP бота, {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}, pid {os.getpid()}",
+            f"Длительность {self.elapsed:.1f} с, апдейтов {self.seen}",
+            "",
+        ]
+        memory, snapshot = self._memory_lines(snapshot)
+        report = '\n'.join(header + self._cpu_lines() + [""] + memory) + '\n'
+        # Свёрнутые стеки — формат flamegraph.pl и speedscope
+        folded = ''.join(
+            ';'.join(_frame_label(frame) for frame in stack) + f' {count}\n'
+            for stack, count in self._sampler.stacks.most_common()
+        )
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('report.txt', report)
+            z.writestr('cpu.folded', folded)
+            # Снимок читается через tracemalloc.Snapshot.load()
+            z.writestr('heap.tracemalloc', pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+        archive.seek(0)
+        summary = '\n'.join(header[:2] + self._cpu_lines()[2:9])
+        return summary, archive
+
+
+session = None
+_task = None
+
+
+def active():
+    return _task is not None and not _task.done()
+
+
+def start_profile(application, on_report, seconds=None, updates=None):
+    """Запуск сеанса в фоне; on_report(summary, archive) получает результат"""
+    global session, _task
+    session = ProfileSession(application, seconds, updates)
+
+    async def run():
+        try:
+            summary, archive = await session.run()
+        except Exception as e:
+            logger.error(f"❌ Ошибка профилирования: {e}")
+            return
+        try:
+            await on_report(summary, archive)
+        except Exception as e:
+            logger.error(f"❌ Отчёт профилирования не отправлен: {e}")
+
+    _task = asyncio.create_task(run(), name='profile_session')
+    return session
+
+
+async def stop_profile():
+    """Досрочное завершение (например, при остановке бота) с отправкой отчёта"""
+    if active():
+        session.stop()
+        await _task
@@ -0,0 +1,251 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import contextlib
+from collections import Counter
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+# ===== ЛИМИТЫ TELEGRAM =====
+# Официальные ориентиры: ~30 сообщений/с на бота, ~1/с в личный чат, 20/мин в группу
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_GLOBAL_BURST = float(os.environ.get('TELEGRAM_GLOBAL_BURST', 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+TELEGRAM_GROUP_RATE = float(os.environ.get('TELEGRAM_GROUP_RATE', 20 / 60))
+# Сколько раз повторять запрос после 429 (RetryAfter)
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', 3))
+
+# Полосы приоритета: меньший индекс уходит раньше.
+# Ответы пользователю — по умолчанию; уведомления админу и рассылки передают
+# свою полосу через rate_limit_args={'lane': ...}.
+LANES = ('reply', 'notify', 'bulk')
+DEFAULT_LANE = 'reply'
+# Корзины чатов, которые дольше этого простаивают, удаляются
+CHAT_BUCKET_TTL = 300
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ведро токенов с резервированием: reserve() сразу списывает токен и
+    возвращает, сколько ждать до его появления (0 — можно отправлять)"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        self._refill(now)
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def wait_time(self, now):
+        """Сколько ждать до целого токена, ничего не списывая"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class ChatQueue:
+    """Очередь запросов одного чата: FIFO на всех полосах сразу.
+
+    Следующий запрос чата начинается, когда предыдущий завершён (вместе с
+    повторами после 429), поэтому сообщения приходят в порядке отправки.
+    В общей очереди бота стоит только голова очереди чата — с лучшей полосой
+    среди запросов чата, так что приоритет действует лишь между чатами.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.tail = None
+        self.lanes = Counter()
+        # (индекс полосы, future) головы очереди, ждущей общий токен
+        self.slot = None
+
+    @property
+    def idle(self):
+        return not +self.lanes
+
+    def best_lane(self):
+        return min(LANES.index(lane) for lane, count in self.lanes.items() if count > 0)
+
+
+class FloodControlLimiter(BaseRateLimiter):
+    """Планировщик исходящих запросов к Bot API.
+
+    Запросы в один чат выполняются строго по очереди (ChatQueue) и ждут токен
+    своего чата, затем — общий токен бота. Общие токены раздаёт одна
+    задача-диспетчер в порядке полос приоритета, поэтому ответы пользователям
+    обгоняют уведомления и рассылки в другие чаты. При 429 все отправки
+    приостанавливаются на retry_after, а запрос повторяется. Запросы без
+    chat_id (answerCallbackQuery и т. п.) не тарифицируются, но пауза после
+    429 касается и их.
+    """
+
+    def __init__(self):
+        self._global = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_BURST)
+        self._chats = {}
+        self._queue = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0.0
+        self._dispatcher = None
+        self.queued = dict.fromkeys(LANES, 0)
+        self.stats = {'sent': 0, 'throttled': 0, 'throttle_seconds': 0.0, 'retry_after': 0, 'dropped': 0}
+
+    async def initialize(self):
+        self._dispatcher = asyncio.create_task(self._dispatch(), name='rate_limit_dispatcher')
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for _, _, future in self._queue:
+            if not future.done():
+                future.cancel()
+        self._queue.clear()
+
+    # ----- очереди чатов -----
+    def _chat(self, chat_id, now):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) > 10000:
+                self._chats = {
+                    key: c for key, c in self._chats.items()
+                    if not c.idle or now - c.bucket.updated < CHAT_BUCKET_TTL
+                }
+            # Отрицательный chat_id или @username — группы и каналы с более жёстким лимитом
+            rate = TELEGRAM_GROUP_RATE if str(chat_id).startswith(('-', '@')) else TELEGRAM_CHAT_RATE
+            chat = self._chats[chat_id] = ChatQueue(TokenBucket(rate, TELEGRAM_CHAT_BURST))
+        return chat
+
+    @contextlib.asynccontextmanager
+    async def _chat_turn(self, chat, lane):
+        """Очередь чата: вход после завершения предыдущего запроса этого чата"""
+        previous = chat.tail
+        turn = chat.tail = asyncio.get_running_loop().create_future()
+        chat.lanes[lane] += 1
+        self._promote(chat)
+        try:
+            if previous is not None:
+                await asyncio.shield(previous)
+            yield
+        finally:
+            chat.lanes[lane] -= 1
+            if previous is None or previous.done():
+                turn.set_result(None)
+            else:
+                # Запрос, отменённый в ожидании, передаёт очередь только после предыдущего
+                previous.add_done_callback(lambda _: turn.set_result(None))
+
+    def _promote(self, chat):
+        """Голова очереди чата поднимается до лучшей полосы ждущих за ней запросов.
+        Старая запись остаётся в куче и пропускается диспетчером как выполненная"""
+        if chat.slot is None:
+            return
+        index, future = chat.slot
+        best = chat.best_lane()
+        if best < index and not future.done():
+            heapq.heappush(self._queue, (best, next(self._sequence), future))
+            chat.slot = (best, future)
+            self._wakeup.set()
+
+    async def _global_slot(self, chat, lane):
+        future = asyncio.get_running_loop().create_future()
+        index = chat.best_lane()
+        heapq.heappush(self._queue, (index, next(self._sequence), future))
+        chat.slot = (index, future)
+        self.queued[lane] += 1
+        self._wakeup.set()
+        try:
+            await future
+        finally:
+            chat.slot = None
+            self.queued[lane] -= 1
+
+    async def _dispatch(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            delay = max(self._paused_until - now, self._global.wait_time(now))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            self._global.reserve(now)
+            future.set_result(None)
+
+    async def _wait_pause(self):
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    # ----- запрос -----
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        lane = (rate_limit_args or {}).get('lane', DEFAULT_LANE)
+        if lane not in LANES:
+            lane = DEFAULT_LANE
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            return await self._send(callback, args, kwargs, endpoint, lane, None)
+        chat = self._chat(chat_id, time.monotonic())
+        async with self._chat_turn(chat, lane):
+            return await self._send(callback, args, kwargs, endpoint, lane, chat)
+
+    async def _send(self, callback, args, kwargs, endpoint, lane, chat):
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            started = time.monotonic()
+            if chat is None:
+                await self._wait_pause()
+            else:
+                delay = chat.bucket.reserve(started)
+                if delay:
+                    await asyncio.sleep(delay)
+                await self._global_slot(chat, lane)
+            waited = time.monotonic() - started
+            metrics.THROTTLE_DELAY.observe(waited, lane)
+            if waited > 0.001:
+                self.stats['throttled'] += 1
+                self.stats['throttle_seconds'] += waited
+
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.stats['retry_after'] += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + float(e.retry_after))
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    self.stats['dropped'] += 1
+                    logger.error(f"❌ {endpoint}: лимит Telegram, попытки исчерпаны")
+                    raise
+                logger.warning(f"⚠️ {endpoint}: лимит Telegram, пауза {e.retry_after} с (попытка {attempt + 1})")
+                continue
+            self.stats['sent'] += 1
+            return result
+
+    def snapshot(self):
+        """Состояние для /stats и /metrics"""
+        stats = dict(self.stats)
+        stats.update({f'queued_{lane}': count for lane, count in self.queued.items()})
+        stats['paused'] = max(0.0, round(self._paused_until - time.monotonic(), 3))
+        stats['chats'] = len(self._chats)
+        return stats
@@ -0,0 +1,105 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+
+from telegram.error import BadRequest
+
+# ===== НАСТРОЙКИ ОТРИСОВКИ =====
+# Сколько последних сообщений бота помнить; старые вытесняются (LRU)
+RENDER_CACHE_SIZE = int(os.environ.get('RENDER_CACHE_SIZE', 20000))
+
+logger = logging.getLogger(__name__)
+
+
+def _is_not_modified(error):
+    return 'message is not modified' in str(error).lower()
+
+
+class RenderCache:
+    """Последняя отрисовка (текст, разметка, клавиатура) каждого сообщения бота.
+
+    Повторное нажатие той же кнопки перерисовывает сообщение тем же самым —
+    такую правку Telegram всё равно отклоняет («message is not modified»),
+    поэтому она не отправляется вовсе. Ответ на нажатие и правка уходят
+    одновременно, а не друг за другом.
+
+    Кэш живёт в памяти процесса: после рестарта первая правка каждого
+    сообщения отправляется как обычно. Апдейты одного чата обрабатываются
+    по очереди (server.ChatOrderedUpdateProcessor), поэтому гонок за
+    запись одного сообщения нет.
+    """
+
+    def __init__(self, size=RENDER_CACHE_SIZE):
+        self.size = size
+        self._rendered = OrderedDict()
+        self.stats = {'answers': 0, 'edits': 0, 'edits_skipped': 0, 'not_modified': 0, 'replies': 0}
+
+    # ----- кэш -----
+    def _remember(self, message, view):
+        key = (message.chat_id, message.message_id)
+        self._rendered[key] = view
+        self._rendered.move_to_end(key)
+        if len(self._rendered) > self.size:
+            self._rendered.popitem(last=False)
+
+    def _unchanged(self, message, view):
+        key = (message.chat_id, message.message_id)
+        if self._rendered.get(key) != view:
+            return False
+        self._rendered.move_to_end(key)
+        return True
+
+    # ----- вызовы Bot API -----
+    async def _answer(self, query, text):
+        try:
+            await query.answer(text)
+            self.stats['answers'] += 1
+        except BadRequest as e:
+            # Устаревший запрос (например, нажатие до рестарта) не мешает перерисовке
+            logger.warning(f"⚠️ Ответ на нажатие не отправлен: {e}")
+
+    async def _edit(self, query, view):
+        text, parse_mode, reply_markup = view
+        try:
+            await query.edit_message_text(text=text, parse_mode=parse_mode, reply_markup=reply_markup)
+        except BadRequest as e:
+            if not _is_not_modified(e):
+                raise
+            self.stats['not_modified'] += 1
+        else:
+            self.stats['edits'] += 1
+        if query.message is not None:
+            self._remember(query.message, view)
+
+    async def answer(self, query, text=None):
+        """Нажатие без перерисовки: только убрать «часики» на кнопке"""
+        await self._answer(query, text)
+
+    async def edit(self, query, text, parse_mode=None, reply_markup=None, answer_text=None):
+        """Ответ на нажатие и перерисовка сообщения с кнопкой — одновременно"""
+        view = (text, parse_mode, reply_markup)
+        if query.message is not None and self._unchanged(query.message, view):
+            self.stats['edits_skipped'] += 1
+            await self._answer(query, answer_text)
+            return
+        await asyncio.gather(self._answer(query, answer_text), self._edit(query, view))
+
+    async def reply(self, message, text, parse_mode=None, reply_markup=None):
+        """Новое сообщение бота; его отрисовка запоминается для следующих правок"""
+        sent = await message.reply_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+        self.stats['replies'] += 1
+        if reply_markup is not None:
+            self._remember(sent, (text, parse_mode, reply_markup))
+        return sent
+
+    def snapshot(self):
+        """Состояние для /stats и /metrics; saved — сэкономленные вызовы Bot API"""
+        return dict(self.stats, saved=self.stats['edits_skipped'], cached=len(self._rendered))
+
+
+cache = RenderCache()
+answer = cache.answer
+edit = cache.edit
+reply = cache.reply
+render_stats = cache.snapshot
@@ -0,0 +1,307 @@
+import os
+import hmac
+import time
+import signal
+import asyncio
+import logging
+import secrets
+from collections import deque
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+import api
+import metrics
+
+# ===== НАСТРОЙКИ WEB-СЕРВЕРА =====
+# Render сам выставляет RENDER_EXTERNAL_URL и PORT для web-сервиса
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL') or os.environ.get('RENDER_EXTERNAL_URL')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
+HTTP_HOST = os.environ.get('HTTP_HOST', '0.0.0.0')
+HTTP_PORT = os.environ.get('PORT')
+# Сколько апдейтов (из разных чатов) обрабатывается одновременно
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', 64))
+# Сколько последних update_id помнить: апдейт, присланный повторно (пересылка
+# диспетчером после таймаута, повтор webhook), второй раз не обрабатывается
+UPDATE_DEDUP_SIZE = int(os.environ.get('UPDATE_DEDUP_SIZE', 10000))
+# Секрет апдейтов, пересылаемых диспетчером кластера (cluster.py) обработчику
+CLUSTER_SECRET = os.environ.get('CLUSTER_SECRET', '')
+
+logger = logging.getLogger(__name__)
+
+
+# ===== ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА С ПОРЯДКОМ ВНУТРИ ЧАТА =====
+def update_chat_key(update):
+    """Ключ упорядочивания: чат, а если его нет — пользователь"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Апдейты разных чатов обрабатываются параллельно, одного чата — строго по очереди.
+
+    ConversationHandler рассчитывает на последовательную обработку апдейтов
+    одного диалога, поэтому каждый апдейт чата ждёт завершения предыдущего.
+    Ждёт он до того, как занять слот параллельной обработки: иначе один
+    чат, приславший UPDATE_CONCURRENCY апдейтов, занял бы все слоты, а
+    порядок внутри чата зависел бы от очерёдности пробуждения на семафоре.
+    Повторно пришедший апдейт (тот же update_id) пропускается.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._tails = {}
+        self._seen = set()
+        self._seen_order = deque()
+        self.in_flight = 0
+        self.duplicates = 0
+        # Наблюдатели апдейтов (например, счётчик /profile); обычно пусто
+        self.observers = set()
+
+    async def process_update(self, update, coroutine):
+        # Замена BaseUpdateProcessor.process_update: базовая версия берёт
+        # семафор до do_process_update, то есть до ожидания очереди чата
+        if self._is_duplicate(update):
+            self.duplicates += 1
+            coroutine.close()
+            logger.warning(f"⚠️ Апдейт {update.update_id} получен повторно и пропущен")
+            return
+        key = update_chat_key(update)
+        self.in_flight += 1
+        for observer in self.observers:
+            observer(update)
+        try:
+            if key is None:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+                return
+
+            # Очередь чата — цепочка future, которая строится синхронно в порядке поступления
+            previous = self._tails.get(key)
+            done = asyncio.get_running_loop().create_future()
+            self._tails[key] = done
+            try:
+                if previous is not None:
+                    await previous
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+            finally:
+                done.set_result(None)
+                if self._tails.get(key) is done:
+                    del self._tails[key]
+        finally:
+            self.in_flight -= 1
+
+    def _is_duplicate(self, update):
+        update_id = getattr(update, 'update_id', None)
+        if update_id is None:
+            return False
+        if update_id in self._seen:
+            return True
+        self._seen.add(update_id)
+        self._seen_order.append(update_id)
+        if len(self._seen_order) > UPDATE_DEDUP_SIZE:
+            self._seen.discard(self._seen_order.popleft())
+        return False
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def active_chats(self):
+        return len(self._tails)
+
+
+# ===== HTTP-СЕРВЕР =====
+def check_webhook_secret(request):
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        logger.warning("⚠️ Webhook-запрос с неверным секретом отклонён")
+        return False
+    return True
+
+
+async def metrics_response(request):
+    if metrics.METRICS_TOKEN:
+        token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(token, metrics.METRICS_TOKEN):
+            return web.Response(status=401)
+    return web.Response(
+        body=metrics.render().encode(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
+
+class BotWebServer:
+    """aiohttp-сервер бота: webhook Telegram и служебные эндпоинты.
+
+    worker — номер обработчика кластера: апдейты тогда приходят не от
+    Telegram, а пачками от диспетчера на /internal/updates.
+    """
+
+    def __init__(self, application: Application, webhook=False, worker=None):
+        self.application = application
+        self.webhook = webhook
+        self.worker = worker
+        self.started_at = time.monotonic()
+        self.updates_received = 0
+        self.web = web.Application(client_max_size=16 * 1024 * 1024)
+        self.web.router.add_get('/', self.handle_health)
+        self.web.router.add_get('/health', self.handle_health)
+        self.web.router.add_get('/metrics', self.handle_metrics)
+        if webhook:
+            self.web.router.add_post(WEBHOOK_PATH, self.handle_webhook)
+        if worker is not None:
+            self.web.router.add_post('/internal/updates', self.handle_forwarded)
+        if api.enabled():
+            api.add_routes(self.web.router)
+        self._runner = None
+        metrics.register_collector('updates', 'Очередь и обработка апдейтов', self.update_stats)
+
+    @property
+    def router(self):
+        return self.web.router
+
+    async def handle_webhook(self, request):
+        if not check_webhook_secret(request):
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        update = Update.de_json(data, self.application.bot)
+        self.updates_received += 1
+        # Отвечаем Telegram сразу, обработка идёт в очереди приложения
+        await self.application.update_queue.put(update)
+        return web.Response()
+
+    async def handle_forwarded(self, request):
+        token = request.headers.get('X-Cluster-Secret', '')
+        if not CLUSTER_SECRET or not hmac.compare_digest(token, CLUSTER_SECRET):
+            return web.Response(status=403)
+        try:
+            batch = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        # Пачка уже упорядочена диспетчером; порядок внутри чата держит ChatOrderedUpdateProcessor
+        for data in batch:
+            await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+        self.updates_received += len(batch)
+        return web.Response()
+
+    def update_stats(self):
+        processor = self.application.update_processor
+        return {
+            'received': self.updates_received,
+            'queue': self.application.update_queue.qsize(),
+            'in_flight': getattr(processor, 'in_flight', None),
+            'active_chats': getattr(processor, 'active_chats', None),
+            'duplicates': getattr(processor, 'duplicates', None),
+        }
+
+    async def handle_health(self, request):
+        stats = self.update_stats()
+        return web.json_response({
+            'status': 'ok' if self.application.running else 'starting',
+            'mode': 'worker' if self.worker is not None else 'webhook' if self.webhook else 'polling',
+            'worker': self.worker,
+            'pid': os.getpid(),
+            'uptime': round(time.monotonic() - self.started_at, 1),
+            'updates_received': stats['received'],
+            'update_queue': stats['queue'],
+            'in_flight': stats['in_flight'],
+        })
+
+    async def handle_metrics(self, request):
+        return await metrics_response(request)
+
+    async def start(self, host=HTTP_HOST, port=None):
+        port = int(port or HTTP_PORT or 8080)
+        self._runner = web.AppRunner(self.web, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"🌐 HTTP-сервер слушает {host}:{port}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+http_server = None
+
+
+async def start_http(application: Application, webhook=False, worker=None):
+    """Запуск HTTP-сервера: всегда в режиме webhook и у обработчика кластера,
+    при заданном PORT — и при polling"""
+    global http_server
+    if not webhook and worker is None and not HTTP_PORT:
+        return None
+    http_server = BotWebServer(application, webhook=webhook, worker=worker)
+    await http_server.start()
+    return http_server
+
+
+async def stop_http():
+    global http_server
+    if http_server is not None:
+        await http_server.stop()
+        http_server = None
+
+
+async def run_webhook(application: Application, worker=None):
+    """Режим webhook: свой цикл жизни приложения вместо run_polling().
+
+    С номером worker — обработчик кластера: апдейты пересылает диспетчер,
+    webhook в Telegram он не регистрирует.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if worker is not None:
+            await start_http(application, worker=worker)
+        else:
+            await start_http(application, webhook=True)
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info(f"🔗 Webhook установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        await application.start()
+        await stop_event.wait()
+    finally:
+        await stop_http()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
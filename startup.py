@@ -0,0 +1,120 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+
+# ===== РЕЖИМ ЗАПУСКА =====
+# lazy  — бот начинает отвечать сразу, схема БД и очередь писем готовятся в фоне;
+# eager — всё готовится до запуска опроса (прежнее поведение)
+STARTUP_MODE = os.environ.get('STARTUP_MODE', 'lazy')
+LAZY = STARTUP_MODE != 'eager'
+
+logger = logging.getLogger(__name__)
+
+
+def _process_age():
+    """Сколько процесс уже живёт: время запуска интерпретатора до импорта этого модуля"""
+    try:
+        with open('/proc/self/stat') as f:
+            # Поле 22 — время запуска в тиках от загрузки системы; имя процесса может содержать пробелы
+            started_ticks = int(f.read().rpartition(')')[2].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - started_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+# Отсчёт ведётся от запуска процесса, а не от импорта модуля
+_origin = time.monotonic() - _process_age()
+phases = {'interpreter': time.monotonic() - _origin}
+_last_mark = time.monotonic()
+_deferred = None
+first_response = None
+
+
+@contextmanager
+def phase(name):
+    """Замер этапа запуска; этапы в отчёте идут в порядке выполнения"""
+    global _last_mark
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        phases[name] = time.monotonic() - started
+        _last_mark = time.monotonic()
+
+
+def mark(name):
+    """Этап, который длился от предыдущей отметки до этого момента (например, импорты)"""
+    global _last_mark
+    now = time.monotonic()
+    phases[name] = now - _last_mark
+    _last_mark = now
+
+
+def since_start():
+    return time.monotonic() - _origin
+
+
+def mark_first_response():
+    """Первый обработанный апдейт — время до первого ответа пользователю"""
+    global first_response
+    if first_response is None:
+        first_response = since_start()
+        logger.info(f"⏱️ Первый ответ через {first_response:.2f} с после запуска процесса\n{report()}")
+
+
+# ===== ОТЛОЖЕННАЯ ИНИЦИАЛИЗАЦИЯ =====
+def defer(coro):
+    """Фоновая подготовка после запуска опроса; ready() её дожидается.
+
+    Задача создаётся в event loop напрямую: в post_init приложение ещё не
+    запущено, и application.create_task её бы не отслеживал. Остановку
+    обеспечивает cancel_deferred().
+    """
+    global _deferred
+
+    async def run():
+        try:
+            await coro
+        except Exception as e:
+            logger.error(f"❌ Ошибка отложенной инициализации: {e}")
+            return
+        logger.info(f"✅ Отложенная инициализация завершена через {since_start():.2f} с после запуска")
+
+    _deferred = asyncio.get_running_loop().create_task(run(), name='deferred_init')
+    return _deferred
+
+
+async def cancel_deferred():
+    """Остановка незавершённой подготовки при выключении (повторный вызов ничего не делает)"""
+    if _deferred is None or _deferred.done():
+        return
+    _deferred.cancel()
+    try:
+        await _deferred
+    except asyncio.CancelledError:
+        logger.info("⏹️ Отложенная инициализация прервана остановкой бота")
+
+
+async def ready():
+    """Ожидание отложенной инициализации перед работой с заявками и очередью писем"""
+    if _deferred is not None and not _deferred.done():
+        await asyncio.shield(_deferred)
+
+
+# ===== ОТЧЁТ =====
+def report():
+    lines = [f"  {name:<14} {seconds * 1000:8.0f} мс" for name, seconds in phases.items()]
+    return "⏱️ Этапы запуска:\n" + '\n'.join(lines)
+
+
+def startup_stats():
+    """Длительности этапов для /metrics (секунды)"""
+    stats = {f'{name}_seconds': round(seconds, 4) for name, seconds in phases.items()}
+    if first_response is not None:
+        stats['first_response_seconds'] = round(first_response, 4)
+    stats['lazy'] = int(LAZY)
+    return stats
@@ -0,0 +1,392 @@
+import html
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.helpers import escape_markdown
+
+# Всё, что не зависит от пользователя, собирается один раз при импорте:
+# клавиатуры PTB неизменяемы, поэтому один объект безопасно отдавать всем.
+# Динамические тексты — строки str.format с заранее разобранной статикой.
+
+# ===== БАЗА ЗНАНИЙ ELP =====
+KNOWLEDGE_BASE = {
+    'area': "🏭 *Площади складов ELP:*\n\n• Корпус А: 32 800 м²\n• Корпус В: 17 500 м²\n• Минимальная аренда: от 3 500 м²\n\nВсе склады класса А с полным комплектом инженерных систем.",
+    'price': "💰 *Стоимость аренды:*\n\n• От 5 500 ₸ за кв.м/мес\n• Включает OPEX (эксплуатационные расходы)\n• Индивидуальный расчёт для площадей от 3 500 м²\n\nНужен точный расчёт для вашего бизнеса?",
+    'location': "📍 *Расположение:*\n\n• Алматинская область, Талгарский район\n• Кульджинский тракт, 200\n• 30 км до центра Алматы\n• 22 км до международного аэропорта\n• 5 км до развязки БАКАД\n\nКоординаты: 43.394771, 77.173137",
+    'specs': "⚙️ *Технические характеристики:*\n\n• Класс А по международной классификации\n• Высота до подкранового пути: 12 м\n• Допустимая нагрузка на пол: 8 т/м²\n• Шаг колонн: 12×24 м\n• Доки: 1 на 1200 м²\n• Современные системы пожаротушения\n• Круглосуточная охрана и видеонаблюдение",
+    'contact': "👨‍💼 *Контакты директора по развитию:*\n\n**Директор по развитию ELP**\n• Email: strategy.elp@gmail.com\n• Telegram: @elp_almaty_bot\n\nСпециализируется на стратегическом развитии логистических мощностей в Алматы.",
+    'timeline': "📅 *Сроки реализации:*\n\n• Период проекта: 2025–2028 гг.\n• 1 этап (Корпус В) — введён в эксплуатацию\n• Поэтапный ввод до общей площади 250 000 м²",
+    'broker': "🤝 *Эксклюзивный брокер:*\n\n• Bright Rich | CORFAC International\n• ТОП-5 на рынке коммерческой недвижимости РК\n• 16 лет опыта, более 3 млн м² сделок\n\nБрокер подготовит индивидуальный расчёт аренды.",
+    'infrastructure': "🏢 *Инфраструктура парка:*\n\n• 3 административно-бытовых блока по 1 128 м²\n• Рабочие места до 320 сотрудников\n• 16 санузлов, 4 душевые\n• Парковка: 50 мест для фур, 32 для легковых",
+    'developer': "🏗️ *Девелопер проекта:*\n\n• Опытный девелопер складской недвижимости\n• Реализованные проекты в Москве и Казани\n• Лауреат CRE Awards 2023",
+    'about': "🏭 *Евразийский Логистический Парк (ELP)*\n\nЛогистический парк класса А общей площадью 250 000 м² — ключевой складской хаб Алматы."
+}
+
+# ===== КЛАВИАТУРЫ =====
+def _keyboard(*rows):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(text, callback_data=data) for text, data in row]
+        for row in rows
+    ])
+
+MAIN_MENU_KEYBOARD = _keyboard(
+    [("📐 Площади", 'area'), ("💰 Стоимость", 'price')],
+    [("📍 Расположение", 'location'), ("⚙️ Характеристики", 'specs')],
+    [("👨‍💼 Контакты", 'contact'), ("📅 Сроки", 'timeline')],
+    [("📝 Оставить заявку", 'start_request')]
+)
+
+ACTION_KEYBOARDS = {
+    'price': _keyboard(
+        [("📝 Оставить заявку", 'start_request'), ("👨‍💼 Написать директору", 'contact')],
+        [("🗓️ Записаться на просмотр", 'schedule_tour')]
+    ),
+    'contact': _keyboard(
+        [("✉️ Написать email", 'write_email'), ("📝 Оставить заявку", 'start_request')],
+        [("🏭 Посмотреть площади", 'area')]
+    ),
+    'default': _keyboard(
+        [("📝 Оставить заявку", 'start_request'), ("💰 Узнать стоимость", 'price')],
+        [("👨‍💼 Связаться с директором", 'contact')]
+    ),
+}
+
+AREA_KEYBOARD = _keyboard(
+    [("до 500 м²", 'area_500')],
+    [("500 - 1 000 м²", 'area_1000')],
+    [("1 000 - 3 500 м²", 'area_3500')],
+    [("более 3 500 м²", 'area_5000')],
+    [("↩️ Назад", 'cancel')]
+)
+
+TERM_KEYBOARD = _keyboard(
+    [("6 месяцев", 'term_6')],
+    [("1 год", 'term_12')],
+    [("2 года", 'term_24')],
+    [("3+ года", 'term_36')],
+    [("↩️ Назад", 'back_to_area')]
+)
+
+CONTACT_METHOD_KEYBOARD = _keyboard(
+    [("📱 Отправить телефон", 'send_phone'), ("📧 Указать email", 'send_email')],
+    [("↩️ Назад", 'back_to_term')]
+)
+
+WRITE_EMAIL_KEYBOARD = _keyboard(
+    [("📝 Оставить заявку через бота", 'start_request'), ("🏠 В главное меню", 'main_menu')]
+)
+
+SCHEDULE_TOUR_KEYBOARD = _keyboard(
+    [("📝 Оставить заявку", 'start_request'), ("🏠 В меню", 'main_menu')]
+)
+
+LEAD_DONE_KEYBOARD = _keyboard(
+    [("👨‍💼 Написать директору", 'contact'), ("🏠 В главное меню", 'main_menu')]
+)
+
+# ===== СТАТИЧНЫЕ ТЕКСТЫ =====
+WELCOME_TEXT = "🏭 *Добро пожаловать в официальный бот Евразийского Логистического Парка!*\n\nЗдесь вы можете получить всю информацию о складах класса А в Алматы.\n\nВыберите интересующий раздел:"
+REQUEST_START_TEXT = "📋 *Оформление заявки*\n\nДавайте подберём оптимальное решение для вашего бизнеса.\n\n🔄 *Шаг 1 из 4*\nКакая площадь склада вас интересует?"
+REQUEST_AREA_TEXT = "📋 *Оформление заявки*\n\n🔄 *Шаг 1 из 4*\nКакая площадь склада вас интересует?"
+WRITE_EMAIL_TEXT = "✉️ *Написать директору по развитию:*\n\nEmail: strategy.elp@gmail.com\n\nУкажите в теме письма:\n«Запрос по складам ELP»\n\nМы ответим в течение 24 часов."
+SCHEDULE_TOUR_TEXT = "🗓️ *Запись на просмотр*\n\nДля записи на индивидуальный просмотр:\n1. Оставьте заявку через бота\n2. Директор по развитию свяжется с вами\n3. Согласуем удобное время\n\nПросмотры проводятся по будням с 10:00 до 17:00."
+LEAD_DONE_TEXT = "✅ *Заявка успешно отправлена!*\n\nС вами свяжется **директор по развитию ELP** в ближайшее время.\n\n✉️ Контакты для связи:\n• Email: strategy.elp@gmail.com\n• Telegram: @elp_almaty_bot\n\nРабочие часы: Пн-Пт, 9:00-18:00"
+CANCEL_TEXT = "Заявка отменена."
+GREETING_TEXT = "Привет! Чем могу помочь?"
+THANKS_TEXT = "Рад был помочь! 🤝"
+MENU_PROMPT_TEXT = "Выберите интересующий раздел:"
+
+# Раздел базы знаний вместе с клавиатурой действий под ним
+KNOWLEDGE_SCREENS = {
+    key: (text, ACTION_KEYBOARDS.get(key, ACTION_KEYBOARDS['default']))
+    for key, text in KNOWLEDGE_BASE.items()
+}
+
+AREA_LABELS = {
+    'area_500': 'до 500 м²', 'area_1000': '500 - 1 000 м²',
+    'area_3500': '1 000 - 3 500 м²', 'area_5000': 'более 3 500 м²'
+}
+
+TERM_LABELS = {
+    'term_6': '6 месяцев', 'term_12': '1 год',
+    'term_24': '2 года', 'term_36': '3+ года'
+}
+
+# ===== ШАБЛОНЫ =====
+STEP_TERM_TEMPLATE = "📋 *Оформление заявки*\n\n✅ Площадь: {area}\n\n🔄 *Шаг 2 из 4*\nНа какой срок планируете аренду?"
+STEP_NAME_TEMPLATE = "📋 *Оформление заявки*\n\n✅ Площадь: {area}\n✅ Срок аренды: {term}\n\n🔄 *Шаг 3 из 4*\nКак к вам обращаться? Отправьте ваше имя."
+STEP_CONTACT_TEMPLATE = "📋 *Оформление заявки*\n\n✅ Площадь: {area}\n✅ Срок: {term}\n✅ Имя: {name}\n\n🔄 *Шаг 4 из 4*\nКак с вами связаться?"
+CONTACT_PROMPT_TEMPLATE = "Отправьте ваш {contact_type}:"
+
+ADMIN_LEAD_TEMPLATE = (
+    "🚀 *НОВАЯ ЗАЯВКА С БОТА ELP!*\n\n"
+    "📋 ID: `{lead_id}`\n"
+    "📧 Email: {email_status}\n"
+    "👤 Имя: {name}\n"
+    "👤 Username: @{username}\n"
+    "📞 Контакт ({contact_type}): {contact}\n"
+    "📐 Площадь: {area}\n"
+    "📅 Срок: {term}\n"
+    "⏰ Время: {time}\n\n"
+    "User ID: `{user_id}`"
+)
+
+EMAIL_SUBJECT_TEMPLATE = "🚀 Новая заявка ELP {lead_id} - {name}"
+
+EMAIL_BODY_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <style>
+        body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
+        .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
+        .header {{ background: #1a3d7a; color: white; padding: 20px; text-align: center; border-radius: 5px 5px 0 0; }}
+        .content {{ background: #f9f9f9; padding: 20px; border: 1px solid #ddd; }}
+        .lead-info {{ background: white; padding: 15px; margin: 10px 0; border-left: 4px solid #1a3d7a; }}
+        .label {{ font-weight: bold; color: #1a3d7a; }}
+        .footer {{ text-align: center; margin-top: 20px; color: #666; font-size: 12px; }}
+        .button {{ display: inline-block; background: #1a3d7a; color: white; padding: 10px 20px; text-decoration: none; border-radius: 4px; margin-top: 10px; }}
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h2>🚀 Новая заявка с бота ELP</h2>
+        </div>
+        
+        <div class="content">
+            <div class="lead-info">
+                <p><span class="label">📋 ID заявки:</span> {lead_id}</p>
+                <p><span class="label">👤 Клиент:</span> {name}</p>
+                <p><span class="label">📧 Контакт:</span> {contact} ({contact_type})</p>
+                <p><span class="label">📐 Интересуемая площадь:</span> {area}</p>
+                <p><span class="label">📅 Срок аренды:</span> {term}</p>
+                <p><span class="label">⏰ Дата и время:</span> {time}</p>
+                <p><span class="label">🔗 User ID:</span> {user_id}</p>
+                <p><span class="label">👤 Username:</span> @{username}</p>
+            </div>
+            
+            <p><strong>📞 Быстрый ответ:</strong></p>
+            <p>• Email: <a href="mailto:{contact}">{contact}</a></p>
+            
+            <p style="margin-top: 20px;">
+                <a href="https://t.me/elp_almaty_bot" class="button">💬 Открыть бота</a>
+            </p>
+        </div>
+        
+        <div class="footer">
+            <p>📍 Евразийский Логистический Парк | Алматы</p>
+            <p>📧 strategy.elp@gmail.com | 🌐 elpk.kz</p>
+            <p><em>Заявка сгенерирована автоматически Telegram-ботом ELP</em></p>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+ADMIN_DIGEST_HEADER_TEMPLATE = "📦 *НОВЫЕ ЗАЯВКИ С БОТА ELP: {count}*\n📧 Email: {email_status}\n"
+ADMIN_DIGEST_ITEM_TEMPLATE = (
+    "\n📋 `{lead_id}` · ⏰ {time}\n"
+    "👤 {name} (@{username}, `{user_id}`)\n"
+    "📞 {contact} ({contact_type})\n"
+    "📐 {area} · 📅 {term}\n"
+)
+# Лимит Telegram — 4096 символов; остаток сводки уходит следующими сообщениями
+ADMIN_DIGEST_LIMIT = 4000
+
+EMAIL_DIGEST_SUBJECT_TEMPLATE = "📦 Новые заявки ELP: {count} ({first} – {last})"
+EMAIL_DIGEST_ROW_TEMPLATE = (
+    "<tr><td>{lead_id}</td><td>{time}</td><td>{name}</td>"
+    "<td><a href=\"mailto:{contact}\">{contact}</a> ({contact_type})</td><td>{area}</td><td>{term}</td>"
+    "<td>@{username}<br>{user_id}</td></tr>"
+)
+EMAIL_DIGEST_BODY_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <style>
+        body {{ font-family: Arial, sans-serif; line-height: 1.5; color: #333; }}
+        .header {{ background: #1a3d7a; color: white; padding: 15px 20px; border-radius: 5px 5px 0 0; }}
+        table {{ border-collapse: collapse; width: 100%; }}
+        th {{ background: #1a3d7a; color: white; text-align: left; }}
+        th, td {{ padding: 8px; border: 1px solid #ddd; vertical-align: top; }}
+        tr:nth-child(even) {{ background: #f9f9f9; }}
+        .footer {{ text-align: center; margin-top: 20px; color: #666; font-size: 12px; }}
+    </style>
+</head>
+<body>
+    <div class="header">
+        <h2>📦 Новые заявки с бота ELP: {count}</h2>
+    </div>
+    <table>
+        <tr><th>ID</th><th>Время</th><th>Клиент</th><th>Контакт</th><th>Площадь</th><th>Срок</th><th>Telegram</th></tr>
+        {rows}
+    </table>
+    <div class="footer">
+        <p>📍 Евразийский Логистический Парк | Алматы</p>
+        <p><em>Сводка сгенерирована автоматически Telegram-ботом ELP</em></p>
+    </div>
+</body>
+</html>
+"""
+
+
+def render_step_term(lead):
+    return STEP_TERM_TEMPLATE.format(area=lead['area'])
+
+def render_step_name(lead):
+    return STEP_NAME_TEMPLATE.format(area=lead['area'], term=lead['term'])
+
+def render_step_contact(lead):
+    return STEP_CONTACT_TEMPLATE.format(area=lead['area'], term=lead['term'], name=lead['name'])
+
+def _md(value):
+    """Данные клиента в Markdown-уведомлении: один «_» или «*» иначе ломает всё сообщение"""
+    return escape_markdown(str(value or ''))
+
+def render_admin_lead(lead, lead_id, email_status, time):
+    return ADMIN_LEAD_TEMPLATE.format(
+        lead_id=lead_id, email_status=email_status, name=_md(lead['name']),
+        username=_md(lead['username']), contact_type=_md(lead['contact_type']), contact=_md(lead['contact']),
+        area=_md(lead['area']), term=_md(lead['term']), time=time, user_id=lead['user_id']
+    )
+
+def render_email(lead, lead_id, time):
+    subject = EMAIL_SUBJECT_TEMPLATE.format(lead_id=lead_id, name=lead['name'])
+    body = EMAIL_BODY_TEMPLATE.format(
+        lead_id=lead_id, name=lead['name'], contact=lead['contact'],
+        contact_type=lead['contact_type'], area=lead['area'], term=lead['term'],
+        time=time, user_id=lead['user_id'], username=lead.get('username', 'не указан')
+    )
+    return subject, body
+
+def render_admin_digest(items, email_status):
+    """Сводка заявок для админа; items — (заявка, id, время). Возвращает список сообщений"""
+    messages = []
+    current = ADMIN_DIGEST_HEADER_TEMPLATE.format(count=len(items), email_status=email_status)
+    for lead, lead_id, time in items:
+        item = ADMIN_DIGEST_ITEM_TEMPLATE.format(
+            lead_id=lead_id, time=time, name=_md(lead['name']), username=_md(lead['username']),
+            user_id=lead['user_id'], contact=_md(lead['contact']), contact_type=_md(lead['contact_type']),
+            area=_md(lead['area']), term=_md(lead['term'])
+        )
+        if len(current) + len(item) > ADMIN_DIGEST_LIMIT:
+            messages.append(current)
+            current = ''
+        current += item
+    messages.append(current)
+    return messages
+
+def render_email_digest(items):
+    """Одно письмо на всю сводку (HTML: данные клиентов экранируются)"""
+    rows = "\n        ".join(
+        EMAIL_DIGEST_ROW_TEMPLATE.format(
+            lead_id=html.escape(str(lead_id)), time=time, name=html.escape(lead['name'] or ''),
+            contact=html.escape(lead['contact'] or ''), contact_type=html.escape(lead['contact_type'] or ''),
+            area=html.escape(lead['area'] or ''), term=html.escape(lead['term'] or ''),
+            username=html.escape(lead.get('username') or 'не указан'), user_id=lead['user_id']
+        )
+        for lead, lead_id, time in items
+    )
+    subject = EMAIL_DIGEST_SUBJECT_TEMPLATE.format(count=len(items), first=items[0][2], last=items[-1][2])
+    return subject, EMAIL_DIGEST_BODY_TEMPLATE.format(count=len(items), rows=rows)
+
+def render_leads_page(rows, prev_cursor=None, next_cursor=None):
+    """Страница /leads (HTML: имена и контакты экранируются) и кнопки листания"""
+    if not rows:
+        return "📋 <b>Заявок пока нет</b>", None
+    lines = ["📋 <b>Заявки</b>\n"]
+    for row in rows:
+        lines.append(
+            f"<b>#{row['id']}</b> · {row['created_at'].strftime('%d.%m.%Y %H:%M')} · {html.escape(row['status'] or '')}\n"
+            f"👤 {html.escape(row['name'] or '')} — {html.escape(row['contact'] or '')} ({html.escape(row['contact_type'] or '')})\n"
+            f"📐 {html.escape(row['area'] or '')} · 📅 {html.escape(row['term'] or '')}\n"
+        )
+    buttons = []
+    if prev_cursor:
+        buttons.append(InlineKeyboardButton("⬅️ Новее", callback_data=f"leads:newer:{prev_cursor}"))
+    if next_cursor:
+        buttons.append(InlineKeyboardButton("Старше ➡️", callback_data=f"leads:older:{next_cursor}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+BROADCAST_STATUS_LABELS = {
+    'draft': '📝 черновик', 'running': '▶️ идёт', 'done': '✅ завершена', 'cancelled': '⏹️ остановлена',
+    'failed': '❌ прервана ошибкой'
+}
+
+def broadcast_confirm_keyboard(broadcast_id, total):
+    return _keyboard(
+        [(f"✅ Отправить {total} получателям", f'broadcast:confirm:{broadcast_id}')],
+        [("❌ Отмена", f'broadcast:cancel:{broadcast_id}')]
+    )
+
+def render_broadcast_preview(text, total):
+    return f"📣 Предпросмотр рассылки ({total} получателей):\n\n{text}"
+
+def render_broadcast_status(broadcast):
+    """Прогресс рассылки (без Markdown: в счётчиках нет разметки)"""
+    processed = broadcast['delivered'] + broadcast['blocked'] + broadcast['failed'] + broadcast['unknown']
+    return (
+        f"📣 Рассылка #{broadcast['id']}: {BROADCAST_STATUS_LABELS.get(broadcast['status'], broadcast['status'])}\n"
+        f"• Обработано: {processed} из {broadcast['total']}\n"
+        f"• Доставлено: {broadcast['delivered']}\n"
+        f"• Заблокировали бота: {broadcast['blocked']}\n"
+        f"• Ошибок: {broadcast['failed']}"
+        + (f"\n• Прервано сбоем: {broadcast['unknown']}" if broadcast['unknown'] else "")
+        + ("\n\nПродолжить с места остановки: /broadcast resume" if broadcast['status'] == 'failed' else "")
+    )
+
+
+FUNNEL_STEP_LABELS = {
+    'request': 'начало', 'area': 'площадь', 'term': 'срок', 'name': 'имя', 'confirm': 'заявка'
+}
+FUNNEL_PERIOD_LABELS = {'day': ('по дням', '%d.%m'), 'week': ('по неделям', 'с %d.%m')}
+
+def _format_duration(seconds):
+    if seconds is None:
+        return '—'
+    if seconds < 60:
+        return f"{seconds:.0f}с"
+    if seconds < 3600:
+        return f"{seconds // 60:.0f}м{seconds % 60:02.0f}с"
+    return f"{seconds // 3600:.0f}ч{seconds % 3600 // 60:02.0f}м"
+
+def _render_funnel_row(steps, medians, order):
+    """«120 → 90 (75%) → ...» и медианы времени каждого перехода"""
+    parts = []
+    previous = None
+    for step in order:
+        users = steps.get(step, 0)
+        part = str(users)
+        if previous is not None:
+            part += f" ({users * 100 / previous:.0f}%)" if previous else " (—)"
+        parts.append(part)
+        previous = users
+    first, last = steps.get(order[0], 0), steps.get(order[-1], 0)
+    overall = f"{last * 100 / first:.0f}%" if first else "—"
+    times = ' · '.join(_format_duration(medians.get(step)) for step in order[1:])
+    return f"{' → '.join(parts)} | {overall}", f"  ⏱ {times}"
+
+def render_funnel_report(report, order):
+    """Отчёт /funnel (без Markdown: только числа и ключи разделов)"""
+    title, date_format = FUNNEL_PERIOD_LABELS[report['period']]
+    rolled = report['rolled_until']
+    lines = [
+        f"📈 Воронка заявок {title} (UTC), данные до {rolled.strftime('%d.%m %H:00') if rolled else '—'}",
+        f"Шаги: {' → '.join(FUNNEL_STEP_LABELS[step] for step in order)} | конверсия",
+        f"⏱ — медиана времени перехода к шагу: {' · '.join(FUNNEL_STEP_LABELS[step] for step in order[1:])}",
+        "",
+    ]
+    if not report['periods']:
+        lines.append("Событий воронки пока нет")
+        return "\n".join(lines)
+    counts, times = _render_funnel_row(report['total']['steps'], report['total']['medians'], order)
+    lines += [f"Итого с {report['since'].strftime('%d.%m')}: {counts}", times, ""]
+    for row in report['periods']:
+        counts, times = _render_funnel_row(row['steps'], row['medians'], order)
+        lines += [f"{row['start'].strftime(date_format)}: {counts}", times]
+    if report['sections']:
+        lines += ["", "📚 Разделы базы знаний: просмотры → заявки после просмотра"]
+        for section, views, leads in report['sections']:
+            lines.append(f"• {section}: {views} → {leads}" + (f" ({leads * 100 / views:.0f}%)" if views else ""))
+    return "\n".join(lines)